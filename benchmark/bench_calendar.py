@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Benchmark for the backend reservation calendar.
+
+Fills the calendar with an increasing number of reservations spread over a
+number of resources (VLANs on a port) and measures the time for overlap checks.
+The time per check should stay (roughly) flat as the number of reservations grows.
+
+Run from the project root: PYTHONPATH=. python benchmark/bench_calendar.py
+"""
+
+import time
+import random
+import datetime
+
+from opennsa.backends.common import calendar
+
+
+RESOURCES   = [ 'port1:vlan=%i' % vlan for vlan in range(1000, 1100) ]
+CHECKS      = 10000
+
+
+
+def fill(cal, count):
+    now = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
+    per_resource = count / len(RESOURCES)
+    for resource in RESOURCES:
+        for i in range(per_resource):
+            start_time = now + datetime.timedelta(minutes=i*10)
+            end_time   = start_time + datetime.timedelta(minutes=5)
+            cal.addReservation(resource, start_time, end_time)
+    return now, per_resource
+
+
+def benchmark(count):
+    cal = calendar.ReservationCalendar()
+    now, per_resource = fill(cal, count)
+
+    rnd = random.Random(count)
+    checks = []
+    for _ in range(CHECKS):
+        resource = rnd.choice(RESOURCES)
+        start_time = now + datetime.timedelta(minutes=rnd.randint(0, per_resource*10))
+        checks.append( (resource, start_time, start_time + datetime.timedelta(minutes=3)) )
+
+    t_start = time.time()
+    conflicts = 0
+    for resource, start_time, end_time in checks:
+        # the overlap check directly, checkReservation also validates the times against the clock
+        if cal._resourceOverlap(resource, start_time, end_time):
+            conflicts += 1
+    elapsed = time.time() - t_start
+
+    print '%8i reservations: %6.2f us / check (%i conflicts)' % (count, elapsed / CHECKS * 1000000, conflicts)
+
+
+
+if __name__ == '__main__':
+    for count in (1000, 10000, 100000):
+        benchmark(count)
+
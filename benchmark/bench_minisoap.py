@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmark for SOAP payload construction.
+
+Measures the time to build and serialize the envelopes of the typical NSI
+connection messages (reserve, reserveConfirmed, generic acknowledgement,
+service exception fault, and querySummaryConfirmed with an increasing number
+of reservations), with compact and pretty printed serialization.
+
+Run from the project root: PYTHONPATH=. python benchmark/bench_minisoap.py
+"""
+
+import time
+import datetime
+
+from opennsa import nsa, error, state, constants as cnt
+from opennsa.shared.xmlhelper import createXMLTime
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper, queryhelper
+from opennsa.protocols.nsi2.bindings import nsiconnection, p2pservices
+
+
+ITERATIONS  = 2000
+QUERY_SIZES = [ 10, 100, 1000 ]
+
+REQUESTER   = 'urn:ogf:network:example.org:2013:requester'
+PROVIDER    = 'urn:ogf:network:example.net:2013:nsa'
+REPLY_TO    = 'http://localhost:9080/NSI/services/RequesterService2'
+
+START_TIME  = datetime.datetime(2017, 1, 1, 12, 00)
+END_TIME    = datetime.datetime(2017, 1, 1, 13, 00)
+
+SOURCE_STP  = nsa.STP('example.net:2013', 'ps',  nsa.Label(cnt.ETHERNET_VLAN, '1781-1789'))
+DEST_STP    = nsa.STP('example.net:2013', 'bon', nsa.Label(cnt.ETHERNET_VLAN, '1782'))
+
+
+
+def header():
+    return nsa.NSIHeader(REQUESTER, PROVIDER, correlation_id='urn:uuid:f2d8a5a4-2b34-4fdc-a4a8-3e7d6a4c7d5e', reply_to=REPLY_TO)
+
+
+def reserve():
+    header_element = helper.convertProviderHeader(header(), REPLY_TO)
+    service_def = p2pservices.P2PServiceBaseType(1000, cnt.BIDIRECTIONAL, True, SOURCE_STP.urn(), DEST_STP.urn(), None, None)
+    schedule = nsiconnection.ScheduleType(createXMLTime(START_TIME), createXMLTime(END_TIME))
+    criteria = nsiconnection.ReservationRequestCriteriaType(0, schedule, cnt.EVTS_AGOLE, service_def)
+    reservation = nsiconnection.ReserveType(None, 'urn:uuid:1c5e9b0e-5f5b-4c5c-8e7a-4b2f1e8d2f11', 'bench', criteria)
+    return minisoap.createSoapPayload(reservation.xml(nsiconnection.reserve), header_element)
+
+
+def reserveConfirmed():
+    header_element = helper.createRequesterHeader(REQUESTER, PROVIDER, correlation_id='urn:uuid:f2d8a5a4-2b34-4fdc-a4a8-3e7d6a4c7d5e')
+    p2p = p2pservices.P2PServiceBaseType(1000, cnt.BIDIRECTIONAL, True, SOURCE_STP.urn(), DEST_STP.urn(), None, [])
+    schedule = nsiconnection.ScheduleType(createXMLTime(START_TIME), createXMLTime(END_TIME))
+    criteria = nsiconnection.ReservationConfirmCriteriaType(0, schedule, cnt.EVTS_AGOLE, str(p2pservices.p2ps), p2p)
+    reserve_conf = nsiconnection.ReserveConfirmedType('B6E2A4F1A2', 'urn:uuid:1c5e9b0e-5f5b-4c5c-8e7a-4b2f1e8d2f11', 'bench', criteria)
+    return minisoap.createSoapPayload(reserve_conf.xml(nsiconnection.reserveConfirmed), header_element)
+
+
+def acknowledgement():
+    return helper.createGenericProviderAcknowledgement(header())
+
+
+def fault():
+    err = error.STPUnavailableError('STP %s is not available' % SOURCE_STP)
+    se = helper.createServiceException(err, PROVIDER, 'B6E2A4F1A2')
+    return minisoap.createSoapFault(str(err), se.xml(nsiconnection.serviceException))
+
+
+def createConnectionInfos(count):
+    sd = nsa.Point2PointService(SOURCE_STP, DEST_STP, 1000, cnt.BIDIRECTIONAL, False, None)
+    criteria = nsa.QueryCriteria(0, nsa.Schedule(START_TIME, END_TIME), sd)
+    states = (state.RESERVE_START, state.PROVISIONED, state.CREATED, (True, 0, True))
+    return [ nsa.ConnectionInfo('conn-%i' % i, None, 'bench %i' % i, cnt.EVTS_AGOLE, [ criteria ], PROVIDER, REQUESTER, states, None, None)
+             for i in range(count) ]
+
+
+def querySummaryConfirmed(connection_infos):
+    header_element = helper.createRequesterHeader(REQUESTER, PROVIDER, correlation_id='urn:uuid:f2d8a5a4-2b34-4fdc-a4a8-3e7d6a4c7d5e')
+    qsct = nsiconnection.QuerySummaryConfirmedType(queryhelper.buildQuerySummaryResultType(connection_infos))
+    return minisoap.createSoapPayload(qsct.xml(nsiconnection.querySummaryConfirmed), header_element)
+
+
+
+def measure(build, iterations):
+    t_start = time.time()
+    for i in range(iterations):
+        payload = build()
+    return (time.time() - t_start) / iterations, len(payload)
+
+
+def run(name, build, iterations):
+    results = []
+    for pretty in (False, True):
+        minisoap.PRETTY_PRINT = pretty
+        results.append( measure(build, iterations) )
+
+    (compact_time, compact_size), (pretty_time, pretty_size) = results
+    print '%-28s  compact: %9.1f us %7i bytes   pretty: %9.1f us %7i bytes   (%.2fx)' % \
+        (name, compact_time * 1e6, compact_size, pretty_time * 1e6, pretty_size, pretty_time / compact_time)
+
+
+
+def main():
+
+    run('reserve',              reserve,            ITERATIONS)
+    run('reserveConfirmed',     reserveConfirmed,   ITERATIONS)
+    run('acknowledgement',      acknowledgement,    ITERATIONS)
+    run('fault',                fault,              ITERATIONS)
+
+    for count in QUERY_SIZES:
+        connection_infos = createConnectionInfos(count)
+        run('querySummaryConfirmed/%i' % count, lambda : querySummaryConfirmed(connection_infos), max(ITERATIONS / count, 5))
+
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark for NML topology path finding.
+
+Creates synthetic inter-domain topologies, where each network has a
+termination port and a number of peerings with random other networks (with
+random VLAN ranges), and measures the time for finding paths between random
+termination points, with different bounds on the number of paths.
+
+Run from the project root: PYTHONPATH=. python benchmark/bench_pathfinding.py
+"""
+
+import time
+import random
+from StringIO import StringIO
+
+from opennsa import nsa, constants as cnt
+from opennsa.topology import nrm, nml
+
+
+NETWORK_COUNTS  = [ 50, 100, 200, 500 ]
+PEERINGS        = 3     # peerings created per network (networks get twice this on average)
+SEARCHES        = 20
+MAX_PATHS       = [ 1, 5, 10 ]
+
+LABEL           = nsa.Label(cnt.ETHERNET_VLAN, '1780-1789')
+
+
+
+def createTopology(network_count, seed=1):
+
+    rnd = random.Random(seed)
+    names = [ 'net%i' % i for i in range(network_count) ]
+    specs = dict( (name, [ 'ethernet  ps  -  vlan:1780-1789  1000  em0  -' ]) for name in names )
+
+    peerings = set()
+    for idx, name in enumerate(names):
+        # connect to the next network, so the topology is connected, then some random ones
+        peers = [ names[(idx + 1) % network_count] ] + rnd.sample(names, PEERINGS - 1)
+        for peer in peers:
+            if peer == name or (name, peer) in peerings or (peer, name) in peerings:
+                continue
+            peerings.add( (name, peer) )
+            start = rnd.randint(1780, 1786)
+            vlans = 'vlan:%i-%i' % (start, start + rnd.randint(0, 1789 - start))
+            specs[name].append('ethernet  %s  %s#%s-(in|out)  %s  1000  em1  -' % (peer, peer, name, vlans))
+            specs[peer].append('ethernet  %s  %s#%s-(in|out)  %s  1000  em1  -' % (name, name, peer, vlans))
+
+    topology = nml.Topology()
+    for name in names:
+        nrm_ports = nrm.parsePortSpec( StringIO('\n'.join(specs[name]) + '\n') )
+        network = nml.createNMLNetwork(nrm_ports, name, name)
+        topology.addNetwork(network, nsa.NetworkServiceAgent(name + ':nsa', 'http://%s/nsi' % name))
+
+    return topology, names, len(peerings)
+
+
+def benchmark(network_count):
+
+    topology, names, peering_count = createTopology(network_count)
+
+    rnd = random.Random(network_count)
+    endpoints = [ rnd.sample(names, 2) for _ in range(SEARCHES) ]
+
+    results = []
+    for max_paths in MAX_PATHS:
+        t_start = time.time()
+        found = 0
+        for source, dest in endpoints:
+            paths = topology.findPaths(nsa.STP(source, 'ps', LABEL), nsa.STP(dest, 'ps', LABEL), 100, max_paths=max_paths)
+            found += len(paths)
+        elapsed = time.time() - t_start
+        results.append('k=%-2i %8.2f ms / search (%4.1f paths)' % (max_paths, elapsed / SEARCHES * 1000, float(found) / SEARCHES))
+
+    print '%4i networks, %5i peerings:   %s' % (network_count, peering_count, '   '.join(results))
+
+
+
+if __name__ == '__main__':
+    for network_count in NETWORK_COUNTS:
+        benchmark(network_count)
+
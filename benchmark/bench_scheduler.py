@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark for the call scheduler.
+
+Measures schedule and cancel throughput for the timing wheel based scheduler,
+with a reactor DelayedCall per call (the previous implementation) as reference.
+
+Run from the project root: PYTHONPATH=. python benchmark/bench_scheduler.py
+"""
+
+import sys
+import time
+import random
+import datetime
+
+from twisted.internet import reactor, task
+
+from opennsa.backends.common import scheduler
+
+
+COUNTS = [ 10000, 100000, 1000000 ]
+
+
+
+def noop():
+    pass
+
+
+def benchmarkScheduler(count):
+
+    sched = scheduler.CallScheduler()
+    sched.clock = task.Clock()
+
+    rnd = random.Random(count)
+    now = datetime.datetime.utcnow()
+    times = [ now + datetime.timedelta(seconds=rnd.randint(60, 86400*30)) for _ in range(count) ]
+
+    t_start = time.time()
+    for cid, ts in enumerate(times):
+        sched.scheduleCall(cid, ts, noop)
+    t_schedule = time.time() - t_start
+
+    t_start = time.time()
+    for cid in range(count):
+        sched.cancelCall(cid)
+    t_cancel = time.time() - t_start
+
+    return t_schedule, t_cancel
+
+
+def benchmarkDelayedCalls(count):
+
+    # the reactor keeps delayed calls in a heap, task.Clock uses a sorted list, so use the reactor (it does not have to run)
+    clock = reactor
+    rnd = random.Random(count)
+    delays = [ rnd.randint(60, 86400*30) for _ in range(count) ]
+
+    t_start = time.time()
+    calls = [ task.deferLater(clock, delay, noop) for delay in delays ]
+    t_schedule = time.time() - t_start
+
+    t_start = time.time()
+    for d in calls:
+        d.addErrback(lambda _ : None)
+        d.cancel()
+    t_cancel = time.time() - t_start
+
+    return t_schedule, t_cancel
+
+
+def report(name, count, t_schedule, t_cancel):
+    print '%-14s %8i calls: schedule %10.0f/s   cancel %10.0f/s' % (name, count, count / t_schedule, count / t_cancel)
+
+
+
+if __name__ == '__main__':
+
+    counts = [ int(c) for c in sys.argv[1:] ] or COUNTS
+
+    for count in counts:
+        report('timing wheel', count, *benchmarkScheduler(count))
+        report('delayed calls', count, *benchmarkDelayedCalls(count))
+
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Benchmark for SOAP payload parsing.
+
+Measures parse (XML to elements) and build (XML to binding objects, i.e.,
+helper.parseRequest) throughput for reserve, reserveConfirmed and
+querySummaryConfirmed payloads, with the ElementTree and lxml backends.
+The payloads are created as in bench_minisoap.
+
+Run from the project root: PYTHONPATH=. python benchmark/bench_xmlparse.py
+"""
+
+import time
+
+from opennsa.shared import xmlhelper
+from opennsa.protocols.nsi2 import helper
+
+import bench_minisoap
+
+
+ITERATIONS  = 2000
+QUERY_SIZES = [ 10, 100, 1000 ]
+
+
+
+def measure(func, payload, iterations):
+    t_start = time.time()
+    for i in range(iterations):
+        func(payload)
+    return iterations / (time.time() - t_start)
+
+
+def run(name, payload, iterations):
+    backends = [ xmlhelper.ETREE ]
+    if xmlhelper.lxml_etree is not None:
+        backends.append(xmlhelper.LXML)
+
+    results = []
+    for backend in backends:
+        xmlhelper.XML_BACKEND = backend
+        parse_rate = measure(xmlhelper.parseXML,   payload, iterations)
+        build_rate = measure(helper.parseRequest,  payload, iterations)
+        results.append('%s: %8.0f parse/s %8.0f build/s' % (backend, parse_rate, build_rate))
+
+    print '%-28s %7i bytes   %s' % (name, len(payload), '   '.join(results))
+
+
+
+def main():
+
+    if xmlhelper.lxml_etree is None:
+        print 'lxml not available, only measuring ElementTree'
+
+    run('reserve',              bench_minisoap.reserve(),           ITERATIONS)
+    run('reserveConfirmed',     bench_minisoap.reserveConfirmed(),  ITERATIONS)
+
+    for count in QUERY_SIZES:
+        payload = bench_minisoap.querySummaryConfirmed( bench_minisoap.createConnectionInfos(count) )
+        run('querySummaryConfirmed/%i' % count, payload, max(ITERATIONS / count, 5))
+
+
+
+if __name__ == '__main__':
+    main()
+
@@ -4,6 +4,7 @@
 DROP TABLE generic_backend_connections;
 DROP TABLE sub_connections;
 DROP TABLE service_connections;
+DROP FUNCTION update_last_modified();
 DROP TYPE directionality;
 DROP TYPE security_attribute;
 DROP TYPE parameter;
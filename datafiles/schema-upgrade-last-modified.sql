@@ -0,0 +1,29 @@
+-- OpenNSA SQL Schema (PostgreSQL) upgrade
+-- Adds the last modified time of service connections and the query paging
+-- indexes to a database created from an earlier schema.sql. Run it once:
+-- \i datafiles/schema-upgrade-last-modified.sql
+
+BEGIN;
+
+ALTER TABLE service_connections ADD COLUMN last_modified timestamp;
+
+-- existing connections have not been tracked, the reserve time is the best we have
+UPDATE service_connections SET last_modified = reserve_time;
+
+ALTER TABLE service_connections ALTER COLUMN last_modified SET NOT NULL;
+
+CREATE INDEX service_connections_requester_idx ON service_connections (requester_nsa, id);
+
+CREATE FUNCTION update_last_modified() RETURNS trigger AS $$
+BEGIN
+    NEW.last_modified := now() at time zone 'utc';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER service_connections_last_modified BEFORE INSERT OR UPDATE ON service_connections
+    FOR EACH ROW EXECUTE PROCEDURE update_last_modified();
+
+CREATE INDEX sub_connections_service_connection_idx ON sub_connections (service_connection_id);
+
+COMMIT;
@@ -46,9 +46,23 @@ CREATE TABLE service_connections (
     bandwidth               integer                     NOT NULL, -- mbps
     parameter               parameter[],
     security_attributes     security_attribute[],
-    connection_trace        text[]
+    connection_trace        text[],
+    last_modified           timestamp                   NOT NULL  -- maintained by trigger below
 );
 
+-- query summary pages through the connections of a requester by id
+CREATE INDEX service_connections_requester_idx ON service_connections (requester_nsa, id);
+
+CREATE FUNCTION update_last_modified() RETURNS trigger AS $$
+BEGIN
+    NEW.last_modified := now() at time zone 'utc';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER service_connections_last_modified BEFORE INSERT OR UPDATE ON service_connections
+    FOR EACH ROW EXECUTE PROCEDURE update_last_modified();
+
 -- internal references to connections that are part of a service connection
 CREATE TABLE sub_connections (
     id                      serial                      PRIMARY KEY,
@@ -72,6 +86,8 @@ CREATE TABLE sub_connections (
     UNIQUE (provider_nsa, connection_id)
 );
 
+CREATE INDEX sub_connections_service_connection_idx ON sub_connections (service_connection_id);
+
 
 -- move this into the backend sometime
 CREATE TABLE generic_backend_connections (
@@ -4,6 +4,7 @@ Connection abstraction.
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
+import time
 import datetime
 
 from zope.interface import implements
@@ -18,6 +19,10 @@ from opennsa import error, nsa, state, database, constants as cnt
 
 LOG_SYSTEM = 'Aggregator'
 
+QUERY_PAGE_SIZE = 200 # number of connections fetched per query summary page
+MAX_PATHS       = 3   # number of candidate paths computed when creating aggregate paths
+RETRY_DEADLINE  = 30  # seconds, after which no further paths are tried (alternate path policy)
+
 
 
 def shortLabel(label):
@@ -67,7 +72,7 @@ class Aggregator:
 
     implements(INSIProvider, INSIRequester)
 
-    def __init__(self, network, nsa_, network_topology, route_vectors, parent_requester, provider_registry, policies, plugin):
+    def __init__(self, network, nsa_, network_topology, route_vectors, parent_requester, provider_registry, policies, plugin, retry_deadline=RETRY_DEADLINE):
         self.network = network
         self.nsa_ = nsa_
         self.network_topology = network_topology
@@ -77,8 +82,12 @@ class Aggregator:
         self.provider_registry  = provider_registry
         self.policies           = policies
         self.plugin             = plugin
+        self.retry_deadline     = retry_deadline
 
         self.reservations       = {} # correlation_id -> info
+        self.path_attempts      = {} # service connection key -> path attempt, while the connection is being reserved
+        self.abandoned_reservations = set() # correlation ids of sub reservations replaced by an alternate path
+        self.abandoned_sub_connections = set() # (provider nsa, connection id) of sub connections terminated during reservation
         self.notification_id    = 0
 
         # db orm cache, needed to avoid concurrent updates stepping on each other
@@ -108,8 +117,8 @@ class Aggregator:
             # we should get 0 or 1 here since connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No connection with id %s' % connection_id) )
-            self.db_connections[connection_id] = connections[0]
-            return connections[0]
+            # a concurrent lookup may have cached the connection meanwhile, state changes must all go through the same object
+            return self.db_connections.setdefault(connection_id, connections[0])
 
         if connection_id in self.db_connections:
             return defer.succeed(self.db_connections[connection_id])
@@ -168,11 +177,27 @@ class Aggregator:
         return d
 
 
+    def _createPath(self, local_stp, remote_stp, vector_port):
+        # create abstracted path: local link + rest, via the demarcation port vector_port
+        # new stps are created for each path, as plugins (see pruner) may change the labels
+
+        # this really shouldn't fail, so we don't need to check
+        ldp = self.network_topology.getPort( self.network + ':' + vector_port )
+
+        local_demarc_port  = ldp.id_.rsplit(':', 1)[1]
+        remote_demarc_network, remote_demarc_port = ldp.remote_port.rsplit(':', 1) # [1] # this is wrong in the new naming scheme
+
+        local_link  = nsa.Link( nsa.STP(local_stp.network, local_stp.port, local_stp.label), nsa.STP(local_stp.network, local_demarc_port, ldp.label()) )
+        remote_link = nsa.Link( nsa.STP(remote_demarc_network, remote_demarc_port, ldp.label()), nsa.STP(remote_stp.network, remote_stp.port, remote_stp.label)) # # the ldp label isn't quite correct
+
+        return [ local_link, remote_link ]
+
+
     @defer.inlineCallbacks
     def reserve(self, header, connection_id, global_reservation_id, description, criteria, request_info=None):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('Reserve request from %s' % header.requester_nsa, system=LOG_SYSTEM)
+        log.msg('Reserve request from %s' % header.requester_nsa, system=LOG_SYSTEM, header=header, connection_id=connection_id)
         log.msg('- Path %s -- %s ' % (criteria.service_def.source_stp, criteria.service_def.dest_stp), system=LOG_SYSTEM)
         log.msg('- Trace: %s' % (header.connection_trace), system=LOG_SYSTEM)
 
@@ -311,26 +336,17 @@ class Aggregator:
                 local_stp      = dest_stp
                 remote_stp     = source_stp
 
-            # we should really find multiple port/link vectors to the remote network, but right now we don't
-            vector_port = self.route_vectors.vector(remote_stp.network)
-            if vector_port is None:
+            # find candidate port/link vectors to the remote network, cheapest first
+            vector_ports = self.route_vectors.rankedVectors(remote_stp.network, MAX_PATHS)
+            if not vector_ports:
                 raise error.STPResolutionError('No vector to network %s, cannot create circuit' % remote_stp.network)
 
-            log.msg('Vector to %s via port %s' % (remote_stp.network, vector_port), system=LOG_SYSTEM)
-
-            # this really shouldn't fail, so we don't need to check
-            demarc_ports = [ self.network_topology.getPort( self.network + ':' + vector_port ) ]
-
-            ldp = demarc_ports[0] # most of the time we will only have one anyway, should iterate and build multiple paths
-
-            local_demarc_port  = ldp.id_.rsplit(':', 1)[1]
-            remote_demarc_network, remote_demarc_port = ldp.remote_port.rsplit(':', 1) # [1] # this is wrong in the new naming scheme
-
-            local_link  = nsa.Link( local_stp, nsa.STP(local_stp.network, local_demarc_port, ldp.label()) )
-            remote_link = nsa.Link( nsa.STP(remote_demarc_network, remote_demarc_port, ldp.label()), remote_stp) # # the ldp label isn't quite correct
+            log.msg('Vectors to %s via port(s) %s' % (remote_stp.network, ', '.join(vector_ports)), system=LOG_SYSTEM)
 
-            paths = [ [ local_link, remote_link ] ]
+            paths = [ self._createPath(local_stp, remote_stp, vector_port) for vector_port in vector_ports ]
             paths = yield self.plugin.prunePaths(paths)
+            if not paths:
+                raise error.STPResolutionError('No usable path to network %s, cannot create circuit' % remote_stp.network)
 
         elif cnt.AGGREGATOR in self.policies:
             # both endpoints outside the network, proxy aggregation allowed
@@ -343,33 +359,143 @@ class Aggregator:
                 (source_stp.network, dest_stp.network, self.network))
 
 
-        selected_path = paths[0] # shortest path (legacy structure)
-        log_path = ' -> '.join( [ str(p) for p in selected_path ] )
-        log.msg('Attempting to create path %s' % log_path, system=LOG_SYSTEM)
+        # with the alternate path policy, the next candidate path is tried if a sub reservation fails
+        attempt = {
+            'paths'         : paths if cnt.ALTERNATE_PATH in self.policies else paths[:1],
+            'tried'         : 0,        # number of paths tried
+            'start'         : time.time(),
+            'header'        : header,
+            'criteria'      : criteria,
+            'request_info'  : request_info,
+            'conn_trace'    : (header.connection_trace or []) + [ self.nsa_.urn() + ':' + conn.connection_id ],
+            'reserved'      : [],       # acked sub reservations: (order_id, link, sub connection id, provider urn, correlation id)
+            'failed'        : [],       # correlation ids of sub reservations which failed in the previous attempt
+            'rejected'      : [],       # acked sub reservations which have failed later (reserveFailed)
+            'async_failed'  : set(),    # correlation ids of sub reservations for which reserveFailed has been received
+            'local_id_used' : False,
+            'busy'          : False     # a path is being tried
+        }
+        self.path_attempts[conn.id] = attempt
+
+        try:
+            results, provider_urns = yield self._tryPaths(conn, attempt)
+        except Exception:
+            self.path_attempts.pop(conn.id, None)
+            raise
+        if results is None:
+            log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
+            defer.returnValue(connection_id)
+
+        # I think this is out of spec, the aggregator shouldn't do anything here...
+        # terminate non-failed connections
+        # currently we don't try and be too clever about cleaning, just do it, and switch state
+        yield state.terminating(conn)
+        yield self._abandonPathAttempt(conn, attempt)
+        yield state.terminated(conn)
+
+        if all( [ success for success, _ in results ] ): # acked, but reserveFailed has been received
+            raise error.ConnectionCreateError('Sub reservation failed for connection %s, no further paths to try' % connection_id)
+
+        err = _createAggregateException(connection_id, 'reservations', results, provider_urns, error.ConnectionCreateError)
+        raise err
+
+
+    def _morePaths(self, attempt):
+        return attempt['tried'] < len(attempt['paths']) and time.time() - attempt['start'] <= self.retry_deadline
 
-        for link in selected_path:
-            if link.src_stp.network == self.network:
-                continue # we got this..
-            p = self.provider_registry.getProviderByNetwork(link.src_stp.network)
-            if p is None:
-                raise error.ConnectionCreateError('No provider for network %s. Cannot create link.' % link.src_stp.network)
 
-        conn_trace = (header.connection_trace or []) + [ self.nsa_.urn() + ':' + conn.connection_id ]
+    @defer.inlineCallbacks
+    def _tryPaths(self, conn, attempt):
+        # try the remaining paths of the attempt, until one has all its sub reservations acked
+        # returns (None, None) if a path was acked, otherwise the results and provider urns of the last attempted path
+
+        results, provider_urns = [], []
+
+        attempt['busy'] = True
+        try:
+            while attempt['tried'] < len(attempt['paths']):
+
+                n = attempt['tried']
+                selected_path = attempt['paths'][n]
+                attempt['tried'] += 1
+
+                if n > 0 and time.time() - attempt['start'] > self.retry_deadline:
+                    log.msg('Connection %s: Retry deadline of %i seconds passed, not trying further paths' % (conn.connection_id, self.retry_deadline), system=LOG_SYSTEM)
+                    break
+
+                log_path = ' -> '.join( [ str(p) for p in selected_path ] )
+                log.msg('Attempting to create path %s' % log_path, system=LOG_SYSTEM)
+
+                missing_networks = [ link.src_stp.network for link in selected_path
+                                     if link.src_stp.network != self.network and self.provider_registry.getProviderByNetwork(link.src_stp.network) is None ]
+                if missing_networks:
+                    if n == 0:
+                        raise error.ConnectionCreateError('No provider for network %s. Cannot create link.' % missing_networks[0])
+                    log.msg('Connection %s: No provider for network %s, skipping path' % (conn.connection_id, missing_networks[0]), system=LOG_SYSTEM)
+                    continue
+
+                results, provider_urns = yield self._reservePath(conn, attempt, selected_path)
+                if len(attempt['reserved']) == len(selected_path):
+                    defer.returnValue( (None, None) )
+        finally:
+            attempt['busy'] = False
+
+        defer.returnValue( (results, provider_urns) )
+
+
+    def _rejectReservations(self, attempt):
+        # move acked sub reservations, for which reserveFailed has been received, out of the reserved list
+        # the correlation ids are dropped, as the reservations are removed along with the failed ones
+        rejected = [ r for r in attempt['reserved'] if r[4] in attempt['async_failed'] ]
+        attempt['reserved'] = [ r for r in attempt['reserved'] if not r in rejected ]
+        attempt['rejected'] += [ r[:4] + (None,) for r in rejected ]
+
+
+    @defer.inlineCallbacks
+    def _reservePath(self, conn, attempt, selected_path):
+
+        header   = attempt['header']
+        criteria = attempt['criteria']
+        sd       = criteria.service_def
+
+        # keep sub reservations from the previous attempt which are also in this path, only issue the rest
+        self._rejectReservations(attempt)
+        keep = [ r for r in attempt['reserved'] if r[0] < len(selected_path) and selected_path[r[0]] == r[1] ]
+        abandoned = [ r for r in attempt['reserved'] if not r in keep ] + attempt['rejected']
+        attempt['rejected'] = []
+        if abandoned:
+            yield self._abandonReservations(conn, header, abandoned)
+        attempt['reserved'] = list(keep)
+        kept_order_ids = [ r[0] for r in keep ]
+
+        # no confirmation will come for the failed sub reservations, so they must not be waited for. this is only
+        # done when another path is tried, and in the same go as the new sub reservations are added, so a
+        # confirmation for a sub reservation of the previous attempt cannot complete the connection in between
+        for correlation_id in attempt['failed']:
+            self.reservations.pop(correlation_id, None)
+        attempt['failed'] = []
+
+        attempt_start = time.time()
         conn_info = []
 
         for idx, link in enumerate(selected_path):
 
+            if idx in kept_order_ids:
+                continue
+
             sub_connection_id = None
 
             if link.src_stp.network == self.network:
                 provider_urn = self.nsa_.urn()
-                sub_connection_id = connection_id
+                if not attempt['local_id_used']: # the local backend cannot reuse a connection id
+                    sub_connection_id = conn.connection_id
+                    attempt['local_id_used'] = True
             else:
                 provider_urn = self.provider_registry.getProviderByNetwork(link.src_stp.network)
 
-            c_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes, connection_trace=conn_trace)
+            c_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes, connection_trace=attempt['conn_trace'])
 
-            sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
+            link_sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
 
             # save info for db saving
             self.reservations[c_header.correlation_id] = {
@@ -381,14 +507,14 @@ class Aggregator:
                                                         'dest_network'   : link.dst_stp.network,
                                                         'dest_port'      : link.dst_stp.port }
 
-            crt = nsa.Criteria(criteria.revision, criteria.schedule, sd)
+            crt = nsa.Criteria(criteria.revision, criteria.schedule, link_sd)
 
             provider = self.getProvider(provider_urn)
             # note: request info will only be passed to local backends, remote requester will just ignore it
-            d = provider.reserve(c_header, sub_connection_id, conn.global_reservation_id, conn.description, crt, request_info)
-            d.addErrback(_logErrorResponse, connection_id, provider_urn, 'reserve')
+            d = provider.reserve(c_header, sub_connection_id, conn.global_reservation_id, conn.description, crt, attempt['request_info'])
+            d.addErrback(_logErrorResponse, conn.connection_id, provider_urn, 'reserve')
 
-            conn_info.append( (d, provider_urn) )
+            conn_info.append( (d, provider_urn, idx, link, c_header.correlation_id) )
 
             # Don't bother trying to save connection here, wait for reserveConfirmed
 
@@ -396,43 +522,75 @@ class Aggregator:
         results = yield defer.DeferredList( [ c[0] for c in conn_info ], consumeErrors=True) # doesn't errback
         successes = [ r[0] for r in results ]
 
-        if all(successes):
-            log.msg('Connection %s: Reserve acked' % conn.connection_id, system=LOG_SYSTEM)
-            defer.returnValue(connection_id)
+        for (success, sc_id), (_, provider_urn, idx, link, correlation_id) in zip(results, conn_info):
+            if success:
+                attempt['reserved'].append( (idx, link, sc_id, provider_urn, correlation_id) )
+            else:
+                attempt['failed'].append(correlation_id)
 
-        else:
-            # I think this is out of spec, the aggregator shouldn't do anything here...
-            # terminate non-failed connections
-            # currently we don't try and be too clever about cleaning, just do it, and switch state
-            yield state.terminating(conn)
-            defs = []
-            reserved_connections = [ (sc_id, provider_urn) for (success,sc_id),(_,provider_urn) in zip(results, conn_info) if success ]
-            for (sc_id, provider_urn) in reserved_connections:
+        # reserveFailed can arrive before the ack has been processed
+        self._rejectReservations(attempt)
 
-                provider = self.getProvider(provider_urn)
-                t_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes)
+        log.msg('Connection %s: Reserve attempt %i/%i: %i/%i sub reservation(s) acked (%i kept) in %.3f seconds' % \
+                (conn.connection_id, attempt['tried'], len(attempt['paths']), sum(successes), len(successes), len(keep), time.time() - attempt_start), system=LOG_SYSTEM)
 
-                d = provider.terminate(t_header, sc_id)
-                d.addCallbacks(
-                    lambda c : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_urn) , system=LOG_SYSTEM),
-                    lambda f : log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
-                )
-                defs.append(d)
-            dl = defer.DeferredList(defs)
-            yield dl
-            yield state.terminated(conn)
+        # construct provider nsa urns, so we can produce a good error message
+        defer.returnValue( (results, [ ci[1] for ci in conn_info ]) )
+
+
+    @defer.inlineCallbacks
+    def _abandonPathAttempt(self, conn, attempt):
+        # give up the reservation, terminate the sub reservations made for it
+        self.path_attempts.pop(conn.id, None)
+        for correlation_id in attempt['failed']:
+            self.reservations.pop(correlation_id, None)
+        self._rejectReservations(attempt)
+        yield self._abandonReservations(conn, attempt['header'], attempt['reserved'] + attempt['rejected'], detach=False)
+
+
+    @defer.inlineCallbacks
+    def _abandonReservations(self, conn, header, reservations, detach=True):
+        # terminate sub reservations that will not be part of the connection, reserveConfirmed/Failed and
+        # terminateConfirmed for them will be ignored
+        # if detach is true, they are also removed from the connection, in case they have already been confirmed
+
+        defs = []
+        for (order_id, link, sc_id, provider_urn, correlation_id) in reservations:
+
+            if self.reservations.pop(correlation_id, None) is not None:
+                self.abandoned_reservations.add(correlation_id)
+            self.abandoned_sub_connections.add( (provider_urn, sc_id) )
 
-            # construct provider nsa urns, so we can produce a good error message
-            provider_urns = [ ci[1] for ci in conn_info ]
-            err = _createAggregateException(connection_id, 'reservations', results, provider_urns, error.ConnectionCreateError)
-            raise err
+            provider = self.getProvider(provider_urn)
+            t_header = nsa.NSIHeader(self.nsa_.urn(), provider_urn, security_attributes=header.security_attributes)
+
+            def terminateFailed(f, sc_id=sc_id, provider_urn=provider_urn):
+                self.abandoned_sub_connections.discard( (provider_urn, sc_id) ) # no terminateConfirmed will come
+                log.msg('Error terminating connection after partial-reservation failure: %s' % str(f), system=LOG_SYSTEM)
+
+            d = provider.terminate(t_header, sc_id)
+            d.addCallbacks(
+                lambda c, sc_id=sc_id, provider_urn=provider_urn : log.msg('Succesfully terminated sub connection %s at %s after partial reservation failure.' % (sc_id, provider_urn) , system=LOG_SYSTEM),
+                terminateFailed
+            )
+            defs.append(d)
+        yield defer.DeferredList(defs)
+
+        if not detach:
+            return
+
+        for (order_id, link, sc_id, provider_urn, correlation_id) in reservations:
+            sub_conns = yield database.SubConnection.findBy(service_connection_id=conn.id, provider_nsa=provider_urn, connection_id=sc_id)
+            for sc in sub_conns:
+                self.db_sub_connections.pop(sc_id, None)
+                yield sc.delete()
 
 
     @defer.inlineCallbacks
     def reserveCommit(self, header, connection_id, request_info=None):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('ReserveCommit request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg('ReserveCommit request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         conn = yield self.getConnection(connection_id)
 
@@ -471,7 +629,7 @@ class Aggregator:
     def reserveAbort(self, header, connection_id, request_info=None):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('ReserveAbort request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg('ReserveAbort request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         conn = yield self.getConnection(connection_id)
 
@@ -512,7 +670,7 @@ class Aggregator:
     def provision(self, header, connection_id, request_info=None):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('Provision request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg('Provision request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         conn = yield self.getConnection(connection_id)
 
@@ -556,7 +714,7 @@ class Aggregator:
     def release(self, header, connection_id, request_info=None):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('Release request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg('Release request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         conn = yield self.getConnection(connection_id)
 
@@ -600,13 +758,14 @@ class Aggregator:
     def terminate(self, header, connection_id, request_info=None):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('Terminate request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg('Terminate request. NSA: %s. Connection ID: %s' % (header.requester_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         conn = yield self.getConnection(connection_id)
 
         if conn.lifecycle_state == state.TERMINATED:
             defer.returnValue(connection_id) # all good
 
+        self.path_attempts.pop(conn.id, None) # no further paths should be tried
         yield state.terminating(conn)
 
         defs = []
@@ -636,45 +795,13 @@ class Aggregator:
 
 
     @defer.inlineCallbacks
-    def querySummary(self, header, connection_ids=None, global_reservation_ids=None, request_info=None):
+    def querySummary(self, header, connection_ids=None, global_reservation_ids=None, request_info=None, **filters):
 
-        log.msg('QuerySummary request from %s. CID: %s. GID: %s' % (header.requester_nsa, connection_ids, global_reservation_ids), system=LOG_SYSTEM)
+        log.msg('QuerySummary request from %s. CID: %s. GID: %s' % (header.requester_nsa, connection_ids, global_reservation_ids), system=LOG_SYSTEM, header=header)
 
         try:
-            if connection_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND connection_id IN ?', header.requester_nsa, tuple(connection_ids) ] )
-            elif global_reservation_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND global_reservation_ids IN ?', header.requester_nsa, tuple(global_reservation_ids) ] )
-            else:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ?', header.requester_nsa ] )
-
-            # largely copied from genericbackend, merge later
             reservations = []
-            for c in conns:
-
-                source_stp  = nsa.STP(c.source_network, c.source_port, c.source_label)
-                dest_stp    = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
-                schedule    = nsa.Schedule(c.start_time, c.end_time)
-                sd          = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None)
-                criteria    = nsa.QueryCriteria(c.revision, schedule, sd)
-
-                sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
-                if len(sub_conns) == 0: # apparently this can happen
-                    data_plane_status = (False, 0, False)
-                else:
-                    aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-                    aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-                    aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-                    data_plane_status = (aggr_active, aggr_version, aggr_consistent)
-
-                states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
-                notification_id = self.getNotificationId()
-                result_id = 0
-
-                ci = nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
-                                        self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
-                reservations.append(ci)
-
+            yield self.querySummaryPages(header, connection_ids, global_reservation_ids, reservations.extend, request_info, **filters)
             self.parent_requester.querySummaryConfirmed(header, reservations)
 
         except Exception as e:
@@ -682,10 +809,87 @@ class Aggregator:
             raise e
 
 
+    @defer.inlineCallbacks
+    def querySummaryPages(self, header, connection_ids, global_reservation_ids, page_callback, request_info=None,
+                          lifecycle_states=None, start_time=None, end_time=None, modified_since=None, page_size=QUERY_PAGE_SIZE):
+        """
+        Query connections one page at a time, calling page_callback with a list
+        of ConnectionInfo for each page. If page_callback returns a deferred,
+        the next page is not fetched until it fires, so the number of
+        connections in memory is bounded by the page size.
+
+        The connections can be filtered by lifecycle states, by having a
+        schedule overlapping the time window from start_time to end_time,
+        and by having been modified since a given time (all in UTC).
+        Returns a deferred, which fires with the number of connections found.
+        """
+        assert page_size > 1, 'Query page size must be larger than one' # twistar returns a single object for limit=1
+
+        clauses = [ 'requester_nsa = ?' ]
+        args    = [ header.requester_nsa ]
+
+        if connection_ids:
+            clauses.append('connection_id IN ?')
+            args.append( tuple(connection_ids) )
+        elif global_reservation_ids:
+            clauses.append('global_reservation_id IN ?')
+            args.append( tuple(global_reservation_ids) )
+
+        if lifecycle_states:
+            clauses.append('lifecycle_state IN ?')
+            args.append( tuple(lifecycle_states) )
+        if start_time is not None:
+            clauses.append('(end_time IS NULL OR end_time > ?)')
+            args.append(start_time)
+        if end_time is not None:
+            clauses.append('(start_time IS NULL OR start_time < ?)')
+            args.append(end_time)
+        if modified_since is not None:
+            clauses.append('last_modified >= ?')
+            args.append(modified_since)
+
+        # page by id instead of offset, so every page is a cheap index lookup
+        where = ' AND '.join(clauses) + ' AND id > ?'
+        last_id = 0
+        count = 0
+
+        while True:
+            conns = yield database.ServiceConnection.find(where=[where] + args + [last_id], orderby='id', limit=page_size)
+            if not conns:
+                break
+
+            data_plane_statuses = yield database.getDataPlaneStatus( [ c.id for c in conns ] )
+            reservations = [ self._summaryInfo(c, data_plane_statuses[c.id]) for c in conns ]
+            count += len(reservations)
+            yield page_callback(reservations)
+
+            if len(conns) < page_size:
+                break
+            last_id = conns[-1].id
+
+        defer.returnValue(count)
+
+
+    def _summaryInfo(self, c, data_plane_status):
+        # largely copied from genericbackend, merge later
+        source_stp  = nsa.STP(c.source_network, c.source_port, c.source_label)
+        dest_stp    = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
+        schedule    = nsa.Schedule(c.start_time, c.end_time)
+        sd          = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria    = nsa.QueryCriteria(c.revision, schedule, sd)
+
+        states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
+        notification_id = self.getNotificationId()
+        result_id = 0
+
+        return nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
+                                  self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
+
+
     @defer.inlineCallbacks
     def queryRecursive(self, header, connection_ids, global_reservation_ids, request_info=None):
 
-        log.msg('QueryRecursive request from %s. CID: %s. GID: %s' % (header.requester_nsa, connection_ids, global_reservation_ids), system=LOG_SYSTEM)
+        log.msg('QueryRecursive request from %s. CID: %s. GID: %s' % (header.requester_nsa, connection_ids, global_reservation_ids), system=LOG_SYSTEM, header=header)
 
         # the semantics for global reservation id and query recursive is extremely wonky, so we don't do it
         if global_reservation_ids:
@@ -751,16 +955,9 @@ class Aggregator:
 
             criteria = nsa.QueryCriteria(c.revision, schedule, sd, children)
 
-            sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
-            if len(sub_conns) == 0: # apparently this can happen
-                data_plane_status = (False, 0, False)
-            else:
-                aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-                aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-                aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-                data_plane_status = (aggr_active, aggr_version, aggr_consistent)
+            data_plane_statuses = yield database.getDataPlaneStatus( [ c.id ] )
 
-            states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
+            states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_statuses[c.id])
             notification_id = self.getNotificationId()
             result_id = notification_id
 
@@ -811,7 +1008,7 @@ class Aggregator:
 
     def queryNotification(self, header, connection_id, start_notification, end_notification):
 
-        log.msg('QueryNotification request from %s. CID: %s. %s-%s' % (header.requester_nsa, connection_id, start_notification, end_notification), system=LOG_SYSTEM)
+        log.msg('QueryNotification request from %s. CID: %s. %s-%s' % (header.requester_nsa, connection_id, start_notification, end_notification), system=LOG_SYSTEM, header=header, connection_id=connection_id)
         raise NotImplementedError('queryNotification not yet implemented in aggregator')
 
     # --
@@ -822,7 +1019,12 @@ class Aggregator:
     def reserveConfirmed(self, header, connection_id, global_reservation_id, description, criteria):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('reserveConfirm from %s. Connection ID: %s' % (header.provider_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg('reserveConfirm from %s. Connection ID: %s' % (header.provider_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
+
+        if header.correlation_id in self.abandoned_reservations:
+            self.abandoned_reservations.remove(header.correlation_id)
+            log.msg('Ignoring reserveConfirmed for abandoned sub reservation %s (alternate path used)' % connection_id, system=LOG_SYSTEM)
+            return
 
         if not header.correlation_id in self.reservations:
             msg = 'Unrecognized correlation id %s in reserveConfirmed. Connection ID %s. NSA %s' % (header.correlation_id, connection_id, header.provider_nsa)
@@ -876,22 +1078,31 @@ class Aggregator:
         conn = yield self.getConnectionByKey(sc.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
 
+        transition = state.Transition(conn)
         if sc.order_id == 0:
-            conn.source_label = sd.source_stp.label
+            transition.set(source_label=sd.source_stp.label)
         if sc.order_id == len(sub_conns)-1:
-            conn.dest_label = sd.dest_stp.label
-
-        yield conn.save()
+            transition.set(dest_label=sd.dest_stp.label)
 
         outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == resv_info['service_connection_id'] ]
         if len(outstanding_calls) > 0:
+            yield transition.commit()
             log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, len(outstanding_calls)), system=LOG_SYSTEM)
             return
 
+        if conn.reservation_state != state.RESERVE_CHECKING or conn.lifecycle_state != state.CREATED:
+            # the reservation has failed (or been given up) while the sub reservation was being confirmed
+            yield transition.commit()
+            log.msg('Connection %s: Reservation no longer in progress (%s, %s), not emitting reserveConfirmed' % \
+                    (conn.connection_id, conn.reservation_state, conn.lifecycle_state), system=LOG_SYSTEM)
+            return
+
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
         if all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ) and conn.reservation_state != state.RESERVE_HELD:
             log.msg('Connection %s: All sub connections reserve held, can emit reserveConfirmed' % (conn.connection_id), system=LOG_SYSTEM)
-            yield state.reserveHeld(conn)
+            self.path_attempts.pop(conn.id, None)
+            # label update and state change in one go
+            yield transition.reserve(state.RESERVE_HELD).commit()
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             source_stp = nsa.STP(conn.source_network, conn.source_port, conn.source_label)
             dest_stp   = nsa.STP(conn.dest_network,   conn.dest_port,   conn.dest_label)
@@ -901,6 +1112,7 @@ class Aggregator:
             self.parent_requester.reserveConfirmed(header, conn.connection_id, conn.global_reservation_id, conn.description, conn_criteria)
 
         else:
+            yield transition.commit()
             log.msg('Connection %s: Still missing reserveConfirmed messages before emitting to parent' % (conn.connection_id), system=LOG_SYSTEM)
 
 
@@ -908,7 +1120,12 @@ class Aggregator:
     def reserveFailed(self, header, connection_id, connection_states, err):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('reserveFailed from %s. Connection ID: %s. Error: %s' % (header.provider_nsa, connection_id, err), system=LOG_SYSTEM)
+        log.msg('reserveFailed from %s. Connection ID: %s. Error: %s' % (header.provider_nsa, connection_id, err), system=LOG_SYSTEM, header=header, connection_id=connection_id)
+
+        if header.correlation_id in self.abandoned_reservations:
+            self.abandoned_reservations.remove(header.correlation_id)
+            log.msg('Ignoring reserveFailed for abandoned sub reservation %s (alternate path used)' % connection_id, system=LOG_SYSTEM)
+            return
 
         if not header.correlation_id in self.reservations:
             msg = 'Unrecognized correlation id %s in reserveFailed. Connection ID %s. NSA %s' % (header.correlation_id, connection_id, header.provider_nsa)
@@ -920,27 +1137,48 @@ class Aggregator:
             log.msg('Provider NSA in header %s for reserveFailed does not match saved identity %s' % (header.provider_nsa, org_provider_nsa), system=LOG_SYSTEM)
             raise error.SecurityError('Provider NSA for connection does not match saved identity')
 
-        resv_info = self.reservations.pop(header.correlation_id)
-
-        service_connection_key = resv_info['service_connection_id']
+        resv_info = self.reservations[header.correlation_id]
+        parent_err = err
+
+        conn = yield self.getConnectionByKey(resv_info['service_connection_id'])
+
+        attempt = self.path_attempts.get(conn.id)
+        if attempt is not None and (attempt['busy'] or self._morePaths(attempt)):
+            # the reservation is removed when the next path is tried, so the connection cannot be completed in between
+            attempt['failed'].append(header.correlation_id)
+            attempt['async_failed'].add(header.correlation_id)
+            if attempt['busy']:
+                log.msg('Connection %s: Sub reservation failed while a path is being tried, leaving it to the attempt' % conn.connection_id, system=LOG_SYSTEM)
+                return
+
+            log.msg('Connection %s: Sub reservation failed, trying alternate path' % conn.connection_id, system=LOG_SYSTEM)
+            results, provider_urns = yield self._tryPaths(conn, attempt)
+            if results is None:
+                log.msg('Connection %s: Reserve on alternate path acked' % conn.connection_id, system=LOG_SYSTEM)
+                return
+
+            yield self._abandonPathAttempt(conn, attempt)
+            if not all( [ success for success, _ in results ] ):
+                parent_err = _createAggregateException(conn.connection_id, 'reservations', results, provider_urns, error.ConnectionCreateError)
+        else:
+            self.reservations.pop(header.correlation_id)
+            self.path_attempts.pop(conn.id, None)
 
-        conn = yield self.getConnectionByKey(service_connection_key)
         if conn.reservation_state != state.RESERVE_FAILED: # since we can fail multiple times
             yield state.reserveFailed(conn)
 
         header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
-        self.parent_requester.reserveFailed(header, conn.connection_id, connection_states, err)
+        self.parent_requester.reserveFailed(header, conn.connection_id, connection_states, parent_err)
 
 
     @defer.inlineCallbacks
     def reserveCommitConfirmed(self, header, connection_id):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('ReserveCommit Confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+        log.msg('ReserveCommit Confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
-        sub_connection.reservation_state = state.RESERVE_START
-        yield sub_connection.save()
+        yield state.Transition(sub_connection).set(reservation_state=state.RESERVE_START).commit()
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -957,11 +1195,10 @@ class Aggregator:
     def reserveAbortConfirmed(self, header, connection_id):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('ReserveAbort confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+        log.msg('ReserveAbort confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
-        sub_connection.reservation_state = state.RESERVE_START
-        yield sub_connection.save()
+        yield state.Transition(sub_connection).set(reservation_state=state.RESERVE_START).commit()
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -977,7 +1214,7 @@ class Aggregator:
     def provisionConfirmed(self, header, connection_id):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('Provision Confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+        log.msg('Provision Confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         yield state.provisioned(sub_connection)
@@ -996,7 +1233,7 @@ class Aggregator:
     def releaseConfirmed(self, header, connection_id):
 
         log.msg('', system=LOG_SYSTEM)
-        log.msg('Release confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM)
+        log.msg('Release confirmed for sub connection %s. NSA %s ' % (connection_id, header.provider_nsa), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         yield state.released(sub_connection)
@@ -1014,9 +1251,19 @@ class Aggregator:
     @defer.inlineCallbacks
     def terminateConfirmed(self, header, connection_id):
 
+        if (header.provider_nsa, connection_id) in self.abandoned_sub_connections:
+            # terminated during reservation, not part of the connection (anymore), so there is nothing to aggregate
+            self.abandoned_sub_connections.remove( (header.provider_nsa, connection_id) )
+            log.msg('Ignoring terminateConfirmed for abandoned sub connection %s' % connection_id, system=LOG_SYSTEM)
+            try:
+                sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
+                yield state.Transition(sub_connection).set(lifecycle_state=state.TERMINATED).commit()
+            except error.ConnectionNonExistentError:
+                pass # removed from the connection when an alternate path was tried
+            return
+
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
-        sub_connection.lifecycle_state = state.TERMINATED
-        yield sub_connection.save()
+        yield state.Transition(sub_connection).set(lifecycle_state=state.TERMINATED).commit()
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -1047,7 +1294,7 @@ class Aggregator:
     @defer.inlineCallbacks
     def reserveTimeout(self, header, connection_id, notification_id, timestamp, timeout_value, org_connection_id, org_nsa):
 
-        log.msg("reserveTimeout from %s:%s" % (header.provider_nsa, connection_id), system=LOG_SYSTEM)
+        log.msg("reserveTimeout from %s:%s" % (header.provider_nsa, connection_id), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         sub_conn = yield self.getSubConnection(header.provider_nsa, connection_id)
 
@@ -1071,15 +1318,11 @@ class Aggregator:
 
         active, version, consistent = dps
         log.msg("Data plane change for sub connection: %s Active: %s, version %i, consistent: %s" % \
-                 (connection_id, active, version, consistent), system=LOG_SYSTEM)
+                 (connection_id, active, version, consistent), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         sub_conn = yield self.getSubConnection(header.provider_nsa, connection_id)
 
-        sub_conn.data_plane_active      = active
-        sub_conn.data_plane_version     = version
-        sub_conn.data_plane_consistent  = consistent
-
-        yield sub_conn.save()
+        yield state.Transition(sub_conn).set(data_plane_active=active, data_plane_version=version, data_plane_consistent=consistent).commit()
 
         conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
         sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
@@ -1104,7 +1347,7 @@ class Aggregator:
     #@defer.inlineCallbacks
     def error(self, header, nsa_id, connection_id, service_type, error_id, text, variables, child_ex):
 
-        log.msg("errorEvent: Connection %s from %s: %s, %s" % (connection_id, nsa_id, text, str(variables)), system=LOG_SYSTEM)
+        log.msg("errorEvent: Connection %s from %s: %s, %s" % (connection_id, nsa_id, text, str(variables)), system=LOG_SYSTEM, header=header, connection_id=connection_id)
 
         if header.provider_nsa != nsa_id:
             log.msg("errorEvent: NSA Id for error is different from provider (provider: %s, nsa: %s, cannot handle error, due to protocol design issue." % \
@@ -19,13 +19,14 @@ no vlan $vlan_id
 end
 """
 
+import re
 import string
 import random
 
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'opennsa.brocade'
@@ -41,6 +42,9 @@ COMMAND_TAGGED      = 'tagged ethernet %(port)s'
 
 COMMAND_NO_VLAN     = 'no vlan %(vlan)i'
 
+PROMPT_PATTERN      = re.compile('#') # privileged / configuration mode
+ERROR_PATTERN       = re.compile(r'(Invalid input|Error)[^\r\n]*')
+
 
 def _portToInterfaceVLAN(nrm_port):
 
@@ -86,17 +90,13 @@ def _createTeardownCommands(source_nrm_port, dest_nrm_port):
 
 
 
-class SSHChannel(ssh.SSHChannel):
+class SSHChannel(ssh.CLIChannel):
 
     name = 'session'
 
-    def __init__(self, conn):
-        ssh.SSHChannel.__init__(self, conn=conn)
-
-        self.data = ''
-
-        self.wait_defer = None
-        self.wait_data  = None
+    prompt_pattern = PROMPT_PATTERN
+    error_pattern  = ERROR_PATTERN
+    log_system     = LOG_SYSTEM
 
 
     @defer.inlineCallbacks
@@ -104,90 +104,46 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
+            logging.debug('Requesting shell for sending commands', system=LOG_SYSTEM)
             yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
 
-            d = self.waitForData('>')
+            # not a block, so the password isn't logged
+            d = self.waitForPrompt()
             self.write(COMMAND_PRIVILEGE % enable_password + LT)
             yield d
-            log.msg('Entered privileged mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered privileged mode', system=LOG_SYSTEM)
 
-            d = self.waitForData('#')
-            self.write(COMMAND_CONFIGURE + LT)
-            yield d
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
-
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
-                d = self.waitForData('#')
-                self.write(cmd + LT)
-                yield d
-
-            # not quite sure how to handle failure here
-            log.msg('Commands send, sending end command.', debug=True, system=LOG_SYSTEM)
-            d = self.waitForData('#')
-            self.write(COMMAND_END + LT)
-            yield d
+            yield self.sendBlock( [ COMMAND_CONFIGURE ] + commands + [ COMMAND_END ] )
 
         except Exception, e:
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully send', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully send', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
 
-    def waitForData(self, data):
-        self.wait_data  = data
-        self.wait_defer = defer.Deferred()
-        return self.wait_defer
-
-
-    def dataReceived(self, data):
-        if len(data) == 0:
-            pass
-        else:
-            self.data += data
-            if self.wait_data and self.wait_data in self.data:
-                d = self.wait_defer
-                self.data       = ''
-                self.wait_data  = None
-                self.wait_defer = None
-                d.callback(self)
-
-
-
 
 class BrocadeCommandSender:
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, enable_password):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, enable_password,
+                 max_channels=ssh.SINGLE_CHANNEL):
 
-        self.ssh_connection_creator = \
+        # It is currently unknown if the Brocade SSH implementation
+        # supports multiple ssh channels, so the default is one at a time
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
         self.enable_password = enable_password
 
 
-    @defer.inlineCallbacks
     def sendCommands(self, commands):
 
-        # Open a connection for each request
-        # This is done due to the code being based on the Force10 backend
-        # It is currently unknown if the Brocade SSH implementation
-        # supports multiple ssh channels.
-
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
-
-        try:
-            channel = SSHChannel(conn=ssh_connection)
-            ssh_connection.openChannel(channel)
-
-            yield channel.channel_open
-            yield channel.sendCommands(commands, self.enable_password)
+        def gotChannel(channel):
+            return channel.sendCommands(commands, self.enable_password)
 
-        finally:
-            ssh_connection.transport.loseConnection()
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
 
 
@@ -204,8 +160,10 @@ class BrocadeConnectionManager:
         ssh_public_key   = cfg[config.BROCADE_SSH_PUBLIC_KEY]
         ssh_private_key  = cfg[config.BROCADE_SSH_PRIVATE_KEY]
         enable_password  = cfg[config.BROCADE_ENABLE_PASSWORD]
+        max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.SINGLE_CHANNEL))
 
-        self.command_sender = BrocadeCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, enable_password)
+        self.command_sender = BrocadeCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, enable_password,
+                                                   max_channels)
 
 
     def getResource(self, port, label):
@@ -0,0 +1,82 @@
+"""
+Batching of device changes.
+
+Backends which can apply several changes in one transaction (e.g., one commit
+on a router) queue them in a Batcher. Changes queued within the batch window
+are handed to the backend as one batch, and only one batch is sent at a time.
+Each queued change gets a deferred, which the backend must fire when the
+change has been applied (or has failed).
+"""
+
+from twisted.python import failure
+from twisted.internet import reactor, defer
+
+
+
+class Batcher(object):
+
+    def __init__(self, send_batch, window, max_size=None, key=None):
+        # send_batch is called with a list of (change, deferred) and returns a deferred firing when the batch is done
+        # changes with the same key are never put in the same batch (key=None puts no restriction on changes)
+        self.send_batch = send_batch
+        self.window = window
+        self.max_size = max_size
+        self.key = key
+
+        self.clock = reactor # replaced when testing
+        self.pending = [] # (change, deferred), waiting for the next batch
+        self.batch_call = None
+        self.batch_lock = defer.DeferredLock() # one batch at a time
+
+
+    def queue(self, change):
+        # returns a deferred, which fires when the change has been sent
+        d = defer.Deferred()
+        self.pending.append( (change, d) )
+        if self.batch_call is None:
+            self.batch_call = self.clock.callLater(self.window, self._sendPending)
+        return d
+
+
+    def _takeBatch(self):
+        batch = []
+        keys = set()
+        while self.pending and (self.max_size is None or len(batch) < self.max_size):
+            change, d = self.pending[0]
+            if self.key is not None:
+                if self.key(change) in keys:
+                    break
+                keys.add( self.key(change) )
+            batch.append( self.pending.pop(0) )
+        return batch
+
+
+    @defer.inlineCallbacks
+    def _sendPending(self):
+
+        self.batch_call = None
+
+        yield self.batch_lock.acquire()
+        try:
+            # take the batch after getting the lock, so changes queued while waiting are included
+            batch = self._takeBatch()
+            if self.pending and self.batch_call is None:
+                self.batch_call = self.clock.callLater(0, self._sendPending)
+            if batch:
+                yield self.send_batch(batch)
+        finally:
+            self.batch_lock.release()
+
+
+
+@defer.inlineCallbacks
+def sendIndividually(batch, send_change):
+    # send the changes of a batch one at a time, and fire their deferreds with the outcome of each
+    for change, d in batch:
+        try:
+            result = yield send_change(change)
+        except Exception:
+            d.errback( failure.Failure() )
+        else:
+            d.callback(result)
+
@@ -9,23 +9,47 @@ The module assumes that any expired reservations are removed. Otherwise the
 overlap detection will not work properly.
 
 None is allowed for start and end time. In that case the semantics is now for
-start time and forever for end time.
+start time and forever for end time. A stored reservation without start time is
+kept as starting at the beginning of time, which is the same for the overlap
+checks, as checked time spans cannot start in the past. A checked time span
+without start time starts at the time of the check.
+
+Reservations are indexed per resource in a list of intervals sorted by start
+time. As long as the intervals of a resource do not overlap (which is the case
+when every reservation is checked before it is added), an overlap check is a
+single binary search. If overlapping intervals are added anyway (the calendar
+does not forbid this), the resource falls back to scanning the intervals which
+start before the end of the checked interval.
 
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2016)
 """
 
 import types
+import bisect
 import datetime
 
 from opennsa import error
 
 
+# Coalesced values for None start / end time of stored reservations.
+BEGINNING   = datetime.datetime.min
+FOREVER     = datetime.datetime.max
 
-class ReservationCalendar:
+
+
+class ReservationCalendar(object):
 
     def __init__(self):
-        self.reservations = [] # [ ( resource, start_time, end_time ) ]
+        self.resources   = {} # resource -> [ ( start_time, end_time ) ], sorted, None values coalesced
+        self.overlapping = set() # resources which have (or have had) overlapping intervals
+
+
+    @property
+    def reservations(self):
+        # flat list of all reservations, [ ( resource, start_time, end_time ) ], not for use in the hot path
+        uncoalesce = lambda ts : None if ts in (BEGINNING, FOREVER) else ts
+        return [ (resource, uncoalesce(start_time), uncoalesce(end_time)) for resource, intervals in self.resources.items() for start_time, end_time in intervals ]
 
 
     def _checkArgs(self, resource, start_time, end_time):
@@ -40,25 +64,77 @@ class ReservationCalendar:
             assert end_time.tzinfo   is None, 'End time must NOT have time zone.'
 
 
+    def _interval(self, start_time, end_time):
+        return ( start_time or BEGINNING, end_time or FOREVER )
+
+
     def addReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
-        self.reservations.append(reservation)
+        interval = self._interval(start_time, end_time)
+        intervals = self.resources.setdefault(resource, [])
+
+        idx = bisect.bisect_right(intervals, interval)
+        if resource not in self.overlapping:
+            if idx > 0 and intervals[idx-1][1] >= interval[0]:
+                self.overlapping.add(resource)
+            elif idx < len(intervals) and intervals[idx][0] <= interval[1]:
+                self.overlapping.add(resource)
+
+        intervals.insert(idx, interval)
 
 
     def removeReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
-        try:
-            self.reservations.remove(reservation)
-        except ValueError:
+        interval = self._interval(start_time, end_time)
+        intervals = self.resources.get(resource, [])
+
+        idx = bisect.bisect_left(intervals, interval)
+        if idx == len(intervals) or intervals[idx] != interval:
             raise ValueError('Reservation (%s, %s, %s) does not exist. Cannot remove' % (resource, start_time, end_time))
 
+        del intervals[idx]
+        if not intervals:
+            del self.resources[resource]
+            self.overlapping.discard(resource)
+
 
     def checkReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
+        self._checkTimes(start_time, end_time)
+
+        if self._resourceOverlap(resource, start_time, end_time):
+            raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
+
+        # all good
+
+
+    def findAvailable(self, candidates, start_time, end_time):
+        """
+        Find the first candidate for which all resources are available in the time span.
+
+        Candidates is an iterable of ( value, [ resource ] ) pairs, and is only
+        consumed until an available candidate is found, so it can be a generator
+        over a (large) label range. The time span is only validated once.
+
+        Returns the ( value, [ resource ] ) pair of the first available candidate or
+        None if no candidates are available.
+        """
+        self._checkTimes(start_time, end_time)
+
+        for value, resources in candidates:
+            for resource in resources:
+                self._checkArgs(resource, start_time, end_time)
+                if self._resourceOverlap(resource, start_time, end_time):
+                    break
+            else:
+                return value, resources
+
+        return None
+
+
+    def _checkTimes(self, start_time, end_time):
 
         # check start time is before end time
         if start_time is not None and end_time is not None and start_time > end_time:
@@ -77,36 +153,32 @@ class ReservationCalendar:
             if start_time > datetime.datetime(2025, 1, 1):
                 raise error.PayloadError('Invalid request: Start time after year 2025')
 
-        for (c_resource, c_start_time, c_end_time) in self.reservations:
-            if resource == c_resource:
-                if self._resourceOverlap(c_start_time, c_end_time, start_time, end_time):
-                    raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
-
-        # all good
+        assert (start_time or datetime.datetime.utcnow()) < (end_time or FOREVER), 'Cannot detect overlap for backwards reservation'
 
 
-    def _resourceOverlap(self, res1_start_time, res1_end_time, res2_start_time, res2_end_time):
+    def _resourceOverlap(self, resource, start_time, end_time):
         # resource temporal availability
 
-        # hack on
-        # instead of doing a lot of complicated branching for None checking, we just coalesce the values into something easier
+        intervals = self.resources.get(resource)
+        if not intervals:
+            return False
 
-        now = datetime.datetime.utcnow()
-        forever = datetime.datetime(9999, 1, 1)
+        # the checked interval starts now if no start time is given, expired reservations do not overlap it
+        r_start = start_time or datetime.datetime.utcnow()
+        r_end   = end_time   or FOREVER
 
-        r1s = res1_start_time or now
-        r2s = res2_start_time or now
-        r1e = res1_end_time or forever
-        r2e = res2_end_time or forever
+        # intervals starting at or before the end of the checked interval
+        idx = bisect.bisect_right(intervals, (r_end, FOREVER))
+        if idx == 0:
+            return False # everything starts after the checked interval ends
 
-        assert r1s < r1e, 'Cannot detect overlap for backwards reservation (1)'
-        assert r2s < r2e, 'Cannot detect overlap for backwards reservation (2)'
+        if resource not in self.overlapping:
+            # the intervals are disjoint, so the one with the latest start also has the latest end
+            return intervals[idx-1][1] >= r_start
 
-        if r2e < r1s:
-            return False # res2 ends before res1 starts so it is ok
-        if r2s > r1e:
-            return False # res2 starts after res1 ends so it is ok
+        for c_start, c_end in intervals[:idx]:
+            if c_end >= r_start:
+                return True
 
-        # resources overlap in time
-        return True
+        return False
 
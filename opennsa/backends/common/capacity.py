@@ -0,0 +1,114 @@
+"""
+Backend capacity calendar.
+
+Keeps track of the bandwidth committed on ports over time, so a backend can
+reject reservations which would oversubscribe a port, instead of treating a
+port/label as an exclusive resource.
+
+The committed bandwidth for each port is kept as a step function: A sorted
+list of times at which the committed bandwidth changes, and the committed
+bandwidth from each of these times until the next one. Finding the peak
+committed bandwidth in a time span is a binary search plus a scan over the
+steps in the time span.
+
+Time spans are half-open, [start_time, end_time), so back-to-back
+reservations does not add up. As in the reservation calendar, None is allowed
+for start and end time, meaning now and forever respectively.
+"""
+
+import bisect
+
+from opennsa.backends.common.calendar import BEGINNING, FOREVER
+
+
+
+class CapacityCalendar(object):
+
+    def __init__(self):
+        self.ports = {} # port -> ( [ time ], [ bandwidth ] ), bandwidth[i] is committed from time[i] until time[i+1]
+
+
+    def _checkArgs(self, port, start_time, end_time, bandwidth):
+        assert type(port) is str, 'Port must be a string'
+        assert type(bandwidth) in (int, long), 'Bandwidth must be an integer, not %s' % str(type(bandwidth))
+        assert bandwidth >= 0, 'Bandwidth cannot be negative'
+
+        if start_time is not None and end_time is not None:
+            assert start_time < end_time, 'Cannot use backwards time span for capacity'
+
+
+    def _breakpoint(self, times, levels, ts):
+        # ensure there is a step starting at ts, returns index of it
+        idx = bisect.bisect_left(times, ts)
+        if idx == len(times) or times[idx] != ts:
+            times.insert(idx, ts)
+            levels.insert(idx, levels[idx-1] if idx > 0 else 0)
+        return idx
+
+
+    def _change(self, port, start_time, end_time, bandwidth):
+
+        times, levels = self.ports.setdefault(port, ( [], [] ))
+
+        start = self._breakpoint(times, levels, start_time or BEGINNING)
+        end   = self._breakpoint(times, levels, end_time   or FOREVER)
+
+        for idx in range(start, end):
+            levels[idx] += bandwidth
+
+        # merge steps with equal bandwidth, so the step function does not grow with history
+        for idx in (end, start):
+            if idx < len(times) and levels[idx] == (levels[idx-1] if idx > 0 else 0):
+                del times[idx]
+                del levels[idx]
+
+        if not times:
+            del self.ports[port]
+
+
+    def addReservation(self, port, start_time, end_time, bandwidth):
+        self._checkArgs(port, start_time, end_time, bandwidth)
+        self._change(port, start_time, end_time, bandwidth)
+
+
+    def removeReservation(self, port, start_time, end_time, bandwidth):
+        self._checkArgs(port, start_time, end_time, bandwidth)
+
+        if self.peakBandwidth(port, start_time, end_time, minimum=True) < bandwidth:
+            raise ValueError('Reservation of %i for port %s (%s, %s) does not exist. Cannot remove' % (bandwidth, port, start_time, end_time))
+
+        self._change(port, start_time, end_time, -bandwidth)
+
+
+    def peakBandwidth(self, port, start_time, end_time, minimum=False):
+        """
+        Return the peak committed bandwidth for the port in the time span.
+        With minimum=True the lowest committed bandwidth in the time span is returned instead.
+        """
+        if not port in self.ports:
+            return 0
+
+        times, levels = self.ports[port]
+
+        start_time = start_time or BEGINNING
+        end_time   = end_time   or FOREVER
+
+        # the step in effect at the start time, and all steps starting before the end time
+        start = bisect.bisect_right(times, start_time) - 1
+        end   = bisect.bisect_left(times, end_time)
+
+        values = levels[max(start, 0):end]
+        if start < 0:
+            values.append(0) # nothing committed before the first step
+
+        return min(values) if minimum else max(values)
+
+
+    def checkCapacity(self, port, start_time, end_time, bandwidth, port_capacity):
+        """
+        Check if the bandwidth can be added on the port in the time span without
+        exceeding the capacity of the port. Returns True if so, False otherwise.
+        """
+        self._checkArgs(port, start_time, end_time, bandwidth)
+        return self.peakBandwidth(port, start_time, end_time) + bandwidth <= port_capacity
+
@@ -13,19 +13,21 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
+import time
 import datetime
 
 from zope.interface import implements
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import reactor, defer
 from twisted.application import service
 
 from opennsa.interface import INSIProvider
 
-from opennsa import constants as cnt, error, state, nsa, authz
-from opennsa.backends.common import scheduler, calendar
+from opennsa import constants as cnt, error, state, nsa, authz, logging
+from opennsa.backends.common import scheduler, calendar, capacity
 
+from twistar.registry import Registry
 from twistar.dbobject import DBObject
 
 
@@ -44,6 +46,10 @@ class GenericBackend(service.Service):
     # Yeah, it should be much less, but some NRMs are that slow
     TPC_TIMEOUT = 120 # seconds
 
+    # Number of data plane activations/teardowns to run at the same time, when restoring the schedule at startup
+    RESTORE_CONCURRENCY = 10
+    RESTORE_PROGRESS_INTERVAL = 100
+
     def __init__(self, network, nrm_ports, connection_manager, parent_requester, log_system, minimum_duration=60):
 
         self.network            = network
@@ -52,11 +58,20 @@ class GenericBackend(service.Service):
         self.parent_requester   = parent_requester
         self.log_system         = log_system
         self.minimum_duration   = minimum_duration
+        self.restore_concurrency = self.RESTORE_CONCURRENCY
 
         self.notification_id = 0
 
+        # Write-through cache of live connections (see _cacheConnection), loaded in buildSchedule.
+        # All operations on a connection use the same object, and saves go directly to the database.
+        self.connections = {} # connection_id -> GenericBackendConnections
+        # For tests only: if set, every cache hit is compared with the database. This costs a query per
+        # request, and a commit in progress for the connection is reported as a mismatch.
+        self.verify_connection_cache = False
+
         self.scheduler = scheduler.CallScheduler()
         self.calendar  = calendar.ReservationCalendar()
+        self.capacity  = capacity.CapacityCalendar()
         # need to build the calendar as well
 
         # need to build schedule here
@@ -85,33 +100,41 @@ class GenericBackend(service.Service):
 
     @defer.inlineCallbacks
     def buildSchedule(self):
+        # Restoring is done in three steps: First connections are classified and future calls are scheduled
+        # (all in memory), then state changes are written to the database in bulk, and finally data plane
+        # changes (teardown / activation) are done with a limited concurrency.
+
+        restore_start = time.time()
 
         conns = yield GenericBackendConnections.find(where=['lifecycle_state <> ?', state.TERMINATED])
+        conns = [ self._cacheConnection(conn) for conn in conns ]
+        log.msg('Restoring schedule for %i connections' % len(conns), system=self.log_system)
+
+        expired     = [] # passed end time, must be ended and have their resources freed
+        timed_out   = [] # reservation held, but timeout has passed, must be rolled back
+        activate    = [] # passed start time and provisioned, but data plane is not active
+
+        now = datetime.datetime.utcnow()
+
         for conn in conns:
             # avoid race with newly created connections
             if self.scheduler.hasScheduledCall(conn.connection_id):
                 continue
 
-            now = datetime.datetime.utcnow()
-
             if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
                 continue # This connection has already lived it life to the fullest :-)
 
             if conn.reservation_state == state.RESERVE_START and not conn.allocated:
                 # This happens when a connection was reserved, but never committed and abort/timeout happened
-                log.msg('Connection %s: Was never comitted, not putting entry into calendar' % conn.connection_id, debug=True, system=self.log_system)
+                logging.debug('Connection %s: Was never comitted, not putting entry into calendar', conn.connection_id, system=self.log_system)
                 continue
 
             # add reservation, some of the following code will remove the reservation again
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-            self.calendar.addReservation(  src_resource, conn.start_time, conn.end_time)
-            self.calendar.addReservation(  dst_resource, conn.start_time, conn.end_time)
+            self._addReservation(conn)
 
             if conn.end_time is not None and conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
                 log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
-                yield self._doEndtime(conn)
-                continue
+                expired.append(conn)
 
             elif conn.reservation_state == state.RESERVE_HELD:
                 abort_time = conn.reserve_time + datetime.timedelta(seconds=self.TPC_TIMEOUT)
@@ -119,7 +142,7 @@ class GenericBackend(service.Service):
                 if timeout_time < now:
                     # have passed the time when timeout should occur
                     log.msg('Connection %s: Reservation Held, but timeout has passed, doing rollback' % conn.connection_id, system=self.log_system)
-                    yield self._doReserveRollback(conn) # will remove reservation
+                    timed_out.append(conn)
                 else:
                     td = timeout_time - now
                     log.msg('Connection %s: Reservation Held, scheduling timeout in %i seconds' % (conn.connection_id, td.total_seconds()), system=self.log_system)
@@ -137,7 +160,7 @@ class GenericBackend(service.Service):
                             log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
                     else:
                         log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
-                        yield self._doActivate(conn)
+                        activate.append(conn)
                 elif conn.provision_state == state.RELEASED:
                     if conn.end_time is None:
                         log.msg('Connection %s: Currently released, no end scheduled' % conn.connection_id, system=self.log_system)
@@ -153,30 +176,126 @@ class GenericBackend(service.Service):
                 if conn.provision_state == state.PROVISIONED and conn.data_plane_active == False:
                     self.scheduler.scheduleCall(conn.connection_id, conn.start_time, self._doActivate, conn)
                     td = conn.start_time - now
-                    log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+                    log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.start_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
                 elif conn.provision_state == state.RELEASED:
-                    self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
-                    td = conn.end_time - now
-                    log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+                    if conn.end_time is None:
+                        log.msg('Connection %s: Currently released, no end scheduled' % conn.connection_id, system=self.log_system)
+                    else:
+                        self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
+                        td = conn.end_time - now
+                        log.msg('Connection %s: End scheduled for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
                 else:
                     log.msg('Unhandled provision state %s for connection %s in scheduler building' % (conn.provision_state, conn.connection_id))
 
             else:
                 log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id, system=self.log_system)
 
-        log.msg('Scheduled calls restored', system=self.log_system)
+        log.msg('Restore: %i connections to end, %i reservations to roll back, %i connections to activate' % (len(expired), len(timed_out), len(activate)), system=self.log_system)
+
+        if timed_out:
+            # timeout time is never after end time, so these should only have their end scheduled
+            yield self._restoreRollback(timed_out)
+            for conn in timed_out:
+                if conn.end_time is not None:
+                    self.scheduler.scheduleCall(conn.connection_id, conn.end_time, self._doEndtime, conn)
+
+        if expired:
+            yield state.commitTransitions( [ state.Transition(conn).lifecycle(state.PASSED_ENDTIME) for conn in expired ] )
+            for conn in expired:
+                self.logStateUpdate(conn, 'PASSED END TIME')
+                self._uncacheConnection(conn)
+            yield self._restoreDataPlane('free resource', expired, self._doFreeResource)
+
+        if activate:
+            yield self._restoreDataPlane('activate', activate, self._doActivate)
+
+        log.msg('Scheduled calls restored (%i connections, %.2f seconds)' % (len(conns), time.time() - restore_start), system=self.log_system)
         self.restore_defer.callback(None)
 
 
+    def _restoreRollback(self, conns):
+        # bulk version of _doReserveRollback for buildSchedule
+
+        transitions = [ state.Transition(conn).reserve(state.RESERVE_ABORTING, state.RESERVE_START) for conn in conns ]
+        for conn in conns:
+            self._removeReservation(conn)
+
+        d = state.commitTransitions(transitions)
+
+        def logRollback(_):
+            for conn in conns:
+                self.logStateUpdate(conn, 'RESERVE ABORTING/START')
+                self._uncacheConnection(conn)
+        d.addCallback(logRollback)
+        return d
+
+
+    def _restoreDataPlane(self, action_name, conns, action):
+        # runs data plane actions for restore, with at most restore_concurrency running at the same time
+
+        semaphore = defer.DeferredSemaphore(self.restore_concurrency)
+        progress = [ 0 ]
+
+        def actionDone(result, conn):
+            progress[0] += 1
+            if isinstance(result, failure.Failure):
+                log.msg('Connection %s: Error during restore %s: %s' % (conn.connection_id, action_name, result.getErrorMessage()), system=self.log_system)
+            if progress[0] % self.RESTORE_PROGRESS_INTERVAL == 0 or progress[0] == len(conns):
+                log.msg('Restore %s: %i/%i done' % (action_name, progress[0], len(conns)), system=self.log_system)
+
+        defs = [ semaphore.run(action, conn).addBoth(actionDone, conn) for conn in conns ]
+        return defer.DeferredList(defs)
+
+
+
+    def _cacheConnection(self, conn):
+        # returns the cached object for the connection, if there is one, otherwise caches the connection if it
+        # is live. Connections which have ended, or were never committed, only change when they are terminated.
+        if conn.connection_id in self.connections:
+            return self.connections[conn.connection_id]
+        if conn.lifecycle_state == state.CREATED and (conn.allocated or conn.reservation_state != state.RESERVE_START):
+            self.connections[conn.connection_id] = conn
+        return conn
+
+
+    def _uncacheConnection(self, conn):
+        # called when the connection is no longer live
+        if not (conn.lifecycle_state == state.CREATED and conn.allocated):
+            self.connections.pop(conn.connection_id, None)
+
 
     @defer.inlineCallbacks
     def _getConnection(self, connection_id, requester_nsa):
         # add security check sometime
 
-        conns = yield GenericBackendConnections.findBy(connection_id=connection_id)
+        conn = self.connections.get(connection_id)
+        if conn is None:
+            # terminated connection, or request before the cache has been loaded
+            conns = yield GenericBackendConnections.findBy(connection_id=connection_id)
+            if len(conns) == 0:
+                raise error.ConnectionNonExistentError('No connection with id %s' % connection_id)
+            conn = self._cacheConnection(conns[0]) # we only get one, unique in db
+        elif self.verify_connection_cache:
+            yield self._verifyCachedConnection(conn)
+
+        defer.returnValue(conn)
+
+
+    @defer.inlineCallbacks
+    def _verifyCachedConnection(self, conn):
+
+        conns = yield GenericBackendConnections.findBy(connection_id=conn.connection_id)
         if len(conns) == 0:
-            raise error.ConnectionNonExistentError('No connection with id %s' % connection_id)
-        defer.returnValue( conns[0] ) # we only get one, unique in db
+            raise AssertionError('Connection %s: In cache, but not in database' % conn.connection_id)
+
+        db_conn = conns[0]
+        columns = Registry.SCHEMAS[GenericBackendConnections.tablename()]
+        # labels does not have value equality, so compare their string form
+        value = lambda c, column : str(getattr(c, column, None))
+        for column in columns:
+            if value(conn, column) != value(db_conn, column):
+                raise AssertionError('Connection %s: Cached value for %s differs from database (%s != %s)' % \
+                                     (conn.connection_id, column, getattr(conn, column, None), getattr(db_conn, column, None)))
 
 
     def _authorize(self, source_port, destination_port, header, request_info, start_time=None, end_time=None):
@@ -201,7 +320,37 @@ class GenericBackend(service.Service):
     def logStateUpdate(self, conn, state_msg):
         src_target = self.connection_manager.getTarget(conn.source_port, conn.source_label)
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label)
-        log.msg('Connection %s: %s -> %s %s' % (conn.connection_id, src_target, dst_target, state_msg), system=self.log_system)
+        log.msg('Connection %s: %s -> %s %s' % (conn.connection_id, src_target, dst_target, state_msg), system=self.log_system,
+                connection_id=conn.connection_id, requester_nsa=conn.requester_nsa, state=state_msg)
+
+
+    def _checkCapacity(self, source_port, dest_port, start_time, end_time, bandwidth):
+        # a hairpin connection uses the bandwidth twice on the same port
+        port_bandwidth = {}
+        for port in (source_port, dest_port):
+            port_bandwidth[port] = port_bandwidth.get(port, 0) + bandwidth
+
+        for port, port_bw in port_bandwidth.items():
+            if not self.capacity.checkCapacity(port, start_time, end_time, port_bw, self.nrm_ports[port].bandwidth):
+                raise error.BandwidthUnavailableError('Port %s cannot provide %i Mbps in specified time span (capacity %i Mbps)' % (port, port_bw, self.nrm_ports[port].bandwidth))
+
+
+    def _addReservation(self, conn):
+        src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
+        dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
+        self.calendar.addReservation(  src_resource, conn.start_time, conn.end_time)
+        self.calendar.addReservation(  dst_resource, conn.start_time, conn.end_time)
+        self.capacity.addReservation(  conn.source_port, conn.start_time, conn.end_time, conn.bandwidth)
+        self.capacity.addReservation(  conn.dest_port,   conn.start_time, conn.end_time, conn.bandwidth)
+
+
+    def _removeReservation(self, conn):
+        src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
+        dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
+        self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
+        self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+        self.capacity.removeReservation(conn.source_port, conn.start_time, conn.end_time, conn.bandwidth)
+        self.capacity.removeReservation(conn.dest_port,   conn.start_time, conn.end_time, conn.bandwidth)
 
 
     @defer.inlineCallbacks
@@ -280,32 +429,27 @@ class GenericBackend(service.Service):
         if not nsa.Label.canMatch(nrm_dest_port.label, dest_stp.label):
             raise error.TopologyError('Destination port %s cannot match label set %s' % (nrm_dest_port.name, dest_stp.label) )
 
-        labelEnum = lambda label : [None] if label is None else [ nsa.Label(label.type_, lv) for lv in label.enumerateValues() ]
+        # check that the ports can carry the bandwidth, before finding labels
+        self._checkCapacity(source_stp.port, dest_stp.port, start_time, end_time, sd.capacity)
+
+        # lazy, so the calendar only has to look at labels until it finds an available one
+        labelEnum = lambda label : iter([None]) if label is None else ( nsa.Label(label.type_, lv) for lv in label.enumerateValues() )
 
         # do the find the label value dance
         if self.connection_manager.canSwapLabel(labelType(source_stp)) and self.connection_manager.canSwapLabel(labelType(dest_stp)):
-            for lv in labelEnum(source_stp.label):
-                src_resource = self.connection_manager.getResource(source_stp.port, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    src_label = lv
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            src_candidates = ( (lv, [ self.connection_manager.getResource(source_stp.port, lv) ]) for lv in labelEnum(source_stp.label) )
+            src_match = self.calendar.findAvailable(src_candidates, start_time, end_time)
+            if src_match is None:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % source_stp)
 
-            for lv in labelEnum(dest_stp.label):
-                dst_resource = self.connection_manager.getResource(dest_stp.port, lv)
-                try:
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    dst_label = lv
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            dst_candidates = ( (lv, [ self.connection_manager.getResource(dest_stp.port, lv) ]) for lv in labelEnum(dest_stp.label) )
+            dst_match = self.calendar.findAvailable(dst_candidates, start_time, end_time)
+            if dst_match is None:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % dest_stp)
 
+            src_label, (src_resource,) = src_match
+            dst_label, (dst_resource,) = dst_match
+
             # Only add reservations, when src and dest stps are both available
             self.calendar.addReservation(  src_resource, start_time, end_time)
             self.calendar.addReservation(  dst_resource, start_time, end_time)
@@ -321,22 +465,21 @@ class GenericBackend(service.Service):
                 except nsa.EmptyLabelSet:
                     raise error.VLANInterchangeNotSupportedError('VLAN re-write not supported and no possible label intersection')
 
-            for lv in labelEnum(label_candidate):
-                src_resource = self.connection_manager.getResource(source_stp.port, lv)
-                dst_resource = self.connection_manager.getResource(dest_stp.port,   lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    self.calendar.addReservation(  src_resource, start_time, end_time)
-                    self.calendar.addReservation(  dst_resource, start_time, end_time)
-                    src_label = lv
-                    dst_label = lv
-                    break
-                except error.STPUnavailableError:
-                    continue
-            else:
+            link_candidates = ( (lv, [ self.connection_manager.getResource(source_stp.port, lv), self.connection_manager.getResource(dest_stp.port, lv) ])
+                                for lv in labelEnum(label_candidate) )
+            link_match = self.calendar.findAvailable(link_candidates, start_time, end_time)
+            if link_match is None:
                 raise error.STPUnavailableError('Link %s and %s not available in specified time span' % (source_stp, dest_stp))
 
+            lv, (src_resource, dst_resource) = link_match
+            self.calendar.addReservation(  src_resource, start_time, end_time)
+            self.calendar.addReservation(  dst_resource, start_time, end_time)
+            src_label = lv
+            dst_label = lv
+
+        self.capacity.addReservation(source_stp.port, start_time, end_time, sd.capacity)
+        self.capacity.addReservation(dest_stp.port,   start_time, end_time, sd.capacity)
+
         now =  datetime.datetime.utcnow()
 
         source_target = self.connection_manager.getTarget(source_stp.port, src_label)
@@ -355,6 +498,7 @@ class GenericBackend(service.Service):
                                          start_time=start_time, end_time=end_time,
                                          symmetrical=sd.symmetric, directionality=sd.directionality, bandwidth=sd.capacity, allocated=False)
         yield conn.save()
+        self.connections[conn.connection_id] = conn # live from the start, even though not yet held
         reactor.callWhenRunning(self._doReserve, conn, header.correlation_id)
         defer.returnValue(connection_id)
 
@@ -371,9 +515,7 @@ class GenericBackend(service.Service):
             raise error.ConnectionGoneError('Connection %s has been terminated')
 
         # the switch to reserve start and allocated must be in same transaction
-        # state.reserveMultiSwitch will save the state, including the allocated flag
-        conn.allocated = True
-        yield state.reserveMultiSwitch(conn, state.RESERVE_COMMITTING, state.RESERVE_START)
+        yield state.Transition(conn).reserve(state.RESERVE_COMMITTING, state.RESERVE_START).set(allocated=True).commit()
 
         self.logStateUpdate(conn, 'COMMIT/RESERVED')
 
@@ -514,6 +656,7 @@ class GenericBackend(service.Service):
 
         yield state.terminated(conn)
         self.logStateUpdate(conn, 'TERMINATED')
+        self._uncacheConnection(conn)
 
 
 
@@ -571,7 +714,7 @@ class GenericBackend(service.Service):
     def _doReserve(self, conn, correlation_id):
 
         # we have already checked resource availability, so can progress directly through checking
-        yield state.reserveMultiSwitch(conn, state.RESERVE_CHECKING, state.RESERVE_HELD)
+        yield state.Transition(conn).reserve(state.RESERVE_CHECKING, state.RESERVE_HELD).commit()
         self.logStateUpdate(conn, 'RESERVE CHECKING/HELD')
 
         # schedule 2PC timeout
@@ -619,19 +762,14 @@ class GenericBackend(service.Service):
     def _doReserveRollback(self, conn):
 
         try:
-            yield state.reserveAbort(conn)
+            yield state.Transition(conn).reserve(state.RESERVE_ABORTING, state.RESERVE_START).commit()
             self.logStateUpdate(conn, 'RESERVE ABORTING')
+            self._uncacheConnection(conn)
 
             self.scheduler.cancelCall(conn.connection_id) # we only have this for non-timeout calls, but just cancel
 
             # release the resources
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-
-            self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-            self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
-
-            yield state.reserved(conn) # we only log this, when we haven't passed end time, as it looks wonky with start+end together
+            self._removeReservation(conn)
 
             now = datetime.datetime.utcnow()
             if conn.end_time is not None and now > conn.end_time:
@@ -661,8 +799,7 @@ class GenericBackend(service.Service):
             #log.err(e) # note: this causes error in tests
             log.msg('Connection %s: Error activating data plane: %s' % (conn.connection_id, str(e)), system=self.log_system)
             # should include stack trace
-            conn.data_plane_active = False
-            yield conn.save()
+            yield state.Transition(conn).set(data_plane_active=False).commit()
 
             header = nsa.NSIHeader(conn.requester_nsa, conn.requester_nsa) # The NSA is both requester and provider in the backend, but this might be problematic without aggregator
             now = datetime.datetime.utcnow()
@@ -672,8 +809,7 @@ class GenericBackend(service.Service):
             defer.returnValue(None)
 
         try:
-            conn.data_plane_active = True
-            yield conn.save()
+            yield state.Transition(conn).set(data_plane_active=True).commit()
             log.msg('Connection %s: Data plane activated' % (conn.connection_id), system=self.log_system)
 
             # we might have passed end time during activation...
@@ -710,8 +846,8 @@ class GenericBackend(service.Service):
             # We need to mark failure in state machine here somehow....
             log.msg('Connection %s: Error deactivating data plane: %s' % (conn.connection_id, str(e)), system=self.log_system)
             # should include stack trace
-            conn.data_plane_active = False # technically we don't know, but for NSI that means not active
-            yield conn.save()
+            # technically we don't know, but for NSI that means not active
+            yield state.Transition(conn).set(data_plane_active=False).commit()
 
             header = nsa.NSIHeader(conn.requester_nsa, conn.requester_nsa) # The NSA is both requester and provider in the backend, but this might be problematic without aggregator
             now = datetime.datetime.utcnow()
@@ -721,8 +857,8 @@ class GenericBackend(service.Service):
             defer.returnValue(None)
 
         try:
-            conn.data_plane_active = False # technically we don't know, but for NSI that means not active
-            yield conn.save()
+            # technically we don't know, but for NSI that means not active
+            yield state.Transition(conn).set(data_plane_active=False).commit()
             log.msg('Connection %s: Data planed deactivated' % (conn.connection_id), system=self.log_system)
 
             now = datetime.datetime.utcnow()
@@ -745,6 +881,7 @@ class GenericBackend(service.Service):
 
         yield state.passedEndtime(conn)
         self.logStateUpdate(conn, 'PASSED END TIME')
+        self._uncacheConnection(conn)
         yield self._doFreeResource(conn)
 
 
@@ -755,16 +892,10 @@ class GenericBackend(service.Service):
             try:
                 yield self._doTeardown(conn)
                 # we can only remove resource reservation entry if we succesfully shut down the link :-(
-                src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-                dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-                self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-                self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+                self._removeReservation(conn)
             except Exception as e:
                 log.msg('Error ending connection: %s' % e)
                 raise e
         elif conn.allocated or conn.reservation_state == state.RESERVE_HELD: # free reservation if it was allocated/held
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-            self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-            self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+            self._removeReservation(conn)
 
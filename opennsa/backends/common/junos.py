@@ -0,0 +1,59 @@
+"""
+JUNOS CLI channel, shared by the JUNOS based backends.
+
+Configuration commands are sent in a private configuration session and
+committed if they all succeed.
+"""
+
+import re
+
+from twisted.python import log
+from twisted.internet import defer
+
+from opennsa import logging
+from opennsa.backends.common import ssh
+
+
+
+COMMAND_CONFIGURE           = 'edit private'
+COMMAND_COMMIT              = 'commit'
+COMMIT_COMPLETE             = 'commit complete'
+
+# the configuration mode banner ([edit], {master:0}[edit] on virtual chassis) is written after
+# each command, so it marks the end of the output of the command
+PROMPT_PATTERN              = re.compile(r'^(\{[^}]*\})?\[edit\][ \t]*\r?$', re.M)
+ERROR_PATTERN               = re.compile(r'^(error:|syntax error|unknown command|missing argument)[^\r\n]*', re.M)
+
+
+
+class JUNOSChannel(ssh.CLIChannel):
+
+    name = 'session'
+
+    prompt_pattern = PROMPT_PATTERN
+    error_pattern  = ERROR_PATTERN
+    log_system     = 'JUNOS'
+
+
+    @defer.inlineCallbacks
+    def sendCommands(self, commands):
+
+        try:
+            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+
+            # configuration commands are pipelined, commit is only done if they all succeed
+            yield self.sendBlock( [ COMMAND_CONFIGURE ] + commands )
+            logging.debug('Configuration commands applied', system=self.log_system)
+
+            responses = yield self.sendBlock( [ COMMAND_COMMIT ] )
+            if not COMMIT_COMPLETE in responses[0]:
+                raise ssh.CommandError(COMMAND_COMMIT, responses[0].strip())
+
+        except Exception, e:
+            log.msg('Error sending commands: %s' % str(e), system=self.log_system)
+            raise e
+
+        logging.debug('Commands successfully committed', system=self.log_system)
+        self.sendEOF()
+        self.closeIt()
+
@@ -1,6 +1,15 @@
 """
 Call scheduler. Handles one future call per connection.
 
+Scheduled calls are kept in a hierarchical timing wheel, which is driven by a
+single reactor call ticking with a fixed resolution (while there are calls
+scheduled). This avoids having a reactor call per connection, which makes
+scheduling and cancelling calls O(1) and keeps the reactor timer heap small,
+regardless of the number of connections. Calls which become due on the same
+tick are fired as a batch.
+
+The price is that calls are fired up to one resolution late.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
@@ -8,12 +17,22 @@ Copyright: NORDUnet (2011)
 import datetime
 
 from twisted.python import log
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer
 
 
 
 LOG_SYSTEM = 'opennsa.Scheduler'
 
+RESOLUTION      = 1 # seconds
+
+# wheel layout, slots in the first level, and the following levels
+ROOT_BITS       = 8
+LEVEL_BITS      = 6
+LEVELS          = 3 # after the root level, calls beyond the last level go into an overflow list
+
+ROOT_SIZE       = 1 << ROOT_BITS
+LEVEL_SIZE      = 1 << LEVEL_BITS
+
 
 
 def deferTaskFailed(err):
@@ -25,11 +44,165 @@ def deferTaskFailed(err):
 
 
 
+class _WheelEntry(object):
+
+    __slots__ = ('tick', 'deferred', 'slot')
+
+    def __init__(self, tick, deferred):
+        self.tick       = tick
+        self.deferred   = deferred
+        self.slot       = None # the set the entry is currently in
+
+
+
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel. Entries are put into a slot on the root level if
+    they are due within ROOT_SIZE ticks, otherwise into a slot on a coarser
+    level, from which they are cascaded down as time passes.
+    """
+    def __init__(self, clock, resolution=RESOLUTION):
+        self.clock      = clock
+        self.resolution = resolution
+
+        self.root       = [ set() for _ in range(ROOT_SIZE) ]
+        self.levels     = [ [ set() for _ in range(LEVEL_SIZE) ] for _ in range(LEVELS) ]
+        self.overflow   = set()
+
+        self.epoch      = None
+        self.current    = 0 # current tick
+        self.entries    = 0
+        self.tick_call  = None
+
+
+    def __len__(self):
+        return self.entries
+
+
+    def _tickTime(self, tick):
+        return self.epoch + tick * self.resolution
+
+
+    def _place(self, entry):
+        tick = max(entry.tick, self.current + 1)
+        delta = tick - self.current
+
+        if delta < ROOT_SIZE:
+            slot = self.root[tick & (ROOT_SIZE-1)]
+        else:
+            for level in range(LEVELS):
+                shift = ROOT_BITS + level * LEVEL_BITS
+                if delta < 1 << (shift + LEVEL_BITS):
+                    slot = self.levels[level][ (tick >> shift) & (LEVEL_SIZE-1) ]
+                    break
+            else:
+                slot = self.overflow
+
+        slot.add(entry)
+        entry.slot = slot
+
+
+    def add(self, delay, deferred):
+        """
+        Add a deferred to be called back after delay seconds. Returns the entry, which can be removed again.
+        """
+        if self.entries == 0:
+            # wheel is empty, restart it from the current time
+            self.epoch = self.clock.seconds()
+            self.current = 0
+
+        now_tick = (self.clock.seconds() - self.epoch) / self.resolution
+        due_tick = now_tick + float(delay) / self.resolution
+        # round up, calls should never fire early
+        tick = int(due_tick) if due_tick == int(due_tick) else int(due_tick) + 1
+
+        entry = _WheelEntry(tick, deferred)
+        self._place(entry)
+        self.entries += 1
+
+        if self.tick_call is None:
+            self._scheduleTick()
+
+        return entry
+
+
+    def remove(self, entry):
+        if entry.slot is None:
+            return # already fired or removed
+        entry.slot.discard(entry)
+        entry.slot = None
+        self.entries -= 1
+
+        if self.entries == 0 and self.tick_call is not None:
+            self.tick_call.cancel()
+            self.tick_call = None
+
+
+    def _scheduleTick(self):
+        delay = max(self._tickTime(self.current + 1) - self.clock.seconds(), 0)
+        self.tick_call = self.clock.callLater(delay, self._tick)
+
+
+    def _cascade(self, tick):
+        # move entries from coarser levels into finer ones, when the finer level wraps around
+        for level in range(LEVELS):
+            shift = ROOT_BITS + level * LEVEL_BITS
+            if tick & ((1 << shift) - 1) != 0:
+                return
+            slot = self.levels[level][ (tick >> shift) & (LEVEL_SIZE-1) ]
+            entries = list(slot)
+            slot.clear()
+            for entry in entries:
+                self._place(entry)
+
+        if tick & ((1 << (ROOT_BITS + LEVELS * LEVEL_BITS)) - 1) == 0:
+            entries = list(self.overflow)
+            self.overflow.clear()
+            for entry in entries:
+                self._place(entry)
+
+
+    def _tick(self):
+        self.tick_call = None
+
+        target = int( (self.clock.seconds() - self.epoch) / self.resolution )
+
+        due = []
+        while self.current < target and self.entries > len(due):
+            self.current += 1
+            self._cascade(self.current)
+            slot = self.root[self.current & (ROOT_SIZE-1)]
+            if slot:
+                for entry in slot:
+                    entry.slot = None
+                due.extend(slot)
+                slot.clear()
+
+        self.current = max(self.current, target)
+        self.entries -= len(due)
+
+        if self.entries > 0:
+            self._scheduleTick()
+
+        # fire the batch after the wheel is consistent, as the calls can schedule new calls
+        for entry in due:
+            entry.deferred.callback(None)
+
+
+
 class CallScheduler:
 
     def __init__(self):
         self.scheduled_calls = {}
         self.clock = reactor # this is needed in order to test scheduled calls
+        self._wheel = None
+
+
+    def _getWheel(self):
+        # created lazily, as the clock is replaced when testing
+        if self._wheel is None or self._wheel.clock is not self.clock:
+            self._wheel = TimingWheel(self.clock)
+        return self._wheel
 
 
     def scheduleCall(self, connection_id, transition_time, call, *args):
@@ -50,8 +223,13 @@ class CallScheduler:
         transition_delta_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6.0
         transition_delta_seconds = max(transition_delta_seconds, 0) # if dt_now is passed during calculation
 
-        d = task.deferLater(self.clock, transition_delta_seconds, call, *args)
+        wheel = self._getWheel()
+        entry = None
+        d = defer.Deferred(lambda _ : wheel.remove(entry))
+        d.addCallback(lambda _ : call(*args))
         d.addErrback(deferTaskFailed)
+        entry = wheel.add(transition_delta_seconds, d)
+
         self.scheduled_calls[connection_id] = d
         return d
 
@@ -1,5 +1,10 @@
 """
 Basic SSH connectivity.
+
+Backends talk to their devices through an SSHConnectionPool, which keeps an
+authenticated connection to the device alive (using keepalives), reconnects
+transparently if the connection is lost, and hands out channels on the
+connection, with a limit on how many channels can be open at the same time.
 """
 
 from twisted.python import log
@@ -7,9 +12,18 @@ from twisted.internet import defer, protocol, reactor, endpoints
 from twisted.conch import error as concherror
 from twisted.conch.ssh import transport, keys, userauth, connection, channel
 
+from opennsa import error, logging
+
 
 LOG_SYSTEM = 'opennsa.SSH'
 
+MAX_CHANNELS        = 10    # default number of concurrent channels per device (openssh and junos allow 10 sessions per connection)
+SINGLE_CHANNEL      = 1     # for devices which only support one channel per connection
+KEEPALIVE_INTERVAL  = 60    # seconds
+KEEPALIVE_REQUEST   = 'keepalive@openssh.com'
+CLOSE_TIMEOUT       = 10    # seconds to wait for the server to acknowledge channel close
+COMMAND_TIMEOUT     = 120   # seconds to wait for the prompts of a command block
+
 
 
 class SSHClientTransport(transport.SSHClientTransport):
@@ -87,10 +101,15 @@ class SSHConnection(connection.SSHConnection):
     def __init__(self):
         connection.SSHConnection.__init__(self)
         self.ssh_connection_established_d = defer.Deferred()
+        self.closed = False
 
     def serviceStarted(self):
         self.ssh_connection_established_d.callback(self)
 
+    def serviceStopped(self):
+        self.closed = True
+        connection.SSHConnection.serviceStopped(self)
+
 
 
 class SSHChannel(channel.SSHChannel):
@@ -100,11 +119,22 @@ class SSHChannel(channel.SSHChannel):
     def __init__(self, localWindow=0, localMaxPacket=0, remoteWindow=0, remoteMaxPacket=0, conn=None, data=None, avatar=None):
         channel.SSHChannel.__init__(self, localWindow, localMaxPacket, remoteWindow, remoteMaxPacket, conn, data, avatar)
         self.channel_open = defer.Deferred()
+        self.channel_closed = defer.Deferred()
 
 
     def channelOpen(self, data):
         self.channel_open.callback(self)
-        log.msg('SSH channel open.', debug=True, system=LOG_SYSTEM)
+        logging.debug('SSH channel open.', system=LOG_SYSTEM)
+
+
+    def openFailed(self, reason):
+        log.msg('SSH channel open failed: %s' % reason, system=LOG_SYSTEM)
+        self.channel_open.errback(reason)
+
+
+    def closed(self):
+        if not self.channel_closed.called:
+            self.channel_closed.callback(self)
 
 
     def request_exit_status(self, data):
@@ -127,6 +157,124 @@ class SSHChannel(channel.SSHChannel):
 
 
 
+class CommandError(error.InternalNRMError):
+
+    def __init__(self, command, output):
+        error.InternalNRMError.__init__(self, 'Command "%s" failed: %s' % (command, output))
+        self.command = command
+        self.output  = output
+
+
+
+class CLIChannel(SSHChannel):
+    """
+    Channel for sending commands to a device CLI.
+
+    Commands are written in blocks, without waiting for the device between
+    them, and the output is split into per-command responses using the
+    prompt pattern (the device outputs one prompt per command). A response
+    matching the error pattern fails the block, with the command that caused
+    it. Patterns are matched within a line, i.e., they must not span lines.
+    """
+
+    prompt_pattern   = None # compiled regex, set in sub-class
+    error_pattern    = None # compiled regex, optional
+    line_termination = '\r'
+    command_timeout  = COMMAND_TIMEOUT
+    log_system       = LOG_SYSTEM
+
+    def __init__(self, conn):
+        SSHChannel.__init__(self, conn=conn)
+
+        self.clock = reactor # replaced when testing
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.pending = [] # [ (command, deferred) ], in the order they were written
+
+
+    def waitForPrompt(self, pattern=None):
+        """
+        Wait for a single prompt (e.g., a login or password prompt), without
+        writing anything. The deferred fires with the output before the prompt.
+        """
+        d = defer.Deferred()
+        self.pending.append( (pattern or self.prompt_pattern, None, d) )
+        self._scan()
+        return self._addTimeout(d, '(waiting for prompt)')
+
+
+    def sendBlock(self, commands):
+        """
+        Write all commands in one go. Returns a deferred which fires with the
+        list of responses when a prompt has been received for every command,
+        or fails with CommandError for the first command which failed.
+        """
+        if not commands:
+            return defer.succeed([])
+
+        ds = []
+        for cmd in commands:
+            d = defer.Deferred()
+            self.pending.append( (self.prompt_pattern, cmd, d) )
+            ds.append(d)
+
+        for cmd in commands:
+            log.msg('CMD> %s' % cmd, system=self.log_system)
+        self.write(self.line_termination.join(commands) + self.line_termination)
+
+        block_d = defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        block_d.addCallback(lambda results : [ r for _, r in results ])
+        block_d.addErrback(lambda f : f.value.subFailure) # unwrap FirstError
+        return self._addTimeout(block_d, commands[-1])
+
+
+    def _addTimeout(self, d, command):
+
+        def timedOut():
+            log.msg('No prompt received from device within %i seconds' % self.command_timeout, system=self.log_system)
+            pending, self.pending = self.pending, []
+            for _, cmd, wd in pending:
+                wd.errback( CommandError(cmd or command, 'No prompt received from device within %i seconds' % self.command_timeout) )
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        timeout = self.clock.callLater(self.command_timeout, timedOut)
+        d.addBoth(done)
+        return d
+
+
+    def _scan(self):
+        while self.pending:
+            pattern, cmd, d = self.pending[0]
+            match = pattern.search(self.buffer, self.scan_pos)
+            if match is None:
+                # patterns do not span lines, so continue from the start of the last (incomplete) line next time
+                self.scan_pos = self.buffer.rfind('\n') + 1
+                return
+
+            response = str(self.buffer[:match.start()])
+            del self.buffer[:match.end()]
+            self.scan_pos = 0
+            self.pending.pop(0)
+
+            if cmd is not None and self.error_pattern is not None:
+                err = self.error_pattern.search(response)
+                if err:
+                    log.msg('Error from device on command "%s": %s' % (cmd, err.group().strip()), system=self.log_system)
+                    d.errback( CommandError(cmd, err.group().strip()) )
+                    continue
+            d.callback(response)
+
+
+    def dataReceived(self, data):
+        self.buffer.extend(data)
+        self._scan()
+
+
+
 class SSHConnectionCreator:
 
     def __init__(self, host, port, fingerprints, username, public_key_path=None, private_key_path=None, password=None):
@@ -149,7 +297,7 @@ class SSHConnectionCreator:
             self.proto = proto
             return proto.connection_secure_d
 
-        log.msg('Creating new TCP connection for SSH connection.', debug=True, system=LOG_SYSTEM)
+        logging.debug('Creating new TCP connection for SSH connection.', system=LOG_SYSTEM)
         factory = SSHClientFactory(self.fingerprints)
         point = endpoints.TCP4ClientEndpoint(reactor, self.host, self.port)
         d = point.connect(factory)
@@ -176,3 +324,169 @@ class SSHConnectionCreator:
         d.addCallback(gotTCPConnection)
         return d
 
+
+
+
+class SSHConnectionPool:
+    """
+    Shared, long lived, SSH connection to a device.
+
+    The connection is created when first needed, and kept alive with
+    keepalive requests. If the connection is lost (or stops answering
+    keepalives), a new one is created for the next channel request.
+    At most max_channels channels are open at the same time, further
+    requests wait for a channel to be closed.
+    """
+
+    def __init__(self, connection_creator, max_channels=MAX_CHANNELS, keepalive_interval=KEEPALIVE_INTERVAL):
+        self.connection_creator = connection_creator
+        self.keepalive_interval = keepalive_interval
+        self.channel_semaphore = defer.DeferredSemaphore(max_channels)
+
+        self.clock = reactor # replaced when testing
+        self.ssh_connection = None
+        self.connect_waiters = None # list of deferreds when a connection is being created
+        self.keepalive_call = None
+        self.keepalive_d = None
+
+
+    def getConnection(self):
+
+        if self.ssh_connection is not None:
+            if not self.ssh_connection.closed:
+                logging.debug('Reusing SSH connection', system=LOG_SYSTEM)
+                return defer.succeed(self.ssh_connection)
+            log.msg('SSH connection lost, reconnecting', system=LOG_SYSTEM)
+            self._resetConnection()
+
+        d = defer.Deferred()
+        if self.connect_waiters is not None:
+            # connection is already being created, wait for that instead of creating another
+            self.connect_waiters.append(d)
+            return d
+
+        # since creating a new connection should be uncommon, we log it
+        # this makes it possible to see if something fucks up and creates connections continuously
+        log.msg('Creating new SSH connection', system=LOG_SYSTEM)
+        self.connect_waiters = [ d ]
+        cd = self.connection_creator.getSSHConnection()
+        cd.addCallbacks(self._connectionCreated, self._connectionFailed)
+        return d
+
+
+    def _connectionCreated(self, ssh_connection):
+        self.ssh_connection = ssh_connection
+        self.keepalive_call = self.clock.callLater(self.keepalive_interval, self._keepalive)
+        waiters, self.connect_waiters = self.connect_waiters, None
+        for d in waiters:
+            d.callback(ssh_connection)
+
+
+    def _connectionFailed(self, err):
+        log.msg('Error creating SSH connection: %s' % err.getErrorMessage(), system=LOG_SYSTEM)
+        waiters, self.connect_waiters = self.connect_waiters, None
+        for d in waiters:
+            d.errback(err)
+
+
+    def _resetConnection(self):
+        # forget the current connection, closing it if it is still open
+        if self.keepalive_call is not None and self.keepalive_call.active():
+            self.keepalive_call.cancel()
+        self.keepalive_call = None
+        self.keepalive_d = None
+
+        ssh_connection, self.ssh_connection = self.ssh_connection, None
+        if ssh_connection is not None and not ssh_connection.closed:
+            ssh_connection.transport.loseConnection()
+
+
+    def _keepalive(self):
+
+        self.keepalive_call = None
+        ssh_connection = self.ssh_connection
+        if ssh_connection is None or ssh_connection.closed:
+            return
+
+        if self.keepalive_d is not None:
+            log.msg('No reply to SSH keepalive within %i seconds, dropping connection' % self.keepalive_interval, system=LOG_SYSTEM)
+            self._resetConnection()
+            return
+
+        def gotReply(_, d):
+            # a failure reply is fine, the server is still there
+            if self.keepalive_d is d:
+                self.keepalive_d = None
+
+        d = ssh_connection.sendGlobalRequest(KEEPALIVE_REQUEST, '', wantReply=1)
+        self.keepalive_d = d
+        d.addBoth(gotReply, d)
+        self.keepalive_call = self.clock.callLater(self.keepalive_interval, self._keepalive)
+
+
+    @defer.inlineCallbacks
+    def _openChannel(self, channel_factory):
+
+        reconnected = self.ssh_connection is None or self.ssh_connection.closed
+        while True:
+            ssh_connection = yield self.getConnection()
+            channel = channel_factory(conn=ssh_connection)
+            ssh_connection.openChannel(channel)
+            try:
+                yield channel.channel_open
+                defer.returnValue(channel)
+            except Exception as e:
+                if reconnected:
+                    raise
+                # reused connection may have gone bad without us noticing, try once on a fresh one
+                log.msg('Could not open channel on existing SSH connection (%s), reconnecting' % str(e), system=LOG_SYSTEM)
+                if self.ssh_connection is ssh_connection:
+                    self._resetConnection()
+                reconnected = True
+
+
+    def _closeChannel(self, channel):
+        # wait for the server to acknowledge the close before releasing the channel slot,
+        # some devices (e.g., FTOS) will not open a new channel until the previous one is gone
+        if channel.channel_closed.called:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+
+        def channelClosed(_):
+            if timeout.active():
+                timeout.cancel()
+                d.callback(None)
+
+        def closeTimeout():
+            log.msg('SSH channel not closed by server within %i seconds' % CLOSE_TIMEOUT, system=LOG_SYSTEM)
+            d.callback(None)
+
+        timeout = self.clock.callLater(CLOSE_TIMEOUT, closeTimeout)
+        channel.channel_closed.addCallback(channelClosed)
+        channel.loseConnection()
+        return d
+
+
+    @defer.inlineCallbacks
+    def withChannel(self, channel_factory, func):
+        """
+        Open a channel (created with channel_factory(conn=ssh_connection)) and
+        call func with it. The channel is closed when the deferred returned by
+        func fires, if func has not already closed it. Returns the result of func.
+        """
+        yield self.channel_semaphore.acquire()
+        try:
+            channel = yield self._openChannel(channel_factory)
+            try:
+                result = yield func(channel)
+            finally:
+                yield self._closeChannel(channel)
+        finally:
+            self.channel_semaphore.release()
+
+        defer.returnValue(result)
+
+
+    def close(self):
+        self._resetConnection()
@@ -50,12 +50,13 @@ Copyright: NORDUnet (2011-2013)
 import string
 import random
 import os
+import re
 
 from twisted.python import log
 from twisted.internet import defer
 from twisted.conch.ssh import session
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'Force10'
@@ -75,6 +76,11 @@ COMMAND_TAGGED          = 'tagged %(interface)s'
 
 COMMAND_NO_INTERFACE    = 'no interface vlan %(vlan)i'
 
+EXEC_PROMPT_PATTERN     = re.compile('>')
+PASSWORD_PROMPT_PATTERN = re.compile(':')
+PROMPT_PATTERN          = re.compile('#') # enable / configuration mode
+ERROR_PATTERN           = re.compile(r'% Error[^\r\n]*')
+
 
 
 def _portToInterfaceVLAN(nrm_port):
@@ -116,17 +122,13 @@ def _createTeardownCommands(source_nrm_port, dest_nrm_port):
 
 
 
-class SSHChannel(ssh.SSHChannel):
+class SSHChannel(ssh.CLIChannel):
 
     name = 'session'
 
-    def __init__(self, conn):
-        ssh.SSHChannel.__init__(self, conn=conn)
-
-        self.data = ''
-
-        self.wait_defer = None
-        self.wait_data  = None
+    prompt_pattern = PROMPT_PATTERN
+    error_pattern  = ERROR_PATTERN
+    log_system     = LOG_SYSTEM
 
 
     @defer.inlineCallbacks
@@ -134,51 +136,35 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
+            logging.debug('Requesting shell for sending commands', system=LOG_SYSTEM)
             term = os.environ.get('TERM', 'xterm')
-	    winSize = (25,80,0,0)
-	    ptyReqData = session.packRequest_pty_req(term, winSize, '')
+            winSize = (25,80,0,0)
+            ptyReqData = session.packRequest_pty_req(term, winSize, '')
             yield self.conn.sendRequest(self, 'pty-req', ptyReqData, wantReply=1)
             yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
-            log.msg('Got shell', system=LOG_SYSTEM, debug=True)
+            logging.debug('Got shell', system=LOG_SYSTEM)
 
-            d = self.waitForData('>')
-            yield d
-            log.msg('Got shell ready', system=LOG_SYSTEM, debug=True)
+            yield self.waitForPrompt(EXEC_PROMPT_PATTERN)
+            logging.debug('Got shell ready', system=LOG_SYSTEM)
 
-            # so far so good
-
-            d = self.waitForData(':')
-            self.write(COMMAND_ENABLE + LT) # This one fails for some reason
+            # enable is done step by step, as type-ahead is discarded at the password prompt
+            d = self.waitForPrompt(PASSWORD_PROMPT_PATTERN)
+            self.write(COMMAND_ENABLE + LT)
             yield d
-            log.msg('Got enable password prompt', system=LOG_SYSTEM, debug=True)
+            logging.debug('Got enable password prompt', system=LOG_SYSTEM)
 
-            d = self.waitForData('#')
+            d = self.waitForPrompt()
             self.write(enable_password + LT)
             yield d
+            logging.debug('Entered enabled mode', system=LOG_SYSTEM)
 
-            log.msg('Entered enabled mode', debug=True, system=LOG_SYSTEM)
-
-            d = self.waitForData('#')
-            self.write(COMMAND_CONFIGURE + LT) # This one fails for some reason
-            yield d
+            # configuration commands are pipelined, configuration is only written if they all succeed
+            yield self.sendBlock( [ COMMAND_CONFIGURE ] + commands )
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Configuration done, writing configuration.', system=LOG_SYSTEM)
+            yield self.sendBlock( [ COMMAND_WRITE ] )
 
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, debug=True, system=LOG_SYSTEM)
-                d = self.waitForData('#')
-                self.write(cmd + LT)
-                yield d
-
-            # Superfluous COMMAND_END has been removed by hopet
-
-            log.msg('Configuration done, writing configuration.', debug=True, system=LOG_SYSTEM)
-            d = self.waitForData('#')
-            self.write(COMMAND_WRITE + LT)
-            yield d
-
-            log.msg('Configuration written. Exiting.', debug=True, system=LOG_SYSTEM)
+            logging.debug('Configuration written. Exiting.', system=LOG_SYSTEM)
             self.write(COMMAND_EXIT + LT)
             # Waiting for the prompt removed by hopet - we could wait forever here! :(
 
@@ -191,59 +177,24 @@ class SSHChannel(ssh.SSHChannel):
         self.closeIt()
 
 
-    def waitForData(self, data):
-        self.wait_data  = data
-        self.wait_defer = defer.Deferred()
-        return self.wait_defer
-
-
-    def dataReceived(self, data):
-        log.msg("DATA:" + data, system=LOG_SYSTEM, debug=True)
-        if len(data) == 0:
-            pass
-        else:
-            self.data += data
-            if self.wait_data and self.wait_data in self.data:
-                d = self.wait_defer
-                self.data       = ''
-                self.wait_data  = None
-                self.wait_defer = None
-                d.callback(self)
-
-
-
 
 class Force10CommandSender:
 
-    def __init__(self, ssh_connection_creator, enable_password):
+    def __init__(self, ssh_connection_creator, enable_password, max_channels=ssh.SINGLE_CHANNEL):
 
-        self.ssh_connection_creator = ssh_connection_creator
+        # Note: FTOS does not allow multiple channels in an SSH connection,
+        # so max_channels should be left at 1 for these devices
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
         self.enable_password = enable_password
 
 
-    @defer.inlineCallbacks
     def sendCommands(self, commands):
 
-        # Note: FTOS does not allow multiple channels in an SSH connection,
-        # so we open a connection for each request. Party like it is 1988.
+        def gotChannel(channel):
+            logging.debug("Channel open, sending commands", system=LOG_SYSTEM)
+            return channel.sendCommands(commands, self.enable_password)
 
-        # The "correct" solution for this would be to create a connection pool,
-        # but that won't happen just now.
-
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
-
-        try:
-            channel = SSHChannel(conn=ssh_connection)
-            ssh_connection.openChannel(channel)
-            log.msg("Opening channel", system=LOG_SYSTEM, debug=True)
-
-            yield channel.channel_open
-            log.msg("Channel open, sending commands", system=LOG_SYSTEM, debug=True)
-            yield channel.sendCommands(commands, self.enable_password)
-
-        finally:
-            ssh_connection.transport.loseConnection()
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
 
 
@@ -257,7 +208,7 @@ class Force10ConnectionManager:
         port             = cfg.get(config.FORCE10_PORT, 22)
         host_fingerprint = cfg[config.FORCE10_HOST_FINGERPRINT]
         user             = cfg[config.FORCE10_USER]
-
+        max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.SINGLE_CHANNEL))
 
         if config.FORCE10_PASSWORD in cfg:
             password = cfg[config.FORCE10_PASSWORD]
@@ -269,7 +220,7 @@ class Force10ConnectionManager:
             ssh_connection_creator = ssh.SSHConnectionCreator(host, port, [ host_fingerprint ], user, ssh_public_key, ssh_private_key)
 
         # this will blow up when used with ssh keys
-        self.command_sender = Force10CommandSender(ssh_connection_creator, enable_password=password)
+        self.command_sender = Force10CommandSender(ssh_connection_creator, enable_password=password, max_channels=max_channels)
 
 
     def getResource(self, port, label):
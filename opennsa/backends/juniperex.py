@@ -25,7 +25,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -89,7 +89,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(COMMAND_CONFIGURE + LT)
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -112,7 +112,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully committed', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -150,37 +150,12 @@ class SSHChannel(ssh.SSHChannel):
 class JuniperEXCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, max_channels=ssh.MAX_CHANNELS):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-
-
-    def _getSSHChannel(self):
-
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
-
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
-
-        if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
 
 
     def _sendCommands(self, commands):
@@ -189,9 +164,7 @@ class JuniperEXCommandSender:
             d = channel.sendCommands(commands)
             return d
 
-        d = self._getSSHChannel()
-        d.addCallback(gotChannel)
-        return d
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
 
     def setupLink(self, source_nrm_port, dest_nrm_port, vlan):
@@ -225,10 +198,10 @@ class JunosEXTarget(object):
 
 class JuniperEXConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, max_channels=ssh.MAX_CHANNELS):
 
         self.port_map = port_map
-        self.command_sender = JuniperEXCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+        self.command_sender = JuniperEXCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, max_channels)
 
 
     def getResource(self, port, label):
@@ -291,6 +264,7 @@ def JuniperEXBackend(network_name, nrm_ports, parent_requester, cfg):
     user             = cfg[config.JUNIPER_USER]
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
+    max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.MAX_CHANNELS))
 
-    cm = JuniperEXConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+    cm = JuniperEXConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, max_channels)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
@@ -71,7 +71,7 @@ Copyright: NORDUnet (2017)
 from twisted.python import log
 from twisted.internet import defer, reactor
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -171,7 +171,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(CONFIGURE + LT)
             yield d
 
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
+            logging.debug('Entered configure mode', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -187,7 +187,7 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Error sending commands: %s' % str(e))
             raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
+        logging.debug('Commands successfully committed', system=LOG_SYSTEM)
         self.sendEOF()
         self.closeIt()
 
@@ -215,7 +215,7 @@ class SSHChannel(ssh.SSHChannel):
     def matchLine(self, line):
 
         if self.wait_line is None and self.wait_defer is None:
-            log.msg('Nothing to wait for line:: ' + line, debug=True, system=LOG_SYSTEM)
+            logging.debug('Nothing to wait for line:: %s', line, system=LOG_SYSTEM)
             return
 
         if self.wait_line and self.wait_defer:
@@ -229,7 +229,7 @@ class SSHChannel(ssh.SSHChannel):
                 d.callback(self)
 
             else:
-                log.msg('Discarding wait line: ' + line, debug=True, system=LOG_SYSTEM)
+                logging.debug('Discarding wait line: %s', line, system=LOG_SYSTEM)
 
         else:
             log.msg('Weird wait configuration: ' + str(self.wait_line) + ' / ' + str(self.wait_defer), system=LOG_SYSTEM)
@@ -252,37 +252,12 @@ class SSHChannel(ssh.SSHChannel):
 class JuniperVPLSCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, max_channels=ssh.MAX_CHANNELS):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-
-
-    def _getSSHChannel(self):
-
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
-
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
-
-        if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
 
 
     def _sendCommands(self, commands):
@@ -291,9 +266,7 @@ class JuniperVPLSCommandSender:
             d = channel.sendCommands(commands)
             return d
 
-        d = self._getSSHChannel()
-        d.addCallback(gotChannel)
-        return d
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
 
     def setupLink(self, source_port, dest_port, vlan, instance_id, as_number):
@@ -336,10 +309,10 @@ class JunosUnitTarget(object):
 class JuniperVPLSConnectionManager:
 
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number, max_channels=ssh.MAX_CHANNELS):
 
         self.port_map = port_map
-        self.command_sender = JuniperVPLSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+        self.command_sender = JuniperVPLSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, max_channels)
         self.as_number = as_number
 
 
@@ -411,6 +384,7 @@ def JuniperVPLSBackend(network_name, nrm_ports, parent_requester, cfg):
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
     as_number        = cfg[config.AS_NUMBER]
+    max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.MAX_CHANNELS))
 
-    cm = JuniperVPLSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number)
+    cm = JuniperVPLSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number, max_channels)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
@@ -15,15 +15,12 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend, ssh
+from opennsa import constants as cnt, config, logging
+from opennsa.backends.common import genericbackend, ssh, junos
 
 
 
 # parameterized commands
-COMMAND_CONFIGURE           = 'edit private'
-COMMAND_COMMIT              = 'commit'
-
 COMMAND_SET_INTERFACES      = 'set interfaces %(port)s encapsulation ethernet-ccc' # port, source vlan, source vlan
 COMMAND_SET_INTERFACES_CCC  = 'set interfaces %(port)s unit 0 family ccc'
 COMMAND_SET_INTERFACES_MTU  = 'set interfaces %(port)s mtu 9000'
@@ -54,139 +51,29 @@ LOG_SYSTEM = 'EX4550'
 
 
 
-class SSHChannel(ssh.SSHChannel):
-
-    name = 'session'
-
-    def __init__(self, conn):
-        ssh.SSHChannel.__init__(self, conn=conn)
-
-        self.line = ''
-
-        self.wait_defer = None
-        self.wait_line  = None
-
-
-    @defer.inlineCallbacks
-    def sendCommands(self, commands):
-        LT = '\r' # line termination
-
-        try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
-
-            d = self.waitForLine('{master:0}[edit]')
-            self.write(COMMAND_CONFIGURE + LT)
-            yield d
-
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
-
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
-                d = self.waitForLine('{master:0}[edit]')
-                self.write(cmd + LT)
-                yield d
-
-            # commit commands, check for 'commit complete' as success
-            # not quite sure how to handle failure here
-
-            ## test stuff
-            #d = self.waitForLine('[edit]')
-            #self.write('commit check' + LT)
-
-            d = self.waitForLine('commit complete')
-            self.write(COMMAND_COMMIT + LT)
-            yield d
-
-        except Exception, e:
-            log.msg('Error sending commands: %s' % str(e))
-            raise e
-
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
-        self.sendEOF()
-        self.closeIt()
-
-
-    def waitForLine(self, line):
-        self.wait_line = line
-        self.wait_defer = defer.Deferred()
-        return self.wait_defer
-
-
-    def matchLine(self, line):
-        if self.wait_line and self.wait_defer:
-            if self.wait_line == line.strip():
-                d = self.wait_defer
-                self.wait_line  = None
-                self.wait_defer = None
-                d.callback(self)
-            else:
-                pass
-
-
-    def dataReceived(self, data):
-        if len(data) == 0:
-            pass
-        else:
-            self.line += data
-            if '\n' in data:
-                lines = [ line.strip() for line in self.line.split('\n') if line.strip() ]
-                self.line = ''
-                for l in lines:
-                    self.matchLine(l)
+class SSHChannel(junos.JUNOSChannel):
 
+    log_system = LOG_SYSTEM
 
 
 
 class JunosEx4550CommandSender:
 
     def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
-            network_name):
-        self.ssh_connection_creator = \
+            network_name, max_channels=ssh.MAX_CHANNELS):
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-        self.connection_lock = defer.DeferredLock()
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
         self.network_name = network_name
 
-    def _getSSHChannel(self):
-
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
-
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
-
-        if self.ssh_connection:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
-
 
-    @defer.inlineCallbacks
     def _sendCommands(self, commands):
 
-        channel = yield self._getSSHChannel()
-        log.msg('Acquiring ssh session lock', debug=True, system=LOG_SYSTEM)
-        yield self.connection_lock.acquire()
-        log.msg('Got ssh session lock', debug=True, system=LOG_SYSTEM)
+        def gotChannel(channel):
+            return channel.sendCommands(commands)
 
-        try:
-            yield channel.sendCommands(commands)
-        finally:
-            log.msg('Releasing ssh session lock', debug=True, system=LOG_SYSTEM)
-            self.connection_lock.release()
-            log.msg('Released ssh session lock', debug=True, system=LOG_SYSTEM)
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
@@ -221,11 +108,11 @@ class JunosEx4550Target(object):
 class JunosEx4550ConnectionManager:
 
     def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            network_name):
+            network_name, max_channels=ssh.MAX_CHANNELS):
         self.network_name = network_name
         self.port_map = port_map
         self.command_sender = JunosEx4550CommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-                network_name)
+                network_name, max_channels)
 
 
     def getResource(self, port, label):
@@ -273,9 +160,10 @@ def JunosEXBackend(network_name, nrm_ports , parent_requester, cfg):
     user             = cfg[config.JUNIPER_USER]
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
+    max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.MAX_CHANNELS))
 
     cm = JunosEx4550ConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            network_name)
+            network_name, max_channels)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
 
@@ -287,8 +175,8 @@ class JunosEx4550CommandGenerator(object):
         self.dest_port = dest_port
         self.bandwidth = bandwidth
         self.network_name = network_name
-        log.msg('Initialised with params src %s dst %s bandwidth %s connectionid %s' %
-                (src_port,dest_port,bandwidth,connection_id), debug=True, system=LOG_SYSTEM)
+        logging.debug('Initialised with params src %s dst %s bandwidth %s connectionid %s',
+                      src_port, dest_port, bandwidth, connection_id, system=LOG_SYSTEM)
 
 
     def generateActivateCommand(self):
@@ -297,10 +185,10 @@ class JunosEx4550CommandGenerator(object):
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
         log.msg("%s %s " % (source_port,dest_port))
-        log.msg("Activate commands between %s:%s:%s and %s:%s:%s " % 
-                (source_port.remote_network, source_port.interface, source_port.label.type_,
-                    dest_port.remote_network, dest_port.interface, dest_port.label.type_), debug=True,
-                system=LOG_SYSTEM)
+        logging.debug("Activate commands between %s:%s:%s and %s:%s:%s ",
+                      source_port.remote_network, source_port.interface, source_port.label.type_,
+                      dest_port.remote_network, dest_port.interface, dest_port.label.type_,
+                      system=LOG_SYSTEM)
 
         # Local connection
         if source_port.remote_network is None and dest_port.remote_network is None:
@@ -319,10 +207,10 @@ class JunosEx4550CommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Deactivate commands between %s:%s#%s=%s and %s:%s#%s=%s " % 
-                (source_port.remote_network, source_port.interface, source_port.label.type_,self.src_port.value,
-                    dest_port.remote_network, dest_port.interface, dest_port.label.type_,self.dest_port.value), debug=True,
-                system=LOG_SYSTEM)
+        logging.debug("Deactivate commands between %s:%s#%s=%s and %s:%s#%s=%s ",
+                      source_port.remote_network, source_port.interface, source_port.label.type_, self.src_port.value,
+                      dest_port.remote_network, dest_port.interface, dest_port.label.type_, self.dest_port.value,
+                      system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
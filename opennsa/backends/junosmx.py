@@ -9,18 +9,15 @@ Author: Tamas Varga <vargat(at)niif(dot)hu>
 
 import random
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend, ssh
+from opennsa import constants as cnt, config, logging
+from opennsa.backends.common import genericbackend, ssh, junos, batcher
 
 
 
 # parameterized commands
-COMMAND_CONFIGURE           = 'edit private'
-COMMAND_COMMIT              = 'commit'
-
 COMMAND_SET_INTERFACES      = 'set interfaces %(port)s encapsulation ethernet-ccc' # port, source vlan, source vlan
 COMMAND_SET_INTERFACES_CCC  = 'set interfaces %(port)s unit 0 family ccc'
 COMMAND_SET_INTERFACES_MTU  = 'set interfaces %(port)s mtu 9000'
@@ -50,156 +47,77 @@ COMMAND_REMOTE_CONNECTIONS_RECEIVE_LSP  = 'set protocols connections remote-inte
 
 LOG_SYSTEM = 'JUNOS'
 
+COMMIT_WINDOW = 1 # seconds, command sets queued within this window are applied in a single commit
 
 
-class SSHChannel(ssh.SSHChannel):
-
-    name = 'session'
-
-    def __init__(self, conn):
-        ssh.SSHChannel.__init__(self, conn=conn)
-
-        self.line = ''
-
-        self.wait_defer = None
-        self.wait_line  = None
-
-
-    @defer.inlineCallbacks
-    def sendCommands(self, commands):
-        LT = '\r' # line termination
-
-        try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
-
-            d = self.waitForLine('[edit]')
-            self.write(COMMAND_CONFIGURE + LT)
-            yield d
-
-            log.msg('Entered configure mode', debug=True, system=LOG_SYSTEM)
-
-            for cmd in commands:
-                log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
-                d = self.waitForLine('[edit]')
-                self.write(cmd + LT)
-                yield d
-
-            # commit commands, check for 'commit complete' as success
-            # not quite sure how to handle failure here
-
-            ## test stuff
-            #d = self.waitForLine('[edit]')
-            #self.write('commit check' + LT)
-
-            d = self.waitForLine('commit complete')
-            self.write(COMMAND_COMMIT + LT)
-            yield d
-
-        except Exception, e:
-            log.msg('Error sending commands: %s' % str(e))
-            raise e
 
-        log.msg('Commands successfully committed', debug=True, system=LOG_SYSTEM)
-        self.sendEOF()
-        self.closeIt()
-
-
-    def waitForLine(self, line):
-        self.wait_line = line
-        self.wait_defer = defer.Deferred()
-        return self.wait_defer
-
-
-    def matchLine(self, line):
-        if self.wait_line and self.wait_defer:
-            if self.wait_line == line.strip():
-                d = self.wait_defer
-                self.wait_line  = None
-                self.wait_defer = None
-                d.callback(self)
-            else:
-                pass
-
-
-    def dataReceived(self, data):
-        if len(data) == 0:
-            pass
-        else:
-            self.line += data
-            if '\n' in data:
-                lines = [ line.strip() for line in self.line.split('\n') if line.strip() ]
-                self.line = ''
-                for l in lines:
-                    self.matchLine(l)
+class SSHChannel(junos.JUNOSChannel):
 
+    log_system = LOG_SYSTEM
 
 
 
 class JUNOSCommandSender:
 
     def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
-            junos_routers,network_name):
-        self.ssh_connection_creator = \
+            junos_routers,network_name, max_channels=ssh.MAX_CHANNELS):
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-        self.connection_lock = defer.DeferredLock()
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
         self.junos_routers = junos_routers
         self.network_name = network_name
 
-    def _getSSHChannel(self):
+        # command sets queued within the window are committed together, one commit at a time
+        self.batcher = batcher.Batcher(self._commitBatch, COMMIT_WINDOW)
 
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
 
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
+    def _sendCommands(self, commands):
 
-        if self.ssh_connection:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        def gotChannel(channel):
+            return channel.sendCommands(commands)
 
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
-    @defer.inlineCallbacks
-    def _sendCommands(self, commands):
 
-        channel = yield self._getSSHChannel()
-        log.msg('Acquiring ssh session lock', debug=True, system=LOG_SYSTEM)
-        yield self.connection_lock.acquire()
-        log.msg('Got ssh session lock', debug=True, system=LOG_SYSTEM)
+    def _queueCommands(self, commands):
+        # queue commands for the next commit, the deferred fires when they have been committed
+        return self.batcher.queue(commands)
 
+
+    @defer.inlineCallbacks
+    def _commitBatch(self, batch):
+        # apply all command sets in one configuration session and commit
+        # if that fails, the command sets are committed one by one, so only the failing ones are reported as such
+
+        commands = [ cmd for cmds, _ in batch for cmd in cmds ]
+        log.msg('Committing %i command set(s), %i commands' % (len(batch), len(commands)), system=LOG_SYSTEM)
         try:
-            yield channel.sendCommands(commands)
-        finally:
-            log.msg('Releasing ssh session lock', debug=True, system=LOG_SYSTEM)
-            self.connection_lock.release()
-            log.msg('Released ssh session lock', debug=True, system=LOG_SYSTEM)
+            yield self._sendCommands(commands)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].errback( failure.Failure() )
+                return
+            log.msg('Commit of %i command sets failed (%s), committing them individually' % (len(batch), str(e)), system=LOG_SYSTEM)
+            yield batcher.sendIndividually(batch, self._sendCommands)
+            return
+
+        for _, d in batch:
+            d.callback(None)
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
 
         cg = JUNOSCommandGenerator(connection_id,source_port,dest_port,self.junos_routers,self.network_name,bandwidth)
         commands = cg.generateActivateCommand() 
-        return self._sendCommands(commands)
+        return self._queueCommands(commands)
 
 
     def teardownLink(self, connection_id, source_port, dest_port, bandwidth):
 
         cg = JUNOSCommandGenerator(connection_id,source_port,dest_port,self.junos_routers,self.network_name,bandwidth)
         commands = cg.generateDeactivateCommand() 
-        return self._sendCommands(commands)
+        return self._queueCommands(commands)
 
 
 class JUNOSTarget(object):
@@ -226,11 +144,11 @@ class JUNOSTarget(object):
 class JUNOSConnectionManager:
 
     def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            junos_routers,network_name):
+            junos_routers,network_name, max_channels=ssh.MAX_CHANNELS):
         self.network_name = network_name
         self.port_map = port_map
         self.command_sender = JUNOSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-                junos_routers,network_name)
+                junos_routers,network_name, max_channels)
         self.junos_routers = junos_routers
         self.supportedLabelPairs = {
                 "mpls" : ['vlan','port'],
@@ -299,6 +217,7 @@ def JUNOSMXBackend(network_name, nrm_ports , parent_requester, cfg):
     user             = cfg[config.JUNOS_USER]
     ssh_public_key   = cfg[config.JUNOS_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNOS_SSH_PRIVATE_KEY]
+    max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.MAX_CHANNELS))
     junos_routers_c    =  cfg[config.JUNOS_ROUTERS].split()
     junos_routers = dict()
     log.msg("Loaded JUNOS backend with routers:")
@@ -307,7 +226,7 @@ def JUNOSMXBackend(network_name, nrm_ports , parent_requester, cfg):
         log.msg("Network: %s loopback: %s" % (r,l))
         junos_routers[r] = l
     cm = JUNOSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            junos_routers,network_name)
+            junos_routers,network_name, max_channels)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
 
@@ -320,8 +239,8 @@ class JUNOSCommandGenerator(object):
         self.bandwidth = bandwidth
         self.junos_routers = junos_routers
         self.network_name = network_name
-        log.msg('Initialised with params src %s dst %s bandwidth %s connectionid %s' %
-                (src_port,dest_port,bandwidth,connection_id), debug=True, system=LOG_SYSTEM)
+        logging.debug('Initialised with params src %s dst %s bandwidth %s connectionid %s',
+                      src_port, dest_port, bandwidth, connection_id, system=LOG_SYSTEM)
 
 
     def generateActivateCommand(self):
@@ -329,7 +248,7 @@ class JUNOSCommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Activate commands between %s and %s " %  (source_port,dest_port), debug=True, system=LOG_SYSTEM)
+        logging.debug("Activate commands between %s and %s ", source_port, dest_port, system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
@@ -347,7 +266,7 @@ class JUNOSCommandGenerator(object):
 
         source_port = self.src_port.port
         dest_port   = self.dest_port.port
-        log.msg("Deactivate commands between %s and %s " %  (source_port,dest_port), debug=True, system=LOG_SYSTEM)
+        logging.debug("Deactivate commands between %s and %s ", source_port, dest_port, system=LOG_SYSTEM)
 
         # Local connection 
         if source_port.remote_network is None and dest_port.remote_network is None:
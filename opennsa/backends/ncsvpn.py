@@ -8,11 +8,12 @@ Copyright: NORDUnet(2011-2013)
 import base64
 import random
 
-from twisted.python import log
+from twisted.python import log, failure
+from twisted.internet import defer
 from twisted.web.error import Error as WebError
 
 from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend
+from opennsa.backends.common import genericbackend, batcher
 from opennsa.protocols.shared import httpclient
 
 
@@ -50,6 +51,8 @@ NCS_TIMEOUT = 60 # ncs typically spends 25-32 seconds creating/deleting a vpn, s
 
 NO_OUT_OF_SYNC_CHECK = 'no-out-of-sync-check' # put this as a query parameter to get ncs to bypass the check
 
+MAX_BATCH_SIZE = 50 # max number of service changes in a single ncs transaction (when batching)
+
 
 
 ETHERNET_VPN_PAYLOAD_BASE = """
@@ -105,6 +108,22 @@ ETHERNET_VLAN_REWRITE_VPN_PAYLOAD_BASE = """
 
 
 
+# batched changes are sent as a PATCH of the services resource, so they are done in a single transaction
+
+BATCH_PAYLOAD_BASE = """
+<services xmlns="http://tail-f.com/ns/ncs" xmlns:nc="urn:ietf:params:xml:ns:netconf:base:1.0">
+%(services)s
+</services>
+"""
+
+DELETE_PAYLOAD_BASE = """
+<bod xmlns="http://nordu.net/ns/ncs/vpn" nc:operation="delete">
+    <service-name>%(service_name)s</service-name>
+</bod>
+"""
+
+
+
 LOG_SYSTEM = 'opennsa.ncsvpn'
 
 
@@ -151,6 +170,18 @@ def createVPNPayload(service_name, source_target, dest_target):
 
 
 
+def createBatchPayload(changes):
+    # changes is a list of ( connection_id, create payload ), where payload is None for deletion
+    services = []
+    for connection_id, payload in changes:
+        if payload is None:
+            services.append( DELETE_PAYLOAD_BASE % { 'service_name' : connection_id } )
+        else:
+            services.append(payload)
+    return BATCH_PAYLOAD_BASE % { 'services' : ''.join(services) }
+
+
+
 def _extractErrorMessage(failure):
     # used to extract error messages from http requests
     if isinstance(failure.value, WebError):
@@ -162,12 +193,17 @@ def _extractErrorMessage(failure):
 
 class NCSVPNConnectionManager:
 
-    def __init__(self, ncs_services_url, user, password, port_map, log_system):
+    def __init__(self, ncs_services_url, user, password, port_map, log_system, batch_window=0):
         self.ncs_services_url = ncs_services_url
         self.user             = user
         self.password         = password
         self.port_map         = port_map
         self.log_system       = log_system
+        self.batch_window     = batch_window # 0 means no batching
+
+        # changes are ( connection_id, payload ), payload is None for deletion
+        # changes for the same service must not be in the same transaction
+        self.batcher = batcher.Batcher(self._sendBatch, batch_window, MAX_BATCH_SIZE, key=lambda change : change[0])
 
 
     def getResource(self, port, label):
@@ -206,10 +242,61 @@ class NCSVPNConnectionManager:
         headers['Authorization'] = self._createAuthzHeader()
         return headers
 
-    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
+    def _createService(self, connection_id, payload):
         service_url = self.ncs_services_url + '?' + NO_OUT_OF_SYNC_CHECK
+        return httpclient.httpRequest(service_url, payload, self._createHeaders(), method='POST', timeout=NCS_TIMEOUT)
+
+
+    def _deleteService(self, connection_id):
+        service_url = self.ncs_services_url + '/bod/' + connection_id + '?' + NO_OUT_OF_SYNC_CHECK
+        return httpclient.httpRequest(service_url, None, self._createHeaders(), method='DELETE', timeout=NCS_TIMEOUT)
+
+
+    def _sendChange(self, connection_id, payload):
+        if payload is None:
+            return self._deleteService(connection_id)
+        else:
+            return self._createService(connection_id, payload)
+
+
+    def _queueChange(self, connection_id, payload):
+        # queue a service change for the next batch, the deferred fires when it has been done
+        if not self.batch_window:
+            return self._sendChange(connection_id, payload)
+
+        return self.batcher.queue( (connection_id, payload) )
+
+
+    @defer.inlineCallbacks
+    def _sendBatch(self, batch):
+
+        if len(batch) == 1:
+            yield self._sendIndividually(batch)
+            return
+
+        log.msg('Sending %i service changes to NCS in one transaction' % len(batch), system=self.log_system)
+        payload = createBatchPayload( [ change for change, _ in batch ] )
+        service_url = self.ncs_services_url + '?' + NO_OUT_OF_SYNC_CHECK
+        try:
+            yield httpclient.httpRequest(service_url, payload, self._createHeaders(), method='PATCH', timeout=NCS_TIMEOUT * len(batch))
+        except Exception:
+            err = failure.Failure()
+            log.msg('Batch of %i service changes failed, sending them individually. Message: %s' % \
+                    (len(batch), _extractErrorMessage(err)), system=self.log_system)
+            yield self._sendIndividually(batch)
+            return
+
+        for _, d in batch:
+            d.callback(None)
+
+
+    def _sendIndividually(self, batch):
+        # one at a time, ncs serializes transactions anyway
+        return batcher.sendIndividually(batch, lambda change : self._sendChange(*change))
+
+
+    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
         payload = createVPNPayload(connection_id, source_target, dest_target)
-        headers = self._createHeaders()
 
         def linkUp(_):
             log.msg('Link %s -> %s up' % (source_target, dest_target), system=self.log_system)
@@ -219,14 +306,12 @@ class NCSVPNConnectionManager:
             log.msg('Message: %s' % _extractErrorMessage(failure), system=self.log_system)
             return failure
 
-        d = httpclient.httpRequest(service_url, payload, headers, method='POST', timeout=NCS_TIMEOUT)
+        d = self._queueChange(connection_id, payload)
         d.addCallbacks(linkUp, error)
         return d
 
 
     def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
-        service_url = self.ncs_services_url + '/bod/' + connection_id + '?' + NO_OUT_OF_SYNC_CHECK
-        headers = self._createHeaders()
 
         def linkDown(_):
             log.msg('Link %s -> %s down' % (source_target, dest_target), system=self.log_system)
@@ -236,7 +321,7 @@ class NCSVPNConnectionManager:
             log.msg('Message: %s' % _extractErrorMessage(failure), system=self.log_system)
             return failure
 
-        d = httpclient.httpRequest(service_url, None, headers, method='DELETE', timeout=NCS_TIMEOUT)
+        d = self._queueChange(connection_id, None)
         d.addCallbacks(linkDown, error)
         return d
 
@@ -252,7 +337,11 @@ def NCSVPNBackend(network_name, nrm_ports, parent_requester, cfg):
     ncs_services_url = str(cfg[config.NCS_SERVICES_URL]) # convert from unicode
     user             = cfg[config.NCS_USER]
     password         = cfg[config.NCS_PASSWORD]
+    try:
+        batch_window = float(cfg.get(config.NCS_BATCH_WINDOW, 0))
+    except ValueError:
+        raise config.ConfigurationError('Invalid %s value: %s' % (config.NCS_BATCH_WINDOW, cfg[config.NCS_BATCH_WINDOW]))
 
-    cm = NCSVPNConnectionManager(ncs_services_url, user, password, port_map, name)
+    cm = NCSVPNConnectionManager(ncs_services_url, user, password, port_map, name, batch_window)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
 
@@ -8,24 +8,30 @@
   Version 0.1 - Created to support AMPATH (Jul/2015)
   Version 0.2 - Enhanced to support Async calls, replacing urllib2 (Dec/2016)
 
+  Lookups of workgroups and switch ports (which very rarely change) are cached,
+  identical concurrent queries are coalesced into a single HTTP request, and
+  independent lookups during provisioning are done concurrently.
+
 """
 
 import random
 import json
 from base64 import b64encode
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import reactor, defer
 from twisted.internet.ssl import ClientContextFactory
 from twisted.web.client import Agent, readBody
 from twisted.web.http_headers import Headers
 
 from opennsa.backends.common import genericbackend
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 
 
 LOG_SYSTEM = 'opennsa.OESS'
 
+CACHE_TTL = 300 # seconds, for workgroup and switch port lookups
+
 
 # ********************************************************************************
 # ************************* Twisted Mini Web Client ******************************
@@ -43,7 +49,7 @@ def http_query(conn, sub_path):
     """
     full_url = conn.url + sub_path
     full_url = full_url.encode('latin-1')
-    log.msg("http_query: %r" % full_url, debug=True, system=LOG_SYSTEM)
+    logging.debug("http_query: %r", full_url, system=LOG_SYSTEM)
 
     context_factory = WebClientContextFactory()
     agent = Agent(reactor, context_factory)
@@ -169,7 +175,7 @@ def oess_get_path(conn, s_sw, d_sw, primary=None):
     if primary is not None:
         for link in primary:
             query += "&link=%s" % link
-    retval = yield http_query(conn, query)
+    retval = yield conn.query(query)
     defer.returnValue(retval)
 
 
@@ -177,21 +183,25 @@ def oess_get_path(conn, s_sw, d_sw, primary=None):
 def oess_query_vlan_availability(conn, sw, intf, vlan):
     query = "services/data.cgi?action=is_vlan_tag_available"
     query += "&node=%s&interface=%s&vlan=%s" % (sw, intf, vlan)
-    retval = yield http_query(conn, query)
+    retval = yield conn.query(query)
     defer.returnValue(retval)
 
 
 @defer.inlineCallbacks
-def oess_get_switch_ports(conn, node):
+def oess_get_switch_ports(conn, node, refresh=False):
     query = 'services/data.cgi?action=get_node_interfaces&node=%s' % node
-    retval = yield http_query(conn, query)
+    if refresh:
+        conn.invalidate(query)
+    retval = yield conn.query(query, CACHE_TTL)
     defer.returnValue(retval)
 
 
 @defer.inlineCallbacks
-def oess_get_workgroups(conn):
+def oess_get_workgroups(conn, refresh=False):
     query = 'services/data.cgi?action=get_workgroups'
-    retval = yield http_query(conn, query)
+    if refresh:
+        conn.invalidate(query)
+    retval = yield conn.query(query, CACHE_TTL)
     defer.returnValue(retval)
 
 
@@ -199,7 +209,7 @@ def oess_get_workgroups(conn):
 def oess_get_circuits(conn, workgroup_id):
     query = 'services/data.cgi?'
     query += 'action=get_existing_circuits&workgroup_id=%s' % workgroup_id
-    retval = yield http_query(conn, query)
+    retval = yield conn.query(query)
     defer.returnValue(retval)
 
 
@@ -218,11 +228,64 @@ def oess_cancel_circuit(conn, circuit_id, wg_id):
 # ********************************************************************************
 
 
+def gather(deferreds):
+    # run lookups concurrently, failing with the first error (rather than a FirstError)
+    def firstError(err):
+        err.trap(defer.FirstError)
+        return err.value.subFailure
+
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(firstError)
+    return d
+
+
 class UrlConnection(object):
 
     def __init__(self, url, auth):
         self.url = url
         self.auth = auth
+        self.clock = reactor # replaced when testing
+        self.cache = {}    # sub_path -> (expire time, result)
+        self.pending = {}  # sub_path -> [ deferred ], for queries in progress
+
+    def query(self, sub_path, ttl=None):
+        """
+        Query OESS. Identical queries made while one is in progress share its
+        result. If ttl (seconds) is given, the result is cached for that long.
+        """
+        if sub_path in self.cache:
+            expire_time, result = self.cache[sub_path]
+            if self.clock.seconds() < expire_time:
+                logging.debug("Cached result for %s", sub_path, system=LOG_SYSTEM)
+                return defer.succeed(result)
+            del self.cache[sub_path]
+
+        d = defer.Deferred()
+        if sub_path in self.pending:
+            logging.debug("Query for %s already in progress, waiting for it", sub_path, system=LOG_SYSTEM)
+            self.pending[sub_path].append(d)
+            return d
+
+        def gotResult(result):
+            waiters = self.pending.pop(sub_path)
+            if ttl and result is not None and not isinstance(result, failure.Failure):
+                self.cache[sub_path] = (self.clock.seconds() + ttl, result)
+            for wd in waiters:
+                if isinstance(result, failure.Failure):
+                    wd.errback(result)
+                else:
+                    wd.callback(result)
+
+        self.pending[sub_path] = [ d ]
+        http_query(self, sub_path).addBoth(gotResult)
+        return d
+
+    def invalidate(self, sub_path=None):
+        # remove a cached result, or all of them
+        if sub_path is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(sub_path, None)
 
 
 class OessSetup(object):
@@ -238,64 +301,59 @@ class OessSetup(object):
         self.conn = UrlConnection(self.url, self.auth)
 
     @defer.inlineCallbacks
-    def oess_provisioning(self, src_interface, dst_interface):
-        log.msg("Provisioning OESS circuit... ", system=LOG_SYSTEM)
+    def _getWorkgroupId(self):
+        wg_ids = yield oess_get_workgroups(self.conn)
         try:
-            log.msg("01 - Getting All OESS Workgroup' Workgroup_IDs",
-                    debug=True, system=LOG_SYSTEM)
-            wg_ids = yield oess_get_workgroups(self.conn)
+            workgroup_id = oess_get_workgroup_id(wg_ids, self.workgroup)
+        except Exception:
+            # workgroups are cached, so check with OESS before giving up
+            wg_ids = yield oess_get_workgroups(self.conn, refresh=True)
+            workgroup_id = oess_get_workgroup_id(wg_ids, self.workgroup)
+        self.workgroup_id = workgroup_id
+        defer.returnValue(workgroup_id)
 
-            log.msg("02 - Getting our Group's ID",
-                    debug = True, system=LOG_SYSTEM)
-            self.workgroup_id = oess_get_workgroup_id(wg_ids, self.workgroup)
+    @defer.inlineCallbacks
+    def _validatePort(self, sw, intf):
+        switch_interfaces = yield oess_get_switch_ports(self.conn, sw)
+        try:
+            oess_validate_ports(switch_interfaces, intf)
+        except Exception:
+            # switch ports are cached, so check with OESS before giving up
+            switch_interfaces = yield oess_get_switch_ports(self.conn, sw, refresh=True)
+            oess_validate_ports(switch_interfaces, intf)
 
-            log.msg("03 - Getting source switch, interface and VLAN from src_interface",
-                    debug=True, system=LOG_SYSTEM)
+    @defer.inlineCallbacks
+    def oess_provisioning(self, src_interface, dst_interface):
+        log.msg("Provisioning OESS circuit... ", system=LOG_SYSTEM)
+        try:
+            logging.debug("01 - Getting source and destination switch, interface and VLAN",
+                    system=LOG_SYSTEM)
             s_sw, s_int, s_vlan = oess_get_port_vlan(src_interface)
-
-            log.msg("04 - Querying for all interfaces of the source switch",
-                    debug=True, system=LOG_SYSTEM)
-            s_switch_interfaces = yield oess_get_switch_ports(self.conn, s_sw)
-
-            log.msg("05 - Validating switch_interfaces with interface provided",
-                    debug=True, system=LOG_SYSTEM)
-            oess_validate_ports(s_switch_interfaces, s_int)
-
-            log.msg("06 - Verifying if source VLAN is available",
-                    debug=True, system=LOG_SYSTEM)
-            is_available = yield oess_query_vlan_availability(self.conn, s_sw, s_int, s_vlan)
-            oess_confirm_vlan_availability(is_available, s_vlan)
-
-            log.msg("07 - Get destination switch, interface and VLAN from dst_interface",
-                    debug=True, system=LOG_SYSTEM)
             d_sw, d_int, d_vlan = oess_get_port_vlan(dst_interface)
 
-            log.msg("08 - Querying for all interfaces of the destination switch",
-                    debug=True, system=LOG_SYSTEM)
-            d_switch_interfaces = yield oess_get_switch_ports(self.conn, d_sw)
-
-            log.msg("09 - Validating switch_interfaces with interface provided",
-                    debug=True, system=LOG_SYSTEM)
-            oess_validate_ports(d_switch_interfaces, d_int)
-
-            log.msg("10 - Verifying if destination VLAN is available",
-                    debug=True, system=LOG_SYSTEM)
-            is_available = yield oess_query_vlan_availability(self.conn, d_sw, d_int, d_vlan)
-            oess_confirm_vlan_availability(is_available, d_vlan)
-
-            log.msg("11 - Querying for primary path",
-                    debug=True, system=LOG_SYSTEM)
-            p_path = yield oess_get_path(self.conn, s_sw, d_sw)
+            logging.debug("02 - Getting our Group's ID, validating interfaces, verifying VLAN availability and querying for primary path",
+                    system=LOG_SYSTEM)
+            # these are independent, so they are done at the same time
+            workgroup_id, _, _, s_available, d_available, p_path = yield gather( [
+                    self._getWorkgroupId(),
+                    self._validatePort(s_sw, s_int),
+                    self._validatePort(d_sw, d_int),
+                    oess_query_vlan_availability(self.conn, s_sw, s_int, s_vlan),
+                    oess_query_vlan_availability(self.conn, d_sw, d_int, d_vlan),
+                    oess_get_path(self.conn, s_sw, d_sw) ] )
+
+            oess_confirm_vlan_availability(s_available, s_vlan)
+            oess_confirm_vlan_availability(d_available, d_vlan)
             primary = oess_process_path(p_path)
 
-            log.msg("12 - Querying for backup path",
-                    debug=True, system=LOG_SYSTEM)
+            logging.debug("03 - Querying for backup path",
+                    system=LOG_SYSTEM)
             b_path = yield oess_get_path(self.conn, s_sw, d_sw, primary)
             backup = oess_process_path(b_path)
 
-            log.msg("13 - Provisioning circuit...",
-                    debug=True, system=LOG_SYSTEM)
-            result = yield oess_provision_circuit(self.conn, self.workgroup_id,
+            logging.debug("04 - Provisioning circuit...",
+                    system=LOG_SYSTEM)
+            result = yield oess_provision_circuit(self.conn, workgroup_id,
                                                   s_sw, s_int, s_vlan,
                                                   d_sw, d_int, d_vlan,
                                                   primary, backup)
@@ -313,18 +371,19 @@ class OessSetup(object):
     def oess_circuit_removal(self, src_interface, dst_interface):
         log.msg("Removing OESS circuit", system=LOG_SYSTEM)
         try:
-            log.msg("01 - Getting list of circuits", debug=True, system=LOG_SYSTEM)
-            circuits = yield oess_get_circuits(self.conn, self.workgroup_id)
+            logging.debug("01 - Getting list of circuits", system=LOG_SYSTEM)
+            workgroup_id = yield self._getWorkgroupId()
+            circuits = yield oess_get_circuits(self.conn, workgroup_id)
 
-            log.msg("02 - Getting Circuit ID", debug=True, system=LOG_SYSTEM)
+            logging.debug("02 - Getting Circuit ID", system=LOG_SYSTEM)
             circuit_id = oess_get_circuit_id(circuits, src_interface, dst_interface)
 
             if not circuit_id:
-                log.msg("OESS circuit not found!", debug=True, system=LOG_SYSTEM)
+                logging.debug("OESS circuit not found!", system=LOG_SYSTEM)
             else:
-                log.msg("03 - Cancelling Circuit ID", debug=True, system=LOG_SYSTEM)
+                logging.debug("03 - Cancelling Circuit ID", system=LOG_SYSTEM)
                 result = yield oess_cancel_circuit(self.conn, str(circuit_id),
-                                                   self.workgroup_id)
+                                                   workgroup_id)
                 try:
                     try:
                         result = json.loads(result)
@@ -386,7 +445,7 @@ class OESSConnectionManager:
         return True
 
     def setupLink(self, connection_id, source_target, dest_target, bandwidth):
-        log.msg('OESS: setupLink', debug=True, system=self.log_system)
+        logging.debug('OESS: setupLink', system=self.log_system)
         self.oess_conn.setupLink(source_target, dest_target)
         log.msg('Link %s -> %s up' % (source_target, dest_target),
                 system=self.log_system)
@@ -410,7 +469,7 @@ def OESSBackend(network_name, nrm_ports, parent_requester, cfg):
     """
     OESS Backend definition
     """
-    log.msg('OESS: OESSBackend', debug=True, system=LOG_SYSTEM)
+    logging.debug('OESS: OESSBackend', system=LOG_SYSTEM)
     name = 'OESS NRM %s' % network_name
     # for the generic backend
     nrm_map = dict([(p.name, p) for p in nrm_ports])
@@ -10,7 +10,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, logging
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'opennsa.pica8ovs'
@@ -82,7 +82,7 @@ class SSHChannel(ssh.SSHChannel):
             self.write(COMMAND_ECHO + LT)
             yield d
 
-            log.msg('Ready', debug=True, system=LOG_SYSTEM)
+            logging.debug('Ready', system=LOG_SYSTEM)
 
             for cmd in commands:
                 log.msg('CMD> %s' % cmd, system=LOG_SYSTEM)
@@ -137,33 +137,23 @@ class SSHChannel(ssh.SSHChannel):
 class Pica8OVSCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, db_ip):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, db_ip,
+                 max_channels=ssh.MAX_CHANNELS):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
+        self.connection_pool = ssh.SSHConnectionPool(ssh_connection_creator, max_channels)
         self.db_ip = db_ip
 
         log.msg('SSH connection arguments %s, %s, %s, %s, %s, %s' % (host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path), system=LOG_SYSTEM)
 
 
-    @defer.inlineCallbacks
     def _sendCommands(self, commands):
 
-        log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
-
-        try:
-            ssh_channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(ssh_channel)
-            yield ssh_channel.channel_open
-            yield ssh_channel.sendCommands(commands)
-            # not a yield, just being nice
-            ssh_channel.loseConnection()
+        def gotChannel(ssh_channel):
+            return ssh_channel.sendCommands(commands)
 
-        finally:
-            # twisted/os will flush data, before closing
-            ssh_connection.transport.loseConnection()
+        return self.connection_pool.withChannel(SSHChannel, gotChannel)
 
 
     def setupLink(self, source_target, dest_target):
@@ -197,10 +187,10 @@ class Pica8OVSTarget(object):
 
 class Pica8OVSConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip, max_channels=ssh.MAX_CHANNELS):
 
         self.port_map = port_map
-        self.command_sender = Pica8OVSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip)
+        self.command_sender = Pica8OVSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip, max_channels)
 
 
     def getResource(self, port, label):
@@ -261,6 +251,7 @@ def Pica8OVSBackend(network_name, nrm_ports, parent_requester, cfg):
     ssh_public_key   = cfg[config.PICA8OVS_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.PICA8OVS_SSH_PRIVATE_KEY]
     db_ip            = cfg[config.PICA8OVS_DB_IP]
+    max_channels     = int(cfg.get(config.SSH_CHANNELS, ssh.MAX_CHANNELS))
 
-    cm = Pica8OVSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip)
+    cm = Pica8OVSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip, max_channels)
     return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
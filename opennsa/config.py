@@ -15,6 +15,9 @@ from opennsa import constants as cnt
 # defaults
 DEFAULT_CONFIG_FILE     = '/etc/opennsa.conf'
 DEFAULT_LOG_FILE        = '/var/log/opennsa.log'
+DEFAULT_LOG_FORMAT      = 'text'
+DEFAULT_UPDATE_WINDOW   = 2 # seconds
+DEFAULT_RETRY_DEADLINE  = 30 # seconds
 DEFAULT_TLS             = 'true'
 DEFAULT_TOPOLOGY_FILE   = '/usr/local/share/nsi/topology.owl'
 DEFAULT_TCP_PORT        = 9080
@@ -41,6 +44,7 @@ BLOCK_CUSTOM_BACKEND = 'custombackend'
 # service block
 NETWORK_NAME     = 'network'     # mandatory
 LOG_FILE         = 'logfile'
+LOG_FORMAT       = 'logformat'
 HOST             = 'host'
 PORT             = 'port'
 TLS              = 'tls'
@@ -50,6 +54,12 @@ PEERS            = 'peers'
 POLICY           = 'policy'
 PLUGIN           = 'plugin'
 SERVICE_ID_START = 'serviceid_start'
+UPDATE_WINDOW    = 'update_window'
+RETRY_DEADLINE   = 'retry_deadline'
+
+# log formats
+LOG_FORMAT_TEXT         = 'text'
+LOG_FORMAT_JSON         = 'json'
 
 # database
 DATABASE                = 'database'    # mandatory
@@ -75,6 +85,10 @@ _SSH_PRIVATE_KEY        = 'privatekey'
 
 AS_NUMBER              = 'asnumber'
 
+# generic backend options (can be used in all backend blocks)
+RESTORE_CONCURRENCY    = 'restoreconcurrency'
+SSH_CHANNELS           = 'sshchannels' # ssh based backends only
+
 # TODO: Don't do backend specifics for everything, it causes confusion, and doesn't really solve anything
 
 # juniper block - same for mx / ex backends
@@ -117,6 +131,7 @@ PICA8OVS_DB_IP               = 'dbip'
 NCS_SERVICES_URL        = 'url'
 NCS_USER                = 'user'
 NCS_PASSWORD            = 'password'
+NCS_BATCH_WINDOW        = 'batchwindow'
 
 # JUNOS block
 JUNOS_HOST                = _SSH_HOST
@@ -193,6 +208,34 @@ def readVerifyConfig(cfg):
     except ConfigParser.NoOptionError:
         vc[LOG_FILE] = DEFAULT_LOG_FILE
 
+    try:
+        log_format = cfg.get(BLOCK_SERVICE, LOG_FORMAT)
+        if not log_format in (LOG_FORMAT_TEXT, LOG_FORMAT_JSON):
+            raise ConfigurationError('Invalid log format: %s (must be %s or %s)' % (log_format, LOG_FORMAT_TEXT, LOG_FORMAT_JSON))
+        vc[LOG_FORMAT] = log_format
+    except ConfigParser.NoOptionError:
+        vc[LOG_FORMAT] = DEFAULT_LOG_FORMAT
+
+    try:
+        update_window = cfg.getfloat(BLOCK_SERVICE, UPDATE_WINDOW)
+        if update_window < 0:
+            raise ConfigurationError('Invalid update window: %s (must be zero or positive)' % update_window)
+        vc[UPDATE_WINDOW] = update_window
+    except ConfigParser.NoOptionError:
+        vc[UPDATE_WINDOW] = DEFAULT_UPDATE_WINDOW
+    except ValueError:
+        raise ConfigurationError('Invalid update window: %s (must be a number)' % cfg.get(BLOCK_SERVICE, UPDATE_WINDOW))
+
+    try:
+        retry_deadline = cfg.getfloat(BLOCK_SERVICE, RETRY_DEADLINE)
+        if retry_deadline < 0:
+            raise ConfigurationError('Invalid retry deadline: %s (must be zero or positive)' % retry_deadline)
+        vc[RETRY_DEADLINE] = retry_deadline
+    except ConfigParser.NoOptionError:
+        vc[RETRY_DEADLINE] = DEFAULT_RETRY_DEADLINE
+    except ValueError:
+        raise ConfigurationError('Invalid retry deadline: %s (must be a number)' % cfg.get(BLOCK_SERVICE, RETRY_DEADLINE))
+
     try:
         nrm_map_file = cfg.get(BLOCK_SERVICE, NRM_MAP_FILE)
         if not os.path.exists(nrm_map_file):
@@ -230,7 +273,7 @@ def readVerifyConfig(cfg):
     try:
         policies = cfg.get(BLOCK_SERVICE, POLICY).split(',')
         for policy in policies:
-            if not policy in (cnt.REQUIRE_USER, cnt.REQUIRE_TRACE, cnt.AGGREGATOR, cnt.ALLOW_HAIRPIN):
+            if not policy in (cnt.REQUIRE_USER, cnt.REQUIRE_TRACE, cnt.AGGREGATOR, cnt.ALLOW_HAIRPIN, cnt.ALTERNATE_PATH):
                 raise ConfigurationError('Invalid policy: %s' % policy)
         vc[POLICY] = policies
     except ConfigParser.NoOptionError:
@@ -46,4 +46,5 @@ REQUIRE_USER        = 'requireuser'
 REQUIRE_TRACE       = 'requiretrace'
 AGGREGATOR          = 'aggregator'
 ALLOW_HAIRPIN       = 'allowhairpin'
+ALTERNATE_PATH      = 'alternatepath'
 
@@ -11,6 +11,7 @@ Copyright: NORDUnet (2011-2013)
 
 import datetime
 
+from twisted.internet import defer
 from twisted.enterprise import adbapi
 
 from psycopg2.extensions import adapt, register_adapter, AsIs
@@ -128,5 +129,33 @@ def getBackendConnectionId():
 
 
 
+
+def getDataPlaneStatus(service_connection_keys):
+    """
+    Get the aggregated data plane status for a number of service connections,
+    using a single query over the sub connections.
+
+    Returns a deferred, which fires with a dict of service connection key ->
+    (active, version, consistent). Connections without any sub connections
+    gets (False, 0, False).
+    """
+    keys = tuple(set(service_connection_keys))
+    status = dict( (key, (False, 0, False)) for key in keys )
+    if not keys:
+        return defer.succeed(status)
+
+    # null consistency counts as inconsistent (bool_and ignores nulls)
+    query = 'SELECT service_connection_id, bool_and(data_plane_active), max(data_plane_version), bool_and(coalesce(data_plane_consistent, false)) ' + \
+            'FROM %s WHERE service_connection_id IN %%s GROUP BY service_connection_id;' % SubConnection.tablename()
+
+    def gotResult(rows):
+        for key, active, version, consistent in rows:
+            status[key] = (active, version or 0, consistent) # version can be None
+        return status
+
+    return Registry.DBPOOL.runQuery(query, (keys,)).addCallback(gotResult)
+
+
+
 Registry.register(ServiceConnection, SubConnection)
 
@@ -2,6 +2,8 @@
 
 from xml.etree import ElementTree as ET
 
+from opennsa.shared import xmlhelper
+
 # types
 
 class InterfaceType(object):
@@ -155,7 +157,7 @@ nml_topology = ET.QName('{%s}Topology'   % NML_NS)
 
 def parse(input_):
 
-    root = ET.fromstring(input_)
+    root = xmlhelper.parseXML(input_)
 
     return parseElement(root)
 
@@ -1,10 +1,20 @@
 # Fetches discovory documents from other nsas
+#
+# Each peer is polled on its own schedule. The poll interval is reset when the
+# document of the peer changes, and doubles (up to a maximum) when it does not
+# change or cannot be fetched, with some jitter so peers do not get polled in
+# lockstep. Conditional requests (ETag / Last-Modified) are used to avoid
+# transferring unchanged documents, and documents are only parsed if their
+# content has changed.
+
+import random
+import hashlib
 
 from twisted.python import log
-from twisted.internet import defer, task, reactor
+from twisted.internet import defer, reactor
 from twisted.application import service
 
-from opennsa import nsa, constants as cnt
+from opennsa import nsa, constants as cnt, logging
 from opennsa.protocols.shared import httpclient
 from opennsa.discovery.bindings import discovery
 from opennsa.topology.nmlxml import _baseName # nasty but I need it
@@ -15,6 +25,35 @@ LOG_SYSTEM = 'discovery.Fetcher'
 # Exponenetial backoff (x2) is used, for fetch intervals
 FETCH_INTERVAL_MIN = 10 # seconds
 FETCH_INTERVAL_MAX = 3600 # seconds - 3600 seconds = 1 hour
+FETCH_JITTER       = 0.1  # intervals are randomized +/- 10%
+
+ETAG               = 'ETag'
+LAST_MODIFIED      = 'Last-Modified'
+IF_NONE_MATCH      = 'If-None-Match'
+IF_MODIFIED_SINCE  = 'If-Modified-Since'
+
+
+
+class PeerState(object):
+    """
+    Fetch state for a single peer.
+    """
+    def __init__(self, peer):
+        self.peer = peer
+        self.interval = FETCH_INTERVAL_MIN // 2 # doubled after the first fetch
+        self.etag = None
+        self.last_modified = None
+        self.document_hash = None
+        self.call = None # pending fetch
+
+
+    def requestHeaders(self):
+        headers = {}
+        if self.etag:
+            headers[IF_NONE_MATCH] = self.etag
+        if self.last_modified:
+            headers[IF_MODIFIED_SINCE] = self.last_modified
+        return headers
 
 
 
@@ -30,40 +69,83 @@ class FetcherService(service.Service):
         self.provider_registry = provider_registry
         self.ctx_factory = ctx_factory
 
-        self.call = task.LoopingCall(self.fetchDocuments)
+        self.peer_states = [ PeerState(peer) for peer in peers ]
+        self.clock = reactor # replaced when testing
 
 
     def startService(self):
-        # we use half, as it is doubled on first run
-        reactor.callWhenRunning(self.call.start, FETCH_INTERVAL_MIN // 2)
+        log.msg('Fetching documents from %i peers.' % len(self.peers), system=LOG_SYSTEM)
+        for ps in self.peer_states:
+            self._scheduleFetch(ps, 0)
         service.Service.startService(self)
 
 
     def stopService(self):
-        self.call.stop()
+        for ps in self.peer_states:
+            if ps.call is not None and ps.call.active():
+                ps.call.cancel()
+            ps.call = None
         service.Service.stopService(self)
 
 
+    def _scheduleFetch(self, peer_state, delay):
+        peer_state.call = self.clock.callLater(delay, self.fetchDocument, peer_state)
+
+
     def fetchDocuments(self):
-        log.msg('Fetching %i documents.' % len(self.peers), system=LOG_SYSTEM)
+        # fetch all documents now, the regular schedule for each peer continues afterwards
+        return defer.DeferredList( [ self.fetchDocument(ps) for ps in self.peer_states ] )
+
+
+    def fetchDocument(self, peer_state):
+
+        if peer_state.call is not None and peer_state.call.active():
+            peer_state.call.cancel()
+        peer_state.call = None
+
+        peer = peer_state.peer
+        logging.debug('Fetching %s', peer.url, system=LOG_SYSTEM)
+
+        def gotResponse( (response, data) ):
+            if response.code == 304:
+                logging.debug('NSA description from %s not modified', peer.url, system=LOG_SYSTEM)
+                return False
+
+            peer_state.etag          = (response.headers.getRawHeaders(ETAG) or [ None ])[0]
+            peer_state.last_modified = (response.headers.getRawHeaders(LAST_MODIFIED) or [ None ])[0]
+
+            document_hash = hashlib.sha1(data).digest()
+            if document_hash == peer_state.document_hash:
+                logging.debug('NSA description from %s unchanged (%i bytes)', peer.url, len(data), system=LOG_SYSTEM)
+                return False
+
+            peer_state.document_hash = document_hash
+            self.gotDocument(data, peer)
+            return True
 
-        defs = []
-        for peer in self.peers:
-            log.msg('Fetching %s' % peer.url, debug=True, system=LOG_SYSTEM)
-            d = httpclient.httpRequest(peer.url, '', {}, 'GET', timeout=10, ctx_factory=self.ctx_factory)
-            d.addCallbacks(self.gotDocument, self.retrievalFailed, callbackArgs=(peer,), errbackArgs=(peer,))
-            defs.append(d)
+        def fetchFailed(err):
+            # next request should get the full document
+            peer_state.etag = peer_state.last_modified = peer_state.document_hash = None
+            self.retrievalFailed(err, peer)
+            return False
 
-        def updateInterval(passthrough):
-            self.call.interval = min(self.call.interval * 2, FETCH_INTERVAL_MAX)
-            return passthrough
+        def scheduleNext(changed):
+            if changed:
+                peer_state.interval = FETCH_INTERVAL_MIN
+            else:
+                peer_state.interval = min(peer_state.interval * 2, FETCH_INTERVAL_MAX)
+            if self.running:
+                delay = peer_state.interval * random.uniform(1 - FETCH_JITTER, 1 + FETCH_JITTER)
+                self._scheduleFetch(peer_state, delay)
 
-        if defs:
-            return defer.DeferredList(defs).addBoth(updateInterval)
+        d = httpclient.httpRequest(peer.url, '', peer_state.requestHeaders(), 'GET', timeout=10, ctx_factory=self.ctx_factory, full_response=True)
+        d.addCallbacks(gotResponse, fetchFailed)
+        d.addCallback(scheduleNext)
+        return d
 
 
     def gotDocument(self, result, peer):
-        log.msg('Got NSA description from %s (%i bytes)' % (peer.url, len(result)), debug=True, system=LOG_SYSTEM)
+        logging.debug('Got NSA description from %s (%i bytes)', peer.url, len(result), system=LOG_SYSTEM)
         try:
             nsa_description = discovery.parse(result)
 
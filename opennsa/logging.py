@@ -6,6 +6,9 @@ Copyright: NORDUnet (2011-2012)
 """
 
 import time
+import json
+import Queue
+import threading
 
 from zope.interface import implements
 
@@ -15,6 +18,52 @@ from twisted.python import log
 # almost iso, we dump the T in the middle (makes it more tricky to read imho)
 TIME_FORMAT = "%Y-%m-%d %H:%M:%SZ"
 
+# Enabled log categories for debug() and payload(). Messages in a disabled
+# category are dropped before they are formatted, which matters for payloads
+# (can be several hundred KB). Set with configure().
+DEBUG   = False
+PAYLOAD = False
+
+# json log observer
+QUEUE_SIZE      = 10000 # max number of records waiting to be written, records are dropped if exceeded
+BATCH_SIZE      = 500   # max number of records written at once
+
+# event fields which are included in json records (if set), e.g., log.msg('...', connection_id=cid)
+RECORD_FIELDS   = ('connection_id',)
+# nsi header attributes included in json records, for events with a header, e.g., log.msg('...', header=header)
+HEADER_FIELDS   = ('correlation_id', 'requester_nsa', 'provider_nsa')
+
+_STOP           = object() # writer thread stop marker
+
+
+
+def configure(debug=False, payload=False):
+    """
+    Enable or disable the debug and payload log categories. Observers only
+    filter events, so this must be called for debug() and payload() to log.
+    """
+    global DEBUG, PAYLOAD
+    DEBUG   = debug
+    PAYLOAD = payload
+
+
+def debug(message, *args, **kwargs):
+    """
+    Log a debug message. The message is only formatted (message % args) if
+    debug logging is enabled. Keyword arguments are passed on to log.msg.
+    """
+    if DEBUG:
+        log.msg(message % args if args else message, debug=True, **kwargs)
+
+
+def payload(message, *args, **kwargs):
+    """
+    Log a message containing a payload. The message is only formatted
+    (message % args) if payload logging is enabled.
+    """
+    if PAYLOAD:
+        log.msg(message % args if args else message, payload=True, **kwargs)
+
 
 
 class DebugLogObserver(log.FileLogObserver):
@@ -37,12 +86,133 @@ class DebugLogObserver(log.FileLogObserver):
 
     def emit(self, eventDict):
 
-        if self.debug is False and eventDict.get('debug', False):
-            pass # don't print debug messages if we didn't ask for it
-        elif self.profile is False and eventDict.get('profile', False):
-            pass # don't print profile messages if we didn't ask for it
-        elif self.payload is False and eventDict.get('payload', False):
-            pass # don't print payload message if we didn't ask for it
+        if _suppressed(self, eventDict):
+            pass
         else:
             log.FileLogObserver.emit(self, eventDict)
 
+
+
+class JSONLogObserver(object):
+    """
+    Log observer writing events as JSON records, one per line. Fields in
+    RECORD_FIELDS are included in the record if they are set in the event,
+    and HEADER_FIELDS are taken from the NSI header of the event, if any.
+
+    Records are written by a background thread, so a slow disk does not stall
+    the reactor. Records are handed to the writer through a bounded queue. If
+    the queue is full, the record is dropped and counted instead of blocking,
+    and the writer logs the number of dropped records.
+
+    The writer must be started with start() (after daemonizing, as threads do
+    not survive a fork), and stop() writes out outstanding records.
+    """
+    implements(log.ILogObserver)
+
+    def __init__(self, file_, debug=False, profile=False, payload=False, queue_size=QUEUE_SIZE):
+        self.file_ = file_
+        self.debug = debug
+        self.profile = profile
+        self.payload = payload
+
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0 # only updated from the emitting thread
+        self.writer = None
+
+
+    def start(self):
+        self.writer = threading.Thread(target=self._writeRecords, name='JSONLogWriter')
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def stop(self):
+        if self.writer is not None:
+            self.queue.put(_STOP)
+            self.writer.join()
+            self.writer = None
+
+
+    def emit(self, eventDict):
+
+        if _suppressed(self, eventDict):
+            return
+
+        text = log.textFromEventDict(eventDict)
+        if text is None:
+            return
+
+        record = { 'time': eventDict['time'], 'system': eventDict['system'], 'message': text }
+        if eventDict['isError']:
+            record['error'] = True
+        for field in RECORD_FIELDS:
+            value = eventDict.get(field)
+            if value is not None:
+                record[field] = value
+        header = eventDict.get('header')
+        if header is not None:
+            for field in HEADER_FIELDS:
+                value = getattr(header, field, None)
+                if value is not None:
+                    record[field] = value
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+    def _formatRecord(self, record):
+        t = record['time']
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)) + '.%03iZ' % (t % 1 * 1000)
+        try:
+            return json.dumps(record, default=str)
+        except UnicodeDecodeError:
+            # non-utf8 data in the message, escape it rather than losing the record
+            record['message'] = repr(record['message'])
+            return json.dumps(record, default=repr)
+
+
+    def _writeRecords(self):
+        # runs in the writer thread
+
+        reported = 0
+        while True:
+            records = [ self.queue.get() ]
+            try:
+                while len(records) < BATCH_SIZE:
+                    records.append( self.queue.get_nowait() )
+            except Queue.Empty:
+                pass
+
+            lines = [ self._formatRecord(r) for r in records if r is not _STOP ]
+
+            dropped = self.dropped
+            if dropped > reported:
+                msg = '%i log record(s) dropped, log queue full' % (dropped - reported)
+                lines.append( self._formatRecord({ 'time': time.time(), 'system': 'opennsa.Logging', 'message': msg, 'dropped': dropped }) )
+                reported = dropped
+
+            if lines:
+                try:
+                    self.file_.write('\n'.join(lines) + '\n')
+                    self.file_.flush()
+                except (IOError, OSError):
+                    pass # nowhere to log this, and retrying would just make the queue fill up
+
+            if any(r is _STOP for r in records):
+                return
+
+
+
+def _suppressed(observer, eventDict):
+
+    if observer.debug is False and eventDict.get('debug', False):
+        return True # don't print debug messages if we didn't ask for it
+    elif observer.profile is False and eventDict.get('profile', False):
+        return True # don't print profile messages if we didn't ask for it
+    elif observer.payload is False and eventDict.get('payload', False):
+        return True # don't print payload message if we didn't ask for it
+    else:
+        return False
+
@@ -50,7 +50,14 @@ class PrunerPlugin(BasePlugin):
 
 
     def prunePaths(self, paths):
-        pruned_paths = [ pruneLabels(paths[0]) ]
+        # paths that cannot be pruned are dropped, unless it is all of them
+        pruned_paths = []
+        for path in paths:
+            try:
+                pruned_paths.append( pruneLabels(path) )
+            except nsa.EmptyLabelSet:
+                if not pruned_paths and path is paths[-1]:
+                    raise
         return defer.succeed(pruned_paths)
 
 
@@ -2,6 +2,8 @@
 
 from xml.etree import ElementTree as ET
 
+from opennsa.shared import xmlhelper
+
 # types
 
 class DataPlaneStatusType(object):
@@ -912,7 +914,7 @@ reservation = ET.QName('http://schemas.ogf.org/nsi/2013/12/connection/types', 'r
 
 def parse(input_):
 
-    root = ET.fromstring(input_)
+    root = xmlhelper.parseXML(input_)
 
     return parseElement(root)
 
@@ -2,6 +2,8 @@
 
 from xml.etree import ElementTree as ET
 
+from opennsa.shared import xmlhelper
+
 # types
 
 
@@ -221,7 +223,7 @@ ConnectionTrace     = ET.QName(GNS_NAMESPACE, 'ConnectionTrace')
 
 def parse(input_):
 
-    root = ET.fromstring(input_)
+    root = xmlhelper.parseXML(input_)
     return parseElement(root)
 
 
@@ -2,6 +2,8 @@
 
 from xml.etree import ElementTree as ET
 
+from opennsa.shared import xmlhelper
+
 # types
 
 class OrderedStpType(object):
@@ -86,7 +88,7 @@ parameter   = ET.QName(POINT2POINT_NS, 'parameter')
 
 def parse(input_):
 
-    root = ET.fromstring(input_)
+    root = xmlhelper.parseXML(input_)
 
     return parseElement(root)
 
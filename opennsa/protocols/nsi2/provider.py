@@ -16,7 +16,6 @@ PROVISION_RESPONSE      = 'provision_response'
 RELEASE_RESPONSE        = 'release_response'
 TERMINATE_RESPONSE      = 'terminate_response'
 
-QUERY_SUMMARY_RESPONSE  = 'query_summary_response'
 QUERY_RECURSIVE_RESPONSE = 'query_recursive_response'
 
 
@@ -188,19 +187,13 @@ class Provider:
         return self.service_provider.querySummary(header, connection_ids, global_reservation_ids)
 
 
-    def querySummarySync(self, header, connection_ids, global_reservation_ids, request_info):
+    def querySummaryStream(self, header, connection_ids, global_reservation_ids, page_callback, request_info):
+        # sync query summary, where the result is delivered to page_callback one page at a time, see Aggregator.querySummaryPages
 
-        if not header.reply_to:
-            raise ValueError('Cannot perform querySummary request without a replyTo field in the header')
         if not header.correlation_id:
             raise ValueError('Cannot perform querySummary request without a correlationId field in the header')
 
-        dc = defer.Deferred()
-        self.notifications[(header.correlation_id, QUERY_SUMMARY_RESPONSE)] = dc
-
-        # returns a deferred, but we don't use it (indicates message receival only), should it be chained?
-        self.service_provider.querySummary(header, connection_ids, global_reservation_ids, request_info)
-        return dc
+        return self.service_provider.querySummaryPages(header, connection_ids, global_reservation_ids, page_callback, request_info)
 
 
     def querySummaryConfirmed(self, header, reservations):
@@ -209,11 +202,7 @@ class Provider:
             log.msg('No reply url to notify about query summary. Skipping notification.', system=LOG_SYSTEM)
             return defer.succeed(None)
 
-        if (header.correlation_id, QUERY_SUMMARY_RESPONSE) in self.notifications:
-            dc = self.notifications.pop( (header.correlation_id, QUERY_SUMMARY_RESPONSE) )
-            dc.callback( reservations )
-        else:
-            return self.provider_client.querySummaryConfirmed(header.reply_to, header.requester_nsa, header.provider_nsa, header.correlation_id, reservations)
+        return self.provider_client.querySummaryConfirmed(header.reply_to, header.requester_nsa, header.provider_nsa, header.correlation_id, reservations)
 
 
     def queryRecursive(self, header, connection_ids, global_reservation_ids, request_info):
@@ -8,8 +8,10 @@ Copyright: NORDUnet (2011-2015)
 """
 
 import time
+from xml.etree import ElementTree as ET
 
 from twisted.python import log, failure
+from twisted.internet import defer
 
 from opennsa import nsa, error
 from opennsa.shared import xmlhelper
@@ -21,6 +23,8 @@ from opennsa.protocols.nsi2.bindings import actions, nsiconnection, p2pservices
 
 LOG_SYSTEM = 'NSI2.ProviderService'
 
+RESERVATIONS_MARKER = '__RESERVATIONS__'
+
 
 
 class ProviderService:
@@ -181,21 +185,38 @@ class ProviderService:
 
     def querySummarySync(self, soap_data, request_info):
 
-        def gotReservations(reservations, header):
-            # do reply inline
-            soap_header_element = helper.createProviderHeader(header.requester_nsa, header.provider_nsa, correlation_id=header.correlation_id)
-
-            qs_reservations = queryhelper.buildQuerySummaryResultType(reservations)
-
-            qsct = nsiconnection.QuerySummaryConfirmedType(qs_reservations)
-
-            payload = minisoap.createSoapPayload(qsct.xml(nsiconnection.querySummarySyncConfirmed), soap_header_element)
-            return payload
-
         header, query = helper.parseRequest(soap_data)
-        d = self.provider.querySummarySync(header, query.connectionId, query.globalReservationId, request_info)
-        d.addCallbacks(gotReservations, self._createSOAPFault, callbackArgs=(header,), errbackArgs=(header.provider_nsa,))
-        return d
+
+        # The reply is written one page of reservations at a time, so it is
+        # never build in memory. Everything up to and after the reservations is
+        # created from a payload without reservations, split at a marker.
+        soap_header_element = helper.createProviderHeader(header.requester_nsa, header.provider_nsa, correlation_id=header.correlation_id)
+        qsc_element = nsiconnection.QuerySummaryConfirmedType([]).xml(nsiconnection.querySummarySyncConfirmed)
+        qsc_element.text = RESERVATIONS_MARKER
+        payload_start, payload_end = minisoap.createSoapPayload(qsc_element, soap_header_element).split(RESERVATIONS_MARKER)
+
+        def produce(write):
+
+            def gotPage(reservations):
+                ready = None
+                if not written:
+                    ready = write(payload_start)
+                    written.append(True)
+                for qsrt in queryhelper.buildQuerySummaryResultType(reservations):
+                    ready = write( ET.tostring(qsrt.xml('reservation'), 'utf-8') )
+                return ready # next page is fetched when the client has caught up
+
+            def done(_):
+                if not written:
+                    write(payload_start)
+                write(payload_end)
+
+            written = []
+            d = defer.maybeDeferred(self.provider.querySummaryStream, header, query.connectionId, query.globalReservationId, gotPage, request_info)
+            d.addCallbacks(done, self._createSOAPFault, errbackArgs=(header.provider_nsa,))
+            return d
+
+        return soapresource.StreamingReply(produce)
 
 
     def queryRecursive(self, soap_data, request_info):
@@ -3,7 +3,7 @@ from zope.interface import implements
 from twisted.python import log, failure
 from twisted.internet import reactor, defer
 
-from opennsa import error
+from opennsa import error, logging
 from opennsa.interface import INSIProvider
 
 
@@ -77,7 +77,7 @@ class Requester:
 
         def reserveRequestFailed(err):
             # invocation failed, so we error out immediately
-            log.msg('Reserve invocation failed: %s' % err.getErrorMessage(), debug=True, system=LOG_SYSTEM)
+            logging.debug('Reserve invocation failed: %s', err.getErrorMessage(), system=LOG_SYSTEM)
             self.triggerCall(header.provider_nsa, header.correlation_id, RESERVE, err.value)
 
         rd = self.addCall(header.provider_nsa, header.correlation_id, RESERVE)
@@ -101,7 +101,7 @@ class Requester:
 
         def reserveCommitFailed(err):
             # invocation failed, so we error out immediately
-            log.msg('ReserveCommit invocation failed: %s' % err.getErrorMessage(), debug=True, system=LOG_SYSTEM)
+            logging.debug('ReserveCommit invocation failed: %s', err.getErrorMessage(), system=LOG_SYSTEM)
             self.triggerCall(header.provider_nsa, header.correlation_id, RESERVE_COMMIT, err.value)
 
         rd = self.addCall(header.provider_nsa, header.correlation_id, RESERVE_COMMIT)
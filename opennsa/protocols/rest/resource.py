@@ -59,8 +59,7 @@ def _createErrorResponse(err, request):
 
 
 
-@defer.inlineCallbacks
-def conn2dict(conn):
+def conn2dict(conn, data_plane_status):
 
     def label(label):
         if label is None:
@@ -80,24 +79,9 @@ def conn2dict(conn):
     d['reservation_state'] = conn.reservation_state
     d['provision_state']   = conn.provision_state
     d['lifecycle_state']   = conn.lifecycle_state
-
-    # this really needs to be in the database module (aggregator uses this too)
-    df = database.SubConnection.findBy(service_connection_id=conn.id)
-    sub_conns = yield df
-
-    # copied from aggregator, refactor sometime
-    if len(sub_conns) == 0: # apparently this can happen
-        data_plane_status = (False, 0, False)
-    else:
-        aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-        aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-        aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-        data_plane_status = (aggr_active, aggr_version, aggr_consistent)
-
     d['data_plane_active'] = conn.data_plane = data_plane_status[0]
 
-    #return d
-    defer.returnValue(d)
+    return d
 
 
 
@@ -122,11 +106,8 @@ class P2PBaseResource(resource.Resource):
 
         @defer.inlineCallbacks
         def gotConnections(conns):
-            res = []
-
-            for conn in conns:
-                d = yield conn2dict(conn)
-                res.append(d)
+            data_plane_statuses = yield database.getDataPlaneStatus( [ conn.id for conn in conns ] )
+            res = [ conn2dict(conn, data_plane_statuses[conn.id]) for conn in conns ]
 
             payload = json.dumps(res) + RN
 
@@ -277,7 +258,8 @@ class P2PConnectionResource(resource.Resource):
 
         @defer.inlineCallbacks
         def gotConnection(conn):
-            d = yield conn2dict(conn)
+            data_plane_statuses = yield database.getDataPlaneStatus( [ conn.id ] )
+            d = conn2dict(conn, data_plane_statuses[conn.id])
 
             payload = json.dumps(d) + RN
             _finishRequest(request, 200, payload)
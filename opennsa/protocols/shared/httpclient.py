@@ -5,17 +5,32 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
-from twisted.python import log
+from StringIO import StringIO
+
+from zope.interface import implementer
+
+from twisted.python import log, failure
 from twisted.internet import reactor, defer
+from twisted.internet.error import ConnectionClosed, ConnectionRefusedError, TimeoutError
 from twisted.web import client as twclient, http as twhttp
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
 from twisted.web.error import Error as WebError
-from twisted.internet.error import ConnectionClosed, ConnectionRefusedError
+
+from opennsa import logging
 
 
 LOG_SYSTEM = 'HTTPClient'
 
 DEFAULT_TIMEOUT = 30 # seconds
 
+# Requests are send over persistent connections, which are kept in a pool,
+# so the TCP and TLS handshakes can be skipped for most requests to a peer.
+PERSISTENT                  = True
+MAX_CONNECTIONS_PER_HOST    = 10 # concurrent requests to one host, further requests are queued
+MAX_PERSISTENT_PER_HOST     = 4  # idle connections kept open to one host
+CACHED_CONNECTION_TIMEOUT   = 4  # seconds, should be lower than the keep-alive timeout of peers (apache default is 5)
+
 
 
 class HTTPRequestError(Exception):
@@ -24,6 +39,159 @@ class HTTPRequestError(Exception):
     """
 
 
+
+@implementer(IPolicyForHTTPS)
+class _ContextFactoryPolicy(object):
+    # use the opennsa context factory for all hosts (twisted warns when giving it directly to the agent)
+
+    def __init__(self, ctx_factory):
+        self.ctx_factory = ctx_factory
+
+    def creatorForNetloc(self, hostname, port):
+        return self.ctx_factory
+
+
+
+class _HTTPConnectionPool(twclient.HTTPConnectionPool):
+
+    # twisted only retries idempotent requests without a body, _ConnectionPool retries all requests instead
+    retryAutomatically = False
+
+    def hasCachedConnection(self, key):
+        # the agent uses (scheme, host, port) as key, like the host locks
+        return bool(self._connections.get(key))
+
+
+
+def _connectionClosed(err):
+    # true if the request failed because the connection was closed before a reply was received
+    if not isinstance(err.value, (twclient.RequestNotSent, twclient.RequestTransmissionFailed, twclient.ResponseNeverReceived)):
+        return False
+    reasons = getattr(err.value, 'reasons', [])
+    return all( r.check(ConnectionClosed) for r in reasons )
+
+
+
+class _ConnectionPool(object):
+    """
+    Agent with persistent connection pool, and limit on concurrent requests per host.
+    One is created for each context factory, as connections cannot be shared between
+    different client certificates.
+    """
+    def __init__(self, ctx_factory):
+
+        self.pool = _HTTPConnectionPool(reactor, persistent=PERSISTENT)
+        self.pool.maxPersistentPerHost = MAX_PERSISTENT_PER_HOST
+        self.pool.cachedConnectionTimeout = CACHED_CONNECTION_TIMEOUT
+
+        if ctx_factory is None:
+            self.agent = twclient.Agent(reactor, pool=self.pool)
+        else:
+            self.agent = twclient.Agent(reactor, contextFactory=_ContextFactoryPolicy(ctx_factory), pool=self.pool)
+
+        self.host_locks = {} # (scheme, host, port) -> DeferredSemaphore
+
+
+    def _request(self, method, url, headers, payload):
+
+        def gotResponse(response):
+
+            def bodyError(err):
+                # no content-length and no chunking, the body ends when the connection closes
+                err.trap(twclient.PartialDownloadError)
+                return err.value.response
+
+            d = twclient.readBody(response)
+            d.addErrback(bodyError)
+            d.addCallback(lambda data : (response, data))
+            return d
+
+        body_producer = twclient.FileBodyProducer(StringIO(payload)) if payload else None
+
+        d = self.agent.request(method, url, headers, body_producer)
+        d.addCallback(gotResponse)
+        return d
+
+
+    def _requestRetry(self, method, url, headers, payload, key):
+        # a peer may close an idle connection just as a request is sent on it, so
+        # a request which fails like that on a reused connection is retried once,
+        # on a new connection (the closed one is not put back into the pool)
+
+        reused = self.pool.hasCachedConnection(key)
+
+        def requestFailed(err):
+            if reused and _connectionClosed(err):
+                log.msg('Reused connection to %s:%i was closed, retrying request on new connection' % (key[1], key[2]), system=LOG_SYSTEM)
+                return self._request(method, url, headers, payload)
+            return err
+
+        d = self._request(method, url, headers, payload)
+        d.addErrback(requestFailed)
+        return d
+
+
+    def request(self, method, url, headers, payload, key, timeout):
+        # returns a deferred firing with ( response, body )
+        # the timeout starts when the request is send, not while it is queued for the host
+
+        lock = self.host_locks.get(key)
+        if lock is None:
+            lock = self.host_locks[key] = defer.DeferredSemaphore(MAX_CONNECTIONS_PER_HOST)
+
+        def released(result):
+            if lock.tokens == lock.limit and not lock.waiting:
+                self.host_locks.pop(key, None)
+            return result
+
+        def issueRequest():
+
+            d = self._requestRetry(method, url, headers, payload, key)
+
+            timed_out = []
+            def requestTimeout():
+                timed_out.append(True)
+                d.cancel()
+
+            timeout_call = reactor.callLater(timeout, requestTimeout)
+
+            def requestDone(result):
+                if timeout_call.active():
+                    timeout_call.cancel()
+                if timed_out:
+                    log.msg('Request to %s timed out after %i seconds' % (url, timeout), system=LOG_SYSTEM)
+                    return failure.Failure( TimeoutError('Request to %s timed out' % url) )
+                return result
+
+            d.addBoth(requestDone)
+            return d
+
+        # the body is read while holding the lock, so the connection is back in the pool when the next request starts
+        d = lock.run(issueRequest)
+        d.addBoth(released)
+        return d
+
+
+
+_pools = {} # ctx factory -> _ConnectionPool, None is used for plain http
+
+def _getPool(ctx_factory):
+    pool = _pools.get(ctx_factory)
+    if pool is None:
+        pool = _pools[ctx_factory] = _ConnectionPool(ctx_factory)
+    return pool
+
+
+def closeCachedConnections():
+    """
+    Close all idle persistent connections. Returns a deferred, which fires when they are closed.
+    """
+    pools = _pools.values()
+    _pools.clear()
+    return defer.DeferredList( [ p.pool.closeCachedConnections() for p in pools ] )
+
+
+
 def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_factory=None, headers=None):
 
     if not headers:
@@ -36,9 +204,17 @@ def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_fa
 
 
 
-def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
-    # copied from twisted.web.client in order to get access to the
-    # factory (which contains response codes, headers, etc)
+def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None, full_response=False):
+    """
+    Perform a http(s) request. Returns a deferred, which fires with the body
+    of the response for a 2xx status, and errbacks with a
+    twisted.web.error.Error (with status and response body) for other statuses.
+
+    If full_response is True, the deferred fires with (response, body) instead,
+    where response is the twisted.web.client response (code, headers). A 304
+    (not modified) reply is considered a success in this case, as it is the
+    expected outcome of a conditional request.
+    """
 
     if type(url) is not str:
         e = HTTPRequestError('URL must be string, not %s' % type(url))
@@ -48,7 +224,7 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
         e = HTTPRequestError('URL does not start with http (URL %s)' % (url))
         return defer.fail(e)
 
-    log.msg(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --" % (url, payload), system=LOG_SYSTEM, payload=True)
+    logging.payload(" -- Sending Payload to %s --\n%s\n -- END. Sending Payload --", url, payload, system=LOG_SYSTEM)
 
     scheme, netloc, _ , _, _, _ = twhttp.urlparse(url)
     if not ':' in netloc:
@@ -58,42 +234,44 @@ def httpRequest(url, payload, headers, method='POST', timeout=DEFAULT_TIMEOUT, c
         host, s_port = netloc.split(':',1)
         port = int(s_port)
 
-    factory = twclient.HTTPClientFactory(url, method, postdata=payload, timeout=timeout)
-    factory.noisy = False # stop spewing about factory start/stop
-    factory.protocol.handleStatus_204 = lambda _ : None # 204 is an ok reply, needed by NCS VPN backend
-
-    # fix missing port in header (bug in twisted.web.client)
-    factory.headers['host'] = host + ':' + str(port)
-    factory.headers['User-Agent'] = 'OpenNSA/Twisted'
+    if scheme == 'https' and ctx_factory is None:
+        return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
 
+    http_headers = Headers( { 'User-Agent': [ 'OpenNSA/Twisted' ] } )
     for header, value in headers.items():
-        factory.headers[header] = value
+        http_headers.setRawHeaders(header, [ value ] )
 
-    if scheme == 'https':
-        if ctx_factory is None:
-            return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
-        reactor.connectSSL(host, port, factory, ctx_factory)
-    else:
-        reactor.connectTCP(host, port, factory)
+    pool = _getPool(ctx_factory if scheme == 'https' else None)
+    d = pool.request(method, url, http_headers, payload, (scheme, host, port), timeout)
+
+    def gotResponse( (response, data) ):
+        if full_response and (200 <= response.code < 300 or response.code == twhttp.NOT_MODIFIED):
+            return response, data
+        if 200 <= response.code < 300: # 204 is an ok reply, needed by NCS VPN backend
+            return data
+        raise WebError(str(response.code), response.phrase, data)
 
     def invocationError(err):
-        if isinstance(err.value, ConnectionClosed): # note: this also includes ConnectionDone and ConnectionLost
-            pass # these are pretty common when the remote shuts down
-        elif isinstance(err.value, WebError):
+        if isinstance(err.value, WebError):
             data = err.value.response
-            log.msg(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --' % data, system=LOG_SYSTEM, payload=True)
+            logging.payload(' -- Received Reply (fault) --\n%s\n -- END. Received Reply (fault) --', data, system=LOG_SYSTEM)
             return err
         elif isinstance(err.value, ConnectionRefusedError):
             log.msg('Connection refused for %s:%i. Request URL: %s' % (host, port, url), system=LOG_SYSTEM)
             return err
+        elif isinstance(err.value, twclient.ResponseNeverReceived) and all( r.check(ConnectionClosed) for r in err.value.reasons ):
+            # pretty common when the remote shuts down, but also if a persistent connection is closed while the request is sent
+            log.msg('Connection to %s:%i closed before a reply was received. Request URL: %s' % (host, port, url), system=LOG_SYSTEM)
+            return err
         else:
             return err
 
-    def logReply(data):
-        log.msg(" -- Received Reply --\n%s\n -- END. Received Reply --" % data, system=LOG_SYSTEM, payload=True)
-        return data
+    def logReply(result):
+        logging.payload(" -- Received Reply --\n%s\n -- END. Received Reply --", result[1] if full_response else result, system=LOG_SYSTEM)
+        return result
 
-    factory.deferred.addCallbacks(logReply, invocationError)
+    d.addCallback(gotResponse)
+    d.addCallbacks(logReply, invocationError)
 
-    return factory.deferred
+    return d
 
@@ -7,6 +7,8 @@ Copyright: NORDUnet (2011-2012)
 
 from xml.etree import ElementTree as ET
 
+from opennsa.shared import xmlhelper
+
 
 LOG_SYSTEM = 'opennsa.protocols.soap'
 
@@ -25,6 +27,10 @@ FAULTCODE_SERVER        = 'soap:Server' # must match with the namespace below
 
 ET.register_namespace('soap', SOAP_ENVELOPE_NS)
 
+# Indent payloads for readability. Only worth the cost when payloads are
+# logged, so it is off by default (enabled by the setup when payload logging is on).
+PRETTY_PRINT            = False
+
 
 
 def _indent(elem, level=0):
@@ -54,7 +60,7 @@ def createSoapEnvelope():
 
 
 
-def createSoapPayload(body_element=None, header_element=None):
+def createSoapPayload(body_element=None, header_element=None, pretty=None):
 
     envelope, header, body = createSoapEnvelope()
 
@@ -66,7 +72,8 @@ def createSoapPayload(body_element=None, header_element=None):
         else:
             body.append(body_element)
 
-    _indent(envelope)
+    if pretty or (pretty is None and PRETTY_PRINT):
+        _indent(envelope)
     payload = ET.tostring(envelope, 'utf-8')
 
     return payload
@@ -104,7 +111,7 @@ def createSoapFault(fault_msg, detail_element=None):
 
 def parseSoapPayload(payload):
 
-    envelope = ET.fromstring(payload)
+    envelope = xmlhelper.parseXML(payload)
 
     assert envelope.tag == SOAP_ENV, 'Top element in soap payload is not SOAP:Envelope (got %s)' % envelope.tag
 
@@ -126,7 +133,7 @@ def parseSoapPayload(payload):
 
 def parseFault(payload):
 
-    envelope = ET.fromstring(payload)
+    envelope = xmlhelper.parseXML(payload)
 
     if envelope.tag != SOAP_ENV:
         raise ValueError('Top element in soap payload is not SOAP:Envelope')
@@ -156,7 +163,7 @@ def parseFault(payload):
     if dt is not None:
         dc = dt.getchildren()[0]
         if dc is not None:
-            detail = ET.tostring(dc)
+            detail = xmlhelper.serializeElement(dc)
 
     return fault_code.text, fault_string.text, detail
 
@@ -5,10 +5,14 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2016)
 """
 
+from zope.interface import implements
+
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
+from twisted.internet.error import ConnectionLost
 from twisted.web import resource, server
 
+from opennsa import logging
 from opennsa.shared.requestinfo import RequestInfo
 from opennsa.protocols.shared import minisoap
 
@@ -31,6 +35,64 @@ class SOAPFault(Exception):
 
 
 
+class StreamingReply(object):
+    """
+    Reply which is written to the request incrementally, instead of being
+    build in memory first.
+
+    The produce function is called with a write function and must return a
+    deferred, which fires when everything has been written. If the deferred
+    fires with a SOAPFault before anything is written, the fault is returned
+    instead. Errors after data has been written can only be signaled by
+    dropping the connection, which the client will see as a truncated reply.
+
+    The write function returns a deferred, which fires when the transport
+    can take more data. The produce function should wait for it before
+    producing more, so the reply is not produced faster than the client
+    reads it.
+    """
+    def __init__(self, produce):
+        self.produce = produce
+
+
+
+class _StreamingProducer(object):
+    # push producer for a streaming reply, the transport pauses it when its write buffer is full
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+        self.waiting = []
+
+
+    def ready(self):
+        # deferred, which fires when more data can be written (or the connection is gone, which the next write will tell)
+        if not self.paused:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+
+
 class SOAPResource(resource.Resource):
 
     isLeaf = True
@@ -88,17 +150,20 @@ class SOAPResource(resource.Resource):
         soap_action = request.requestHeaders.getRawHeaders('soapaction',[None])[0]
 
         soap_data = request.content.read()
-        log.msg(" -- Received payload --\n%s\n -- END. Received payload --" % soap_data, system=LOG_SYSTEM, payload=True)
+        logging.payload(" -- Received payload --\n%s\n -- END. Received payload --", soap_data, system=LOG_SYSTEM)
 
         if not soap_action in self.soap_actions:
             log.msg('Got request with unknown SOAP action: %s' % soap_action, system=LOG_SYSTEM)
             request.setResponseCode(406) # Not acceptable
             return 'Invalid SOAP Action for this resource\r\n'
 
-        log.msg('Received SOAP request. Action: %s. Length: %i' % (soap_action, len(soap_data)), system=LOG_SYSTEM, debug=True)
+        logging.debug('Received SOAP request. Action: %s. Length: %i', soap_action, len(soap_data), system=LOG_SYSTEM)
 
         def reply(reply_data):
 
+            if type(reply_data) is StreamingReply:
+                return streamReply(reply_data)
+
             if type(reply_data) is SOAPFault:
                 reply_data = reply_data.createPayload()
                 request.setResponseCode(500) # Internal server error
@@ -106,12 +171,55 @@ class SOAPResource(resource.Resource):
             if reply_data is None or len(reply_data) == 0:
                 log.msg('None/empty reply data supplied for SOAPResource. This is probably wrong', system=LOG_SYSTEM)
             else:
-                log.msg(" -- Sending response --\n%s\n -- END: Sending response --" % reply_data, system=LOG_SYSTEM, payload=True)
+                logging.payload(" -- Sending response --\n%s\n -- END: Sending response --", reply_data, system=LOG_SYSTEM)
 
             request.setHeader('Content-Type', 'text/xml') # Keeps some SOAP implementations happy
             request.write(reply_data)
             request.finish()
 
+        def streamReply(streaming_reply):
+
+            written = [ 0 ]
+            lost = []
+            request.notifyFinish().addErrback(lambda _ : lost.append(True))
+
+            producer = _StreamingProducer()
+            request.registerProducer(producer, True)
+
+            def write(data):
+                if lost or producer.stopped:
+                    raise ConnectionLost('Client went away during streaming reply')
+                if written[0] == 0:
+                    request.setHeader('Content-Type', 'text/xml')
+                written[0] += len(data)
+                request.write(data)
+                return producer.ready()
+
+            def streamDone(result):
+                request.unregisterProducer()
+                if type(result) is SOAPFault and written[0] == 0:
+                    return reply(result)
+                elif type(result) is SOAPFault:
+                    log.msg('Error after %i bytes of streaming reply: %s. Dropping connection.' % (written[0], result.fault_string), system=LOG_SYSTEM)
+                    request.loseConnection()
+                else:
+                    logging.debug('Streaming reply done. Length: %i', written[0], system=LOG_SYSTEM)
+                    request.finish()
+
+            def streamError(err):
+                request.unregisterProducer()
+                if lost or producer.stopped:
+                    log.msg('Client connection lost during streaming reply', system=LOG_SYSTEM)
+                elif written[0] == 0:
+                    errorReply(err, soap_data)
+                else:
+                    log.msg('Error after %i bytes of streaming reply: %s. Dropping connection.' % (written[0], err.getErrorMessage()), system=LOG_SYSTEM)
+                    request.loseConnection()
+
+            d = defer.maybeDeferred(streaming_reply.produce, write)
+            d.addCallbacks(streamDone, streamError)
+            return d
+
         def errorReply(err, soap_data):
 
             log.msg('Failure during SOAP decoding/dispatch: %s' % err.getErrorMessage(), system=LOG_SYSTEM)
@@ -119,7 +227,7 @@ class SOAPResource(resource.Resource):
             log.msg('SOAP Payload that caused error:\n%s\n' % soap_data)
             error_payload = SOAPFault(err.getErrorMessage()).createPayload()
 
-            log.msg(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --" % error_payload, system=LOG_SYSTEM, payload=True)
+            logging.payload(" -- Sending response (fault) --\n%s\n -- END: Sending response (fault) --", error_payload, system=LOG_SYSTEM)
 
             request.setResponseCode(500) # Internal server error
             request.setHeader('Content-Type', 'text/xml')
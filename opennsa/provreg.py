@@ -10,7 +10,7 @@ The class ProviderRegistry tries to keep it a bit sane.
 
 from twisted.python import log
 
-from opennsa import error
+from opennsa import error, logging
 
 LOG_SYSTEM = 'providerregistry'
 
@@ -62,7 +62,7 @@ class ProviderRegistry(object):
         ServiceType must exist on the NSI agent, and a factory for the type available.
         """
         if nsi_agent.urn() in self.providers and self.provider_networks[nsi_agent.urn()] == network_ids:
-            log.msg('Skipping provider spawn for %s (no change)' % nsi_agent, debug=True, system=LOG_SYSTEM)
+            logging.debug('Skipping provider spawn for %s (no change)', nsi_agent, system=LOG_SYSTEM)
             return self.providers[nsi_agent.urn()]
 
         factory = self.provider_factories[ nsi_agent.getServiceType() ]
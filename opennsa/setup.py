@@ -7,6 +7,7 @@ import datetime
 import importlib
 
 from twisted.python import log
+from twisted.internet import reactor
 from twisted.web import resource, server
 from twisted.application import internet, service as twistedservice
 
@@ -15,7 +16,7 @@ from opennsa import __version__ as version
 from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource
 from opennsa.topology import nrm, nml, linkvector, service as nmlservice
 from opennsa.protocols import rest, nsi2
-from opennsa.protocols.shared import httplog
+from opennsa.protocols.shared import httplog, minisoap
 from opennsa.discovery import service as discoveryservice, fetcher
 
 
@@ -81,6 +82,13 @@ def setupBackend(backend_cfg, network_name, nrm_ports, parent_requester):
         raise config.ConfigurationError('No backend specified')
 
     b = BackendConstructer(network_name, nrm_ports, parent_requester, bc)
+
+    if config.RESTORE_CONCURRENCY in bc:
+        try:
+            b.restore_concurrency = int(bc[config.RESTORE_CONCURRENCY])
+        except ValueError:
+            raise config.ConfigurationError('Invalid %s value: %s' % (config.RESTORE_CONCURRENCY, bc[config.RESTORE_CONCURRENCY]))
+
     return b
 
 
@@ -208,7 +216,7 @@ class OpenNSAService(twistedservice.MultiService):
         requester_creator = CS2RequesterCreator(top_resource, None, vc[config.HOST], vc[config.PORT], vc[config.TLS], ctx_factory) # set aggregator later
 
         provider_registry = provreg.ProviderRegistry({}, { cnt.CS2_SERVICE_TYPE : requester_creator.create } )
-        aggr = aggregator.Aggregator(network_name, ns_agent, nml_network, link_vector, None, provider_registry, vc[config.POLICY], plugin ) # set parent requester later
+        aggr = aggregator.Aggregator(network_name, ns_agent, nml_network, link_vector, None, provider_registry, vc[config.POLICY], plugin, vc[config.RETRY_DEADLINE]) # set parent requester later
 
         requester_creator.aggregator = aggr
 
@@ -285,7 +293,8 @@ class OpenNSAService(twistedservice.MultiService):
 
         discovery_resource = ds.resource()
         top_resource.children['NSI'].putChild(discovery_resource_name, discovery_resource)
-        link_vector.callOnUpdate( lambda : discovery_resource.updateResource ( ds.xml() ))
+        update_window = vc[config.UPDATE_WINDOW]
+        link_vector.callOnUpdate( lambda : discovery_resource.updateLater(ds.xml, update_window) )
 
         service_endpoints.append( ('Discovery', discovery_url) )
 
@@ -331,7 +340,19 @@ def createApplication(config_file=config.DEFAULT_CONFIG_FILE, debug=False, paylo
         nsa_service = OpenNSAService(vc)
         nsa_service.setServiceParent(application)
 
-        application.setComponent(log.ILogObserver, logging.DebugLogObserver(log_file, debug, payload=payload).emit)
+        # only indent soap payloads if someone is going to read them
+        minisoap.PRETTY_PRINT = payload
+
+        logging.configure(debug, payload)
+        if vc[config.LOG_FORMAT] == config.LOG_FORMAT_JSON:
+            observer = logging.JSONLogObserver(log_file, debug, payload=payload)
+            # writer thread is started when the reactor runs, i.e., after daemonizing
+            reactor.callWhenRunning(observer.start)
+            reactor.addSystemEventTrigger('after', 'shutdown', observer.stop)
+        else:
+            observer = logging.DebugLogObserver(log_file, debug, payload=payload)
+
+        application.setComponent(log.ILogObserver, observer.emit)
         return application
 
     except config.ConfigurationError as e:
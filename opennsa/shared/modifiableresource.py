@@ -2,19 +2,49 @@
 twisted.web.resource.Resource that supports the if-modified-since header.
 Currently only leaf behaviour is supported.
 
+The resource also supports etags (if-none-match), and gzip content encoding.
+The etag and gzip encoded representation are computed once per update, so
+serving the resource is cheap even if it is polled a lot.
+
+Updates can be debounced (see updateLater), so a burst of changes results in
+a single regeneration of the representation.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2013-2014)
 """
+import gzip
+import hashlib
 import datetime
+from StringIO import StringIO
 
 from twisted.python import log
+from twisted.internet import reactor
 from twisted.web import resource
 
 
 RFC850_FORMAT       = '%a, %d %b %Y %H:%M:%S GMT'
 CONTENT_TYPE        = 'Content-type'
+CONTENT_ENCODING    = 'Content-encoding'
 LAST_MODIFIED       = 'Last-modified'
+ETAG                = 'ETag'
+VARY                = 'Vary'
 IF_MODIFIED_SINCE   = 'if-modified-since'
+IF_NONE_MATCH       = 'if-none-match'
+ACCEPT_ENCODING     = 'accept-encoding'
+
+GZIP                = 'gzip'
+
+UPDATE_WINDOW       = 2 # seconds, default for updateLater
+
+
+
+def _acceptsGzip(accept_encoding):
+    # true if gzip is in the accept-encoding header, without q=0
+    for coding in accept_encoding.split(','):
+        parts = [ p.strip() for p in coding.split(';') ]
+        if parts[0].lower() in (GZIP, '*'):
+            return not any( p.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for p in parts[1:] )
+    return False
 
 
 
@@ -29,6 +59,10 @@ class ModifiableResource(resource.Resource):
         self.log_system = log_system
         self.mime_type = mime_type
 
+        self.clock = reactor # replaced when testing
+        self.update_call = None
+        self.last_generation = None
+
         self.updateResource(None) # so we always have something, resource generate an error though
 
 
@@ -41,6 +75,49 @@ class ModifiableResource(resource.Resource):
         self.last_update_time = update_time
         self.last_modified_timestamp = datetime.datetime.strftime(update_time, RFC850_FORMAT)
 
+        if representation is None:
+            self.etag = None
+        else:
+            self.etag = '"%s"' % hashlib.sha1(representation).hexdigest()
+        self.gzip_representation = None # created on first request for it
+
+
+    def updateLater(self, generate, window=UPDATE_WINDOW):
+        """
+        Update the resource with the representation returned by generate, at
+        most once per window (seconds). If an update is already pending, the
+        call is folded into it, i.e., generate is called once per burst of
+        updates, and when called it creates the representation from the
+        current state.
+        """
+        if self.update_call is not None:
+            return # update already scheduled
+
+        now = self.clock.seconds()
+        delay = 0 if self.last_generation is None else max(0, self.last_generation + window - now)
+
+        def update():
+            self.update_call = None
+            self.last_generation = self.clock.seconds()
+            try:
+                self.updateResource( generate() )
+            except Exception as e:
+                log.msg('Error generating representation: %s' % str(e), system=self.log_system)
+                log.err(e)
+
+        self.update_call = self.clock.callLater(delay, update)
+
+
+    def _gzipRepresentation(self):
+
+        if self.gzip_representation is None:
+            buf = StringIO()
+            gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+            gz.write(self.representation)
+            gz.close()
+            self.gzip_representation = buf.getvalue()
+        return self.gzip_representation
+
 
     def render_GET(self, request):
 
@@ -49,9 +126,23 @@ class ModifiableResource(resource.Resource):
             request.setResponseCode(500)
             return 'Resource has not yet been created/updated.'
 
+        use_gzip = _acceptsGzip(request.getHeader(ACCEPT_ENCODING) or '')
+        etag = self.etag[:-1] + '-gzip"' if use_gzip else self.etag
+
+        request.setHeader(VARY, 'Accept-Encoding')
+
+        # check for if-none-match header, either variant will do
+        inm_header = request.getHeader(IF_NONE_MATCH)
+        if inm_header:
+            tags = [ t.strip() for t in inm_header.split(',') ]
+            if '*' in tags or self.etag in tags or self.etag[:-1] + '-gzip"' in tags:
+                request.setHeader(ETAG, etag)
+                request.setResponseCode(304)
+                return ''
+
         # check for if-modified-since header, and send 304 back if it is not been modified
         msd_header = request.getHeader(IF_MODIFIED_SINCE)
-        if msd_header:
+        if msd_header and not inm_header: # if-none-match takes precedence
             try:
                 msd = datetime.datetime.strptime(msd_header, RFC850_FORMAT)
                 if msd >= self.last_update_time:
@@ -61,8 +152,13 @@ class ModifiableResource(resource.Resource):
                 pass # error parsing timestamp
 
         request.setHeader(LAST_MODIFIED, self.last_modified_timestamp)
+        request.setHeader(ETAG, etag)
         if self.mime_type:
             request.setHeader(CONTENT_TYPE, self.mime_type)
 
-        return self.representation
+        if use_gzip:
+            request.setHeader(CONTENT_ENCODING, GZIP)
+            return self._gzipRepresentation()
+        else:
+            return self.representation
 
@@ -1,17 +1,40 @@
 """
-Various XML utility functions (actually just ISO datetime).
+Various XML utility functions (ISO datetime and XML parsing).
 
 Author: Henrik Thostrup Jensen <htj _at_ nordu.net>
 Copyright: NORDUnet (2012-2015)
 """
 
 import datetime
+from xml.etree import ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 
 from opennsa import error
 from opennsa.ext.iso8601 import iso8601
 
 
 
+# Backend for parsing XML. lxml is used when available, as it parses a lot
+# faster than ElementTree, and the elements it creates supports the part of the
+# ElementTree API used by the bindings. Payloads are always created and
+# serialized with ElementTree, as lxml places namespace declarations and
+# serializes empty elements differently, and the output of OpenNSA should not
+# depend on what happens to be installed.
+ETREE   = 'etree'
+LXML    = 'lxml'
+
+XML_BACKEND = LXML if lxml_etree is not None else ETREE
+
+if lxml_etree is not None:
+    # comments and processing instructions must not show up as elements (ElementTree discards them)
+    _LXML_PARSER = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, resolve_entities=False, no_network=True)
+
+
+
 class UTC(datetime.tzinfo):
 
     def utcoffset(self, dt):
@@ -42,3 +65,26 @@ def parseXMLTimestamp(xsd_timestamp):
     utc_dt = dt.astimezone(UTC()).replace(tzinfo=None)
     return utc_dt
 
+
+
+def parseXML(data):
+    """
+    Parse an XML document, returning the root element.
+    """
+    if XML_BACKEND == LXML:
+        if type(data) is unicode:
+            data = data.encode('utf-8') # lxml refuses unicode strings with an encoding declaration
+        return lxml_etree.fromstring(data, _LXML_PARSER)
+    else:
+        return ET.fromstring(data)
+
+
+def serializeElement(element):
+    """
+    Serialize an element returned by parseXML (or a child of it).
+    """
+    if lxml_etree is not None and isinstance(element, lxml_etree._Element):
+        return lxml_etree.tostring(element)
+    else:
+        return ET.tostring(element)
+
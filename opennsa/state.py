@@ -6,12 +6,17 @@ Copyright: NORDUnet (2011)
 """
 
 from twisted.python import log
+from twisted.internet import defer
+
+from twistar.registry import Registry
 
 from opennsa import error
 
 
 LOG_SYSTEM = 'opennsa.state'
 
+BULK_CHUNK_SIZE = 1000 # connections per UPDATE in commitTransitions
+
 
 # Reservation states
 RESERVE_START           = 'ReserveStart'
@@ -77,24 +82,18 @@ def desubscribe(connection_id, f):
     SUBSCRIPTIONS[connection_id].remove(f)
 
 
-def saveNotify(conn):
+def notify(conn):
+    try:
+        for f in SUBSCRIPTIONS[conn.connection_id]:
+            try:
+                f()
+            except Exception as e:
+                log.msg('Error during state notificaton: %s' % str(e), system=LOG_SYSTEM)
+    except KeyError as e:
+        #print 'Nothing to notify about %s (%s)' % (conn.connection_id, str(e))
+        pass
 
-    def notify(conn):
-        try:
-            for f in SUBSCRIPTIONS[conn.connection_id]:
-                try:
-                    f()
-                except Exception as e:
-                    log.msg('Error during state notificaton: %s' % str(e), system=LOG_SYSTEM)
-        except KeyError as e:
-            #print 'Nothing to notify about %s (%s)' % (conn.connection_id, str(e))
-            pass
-
-        return conn
-
-    d = conn.save()
-    d.addCallback(notify)
-    return d
+    return conn
 
 
 def _switchState(transition_schema, old_state, new_state):
@@ -103,93 +102,197 @@ def _switchState(transition_schema, old_state, new_state):
     else:
         raise error.InternalServerError('Transition from state %s to %s not allowed' % (old_state, new_state))
 
+
+
+class Transition(object):
+    """
+    A batch of state transitions (and other column changes) for a connection.
+
+    Transitions are validated when added to the batch, against the state the
+    connection will be in when the preceding transitions have been made. The
+    connection is not changed until the batch is committed. On commit the
+    transitions are validated again (the connection may have been changed by
+    someone else in the meantime), the changed columns are persisted in a
+    single UPDATE, and subscribers are notified once.
+
+    Usage:
+
+        yield state.Transition(conn).reserve(state.RESERVE_COMMITTING, state.RESERVE_START).set(allocated=True).commit()
+    """
+    def __init__(self, conn):
+        self.conn   = conn
+        self.steps  = [] # ( column, transition_schema, value ), transition schema is None for set
+        self.values = {} # column -> value after the batch
+
+
+    def _add(self, column, transition_schema, states):
+        current = self.values.get(column, getattr(self.conn, column))
+        for new_state in states:
+            _switchState(transition_schema, current, new_state)
+            self.steps.append( (column, transition_schema, new_state) )
+            current = new_state
+        self.values[column] = current
+        return self
+
+
+    def reserve(self, *states):
+        return self._add('reservation_state', RESERVE_TRANSITIONS, states)
+
+    def provision(self, *states):
+        return self._add('provision_state', PROVISION_TRANSITIONS, states)
+
+    def lifecycle(self, *states):
+        return self._add('lifecycle_state', LIFECYCLE_TRANSITIONS, states)
+
+    def set(self, **values):
+        # unvalidated column changes, which are persisted along with the transitions
+        for column, value in values.items():
+            self.steps.append( (column, None, value) )
+        self.values.update(values)
+        return self
+
+
+    def _validate(self):
+        # validate again, in case the connection has changed since the batch was created
+        current = {}
+        for column, transition_schema, value in self.steps:
+            if transition_schema is not None:
+                _switchState(transition_schema, current.get(column, getattr(self.conn, column)), value)
+            current[column] = value
+
+
+    def _apply(self):
+        # change the connection object, returns the changed columns
+        # labels do not have value equality, so they will always be considered changed
+        changes = dict( (column, value) for column, value in self.values.items() if getattr(self.conn, column, None) != value )
+        self.previous = dict( (column, getattr(self.conn, column, None)) for column in changes )
+
+        for column, value in changes.items():
+            setattr(self.conn, column, value)
+        return changes
+
+
+    def _revert(self, err):
+        # keep the connection object in sync with the database
+        for column, value in self.previous.items():
+            setattr(self.conn, column, value)
+        return err
+
+
+    def commit(self):
+
+        self._validate()
+        changes = self._apply()
+
+        if self.conn.id is None:
+            d = self.conn.save()
+        elif changes:
+            d = Registry.getConfig().update(self.conn.tablename(), changes, where=['id = ?', self.conn.id])
+            d.addCallback(lambda _ : self.conn)
+        else:
+            d = defer.succeed(self.conn)
+
+        d.addCallbacks(notify, self._revert)
+        return d
+
+
+
+def commitTransitions(transitions, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Commit the transitions of several (saved) connections in one database
+    transaction. Connections with the same changes are updated together, one
+    UPDATE per chunk of connections. All transitions are validated before
+    anything is changed, and subscribers are notified once the changes have
+    been persisted, as with Transition.commit.
+    """
+    for transition in transitions:
+        transition._validate()
+
+    groups = [] # ( tablename, changes, [ connection id ] )
+    for transition in transitions:
+        changes = transition._apply()
+        if not changes:
+            continue
+        tablename = transition.conn.tablename()
+        for group_tablename, group_changes, ids in groups:
+            if group_tablename == tablename and group_changes == changes:
+                ids.append(transition.conn.id)
+                break
+        else:
+            groups.append( (tablename, changes, [ transition.conn.id ]) )
+
+    def update(txn):
+        for tablename, changes, ids in groups:
+            columns = sorted(changes)
+            query = 'UPDATE %s SET %s WHERE id IN %%s' % (tablename, ', '.join( '%s = %%s' % column for column in columns ))
+            args = [ changes[column] for column in columns ]
+            for i in range(0, len(ids), chunk_size):
+                txn.execute(query, args + [ tuple(ids[i:i+chunk_size]) ])
+
+    def updateFailed(err):
+        for transition in transitions:
+            transition._revert(err)
+        return err
+
+    d = Registry.DBPOOL.runInteraction(update) if groups else defer.succeed(None)
+    d.addCallbacks(lambda _ : [ notify(transition.conn) for transition in transitions ], updateFailed)
+    return d
+
+
 # Reservation
 
 
 def reserveChecking(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_CHECKING)
-    conn.reservation_state = RESERVE_CHECKING
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_CHECKING).commit()
 
 def reserveHeld(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_HELD)
-    conn.reservation_state = RESERVE_HELD
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_HELD).commit()
 
 def reserveFailed(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_FAILED)
-    conn.reservation_state = RESERVE_FAILED
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_FAILED).commit()
 
 def reserveCommit(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_COMMITTING)
-    conn.reservation_state = RESERVE_COMMITTING
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_COMMITTING).commit()
 
 def reserveAbort(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_ABORTING)
-    conn.reservation_state = RESERVE_ABORTING
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_ABORTING).commit()
 
 def reserveTimeout(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_TIMEOUT)
-    conn.reservation_state = RESERVE_TIMEOUT
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_TIMEOUT).commit()
 
 def reserved(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_START)
-    conn.reservation_state = RESERVE_START
-    return saveNotify(conn)
+    return Transition(conn).reserve(RESERVE_START).commit()
 
 def reserveMultiSwitch(conn, *states):
-    # switch through multiple states in one go, note this does not save the state (because it is often needed with allocation switch)
-    for s in states:
-        _switchState(RESERVE_TRANSITIONS, conn.reservation_state, s)
-        conn.reservation_state = s
-    return saveNotify(conn)
+    # switch through multiple states in one go
+    return Transition(conn).reserve(*states).commit()
 
 
 # Provision
 
 def provisioning(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, PROVISIONING)
-    conn.provision_state = PROVISIONING
-    return saveNotify(conn)
+    return Transition(conn).provision(PROVISIONING).commit()
 
 def provisioned(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, PROVISIONED)
-    conn.provision_state = PROVISIONED
-    return saveNotify(conn)
+    return Transition(conn).provision(PROVISIONED).commit()
 
 def releasing(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, RELEASING)
-    conn.provision_state = RELEASING
-    return saveNotify(conn)
+    return Transition(conn).provision(RELEASING).commit()
 
 def released(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, RELEASED)
-    conn.provision_state = RELEASED
-    return saveNotify(conn)
+    return Transition(conn).provision(RELEASED).commit()
 
 # Lifecyle
 
 def passedEndtime(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, PASSED_ENDTIME)
-    conn.lifecycle_state = PASSED_ENDTIME
-    return saveNotify(conn)
+    return Transition(conn).lifecycle(PASSED_ENDTIME).commit()
 
 def failed(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, FAILED)
-    conn.lifecycle_state = FAILED
-    return saveNotify(conn)
+    return Transition(conn).lifecycle(FAILED).commit()
 
 def terminating(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, TERMINATING)
-    conn.lifecycle_state = TERMINATING
-    return saveNotify(conn)
+    return Transition(conn).lifecycle(TERMINATING).commit()
 
 def terminated(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, TERMINATED)
-    conn.lifecycle_state = TERMINATED
-    return saveNotify(conn)
+    return Transition(conn).lifecycle(TERMINATED).commit()
 
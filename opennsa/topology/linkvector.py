@@ -11,6 +11,8 @@ Copyright: NORDUnet (2011-2015)
 
 from twisted.python import log
 
+from opennsa import logging
+
 
 
 LOG_SYSTEM = 'topology.linkvector'
@@ -32,7 +34,10 @@ class LinkVector:
         # this is a set of vectors we keep for each peer
         self.vectors = {} # port name -> { network : cost }
 
-        # this is the calculated shortest paths, should be recalculated when new information gets available
+        # candidate paths for each network, i.e., the ports with an usable vector to the network
+        self._network_costs = {} # network -> { port name : cost }
+
+        # this is the calculated shortest paths, updated incrementally when vectors change
         self._shortest_paths = {} # network -> ( port name, cost)
 
         self.subscribers = []
@@ -51,47 +56,72 @@ class LinkVector:
 
     def updateVector(self, port, vectors):
 
-        if port in self.vectors:
-            self.vectors[port].update(vectors)
-        else:
-            self.vectors[port] = vectors
+        port_vectors = self.vectors.setdefault(port, {})
+        changed_networks = [ network for network, cost in vectors.items() if port_vectors.get(network) != cost ]
+        port_vectors.update(vectors)
 
-        self._calculateVectors()
-        self.updated()
+        if self._updatePaths(port, changed_networks):
+            self.updated()
 
 
     def deleteVector(self, port):
         try:
-            self.vectors.pop(port)
-            self._calculateVectors()
+            port_vectors = self.vectors.pop(port)
         except KeyError:
             log.msg('Tried to delete non-existing vector for %s' % port)
+            return
+
+        if self._updatePaths(port, port_vectors.keys()):
+            self.updated()
+
+
+    def _usable(self, network, cost):
+
+        if network in self.local_networks:
+            return False # skip local networks
+        if network in self.blacklist_networks:
+            log.msg('Skipping network %s in vector calculation, is blacklisted' % network, system=LOG_SYSTEM)
+            return False
+        if cost > self.max_cost:
+            log.msg('Skipping network %s in vector calculation, cost %i exceeds max cost %i' % (network, cost, self.max_cost), system=LOG_SYSTEM)
+            return False
+        return True
 
 
-    def _calculateVectors(self):
+    def _updatePaths(self, port, networks):
+        # recalculate the shortest paths for networks, where the vector for port has changed
+        # returns True if the exported vectors (see listVectors) changed
 
-        log.msg('* Calculating shortest-path vectors', debug=True, system=LOG_SYSTEM)
-        paths = {}
-        for port, vectors in self.vectors.items():
+        port_vectors = self.vectors.get(port, {})
+        exported_changed = False
 
-            for network, cost in vectors.items():
-                if network in self.local_networks:
-                    continue # skip local networks
-                if network in self.blacklist_networks:
-                    log.msg('Skipping network %s in vector calculation, is blacklisted' % network, system=LOG_SYSTEM)
-                    continue
-                if cost > self.max_cost:
-                    log.msg('Skipping network %s in vector calculation, cost %i exceeds max cost %i' % (network, cost, self.max_cost), system=LOG_SYSTEM)
-                    continue
-                if not network in paths:
-                    paths[network] = (port, cost)
-                    log.msg('Added path to %s via %s. Cost %i' % (network, port, cost), debug=True, system=LOG_SYSTEM)
-                elif cost < paths[network][1]:
-                    paths[network] = (port, cost) # overwrite
-                    log.msg('Updated path to %s via %s. Cost %i' % (network, port, cost), debug=True, system=LOG_SYSTEM)
-                # no else, it means we have a cheaper path
+        for network in networks:
+            costs = self._network_costs.setdefault(network, {})
 
-        self._shortest_paths = paths
+            cost = port_vectors.get(network)
+            if cost is not None and self._usable(network, cost):
+                costs[port] = cost
+            else:
+                costs.pop(port, None)
+
+            old_path = self._shortest_paths.get(network)
+
+            if costs:
+                # cheapest path, port name as tie breaker to make it deterministic
+                best_cost, best_port = min( (c, p) for p, c in costs.items() )
+                if old_path != (best_port, best_cost):
+                    self._shortest_paths[network] = (best_port, best_cost)
+                    logging.debug('%s path to %s via %s. Cost %i', 'Added' if old_path is None else 'Updated', network, best_port, best_cost, system=LOG_SYSTEM)
+                if old_path is None or old_path[1] != best_cost:
+                    exported_changed = True
+            else:
+                self._network_costs.pop(network)
+                if old_path is not None:
+                    self._shortest_paths.pop(network)
+                    logging.debug('Removed path to %s', network, system=LOG_SYSTEM)
+                    exported_changed = True
+
+        return exported_changed
 
 
     def vector(self, network):
@@ -103,6 +133,14 @@ class LinkVector:
             return None # or do we need an exception here?
 
 
+    def rankedVectors(self, network, max_vectors=None):
+        # list of ports that can reach network, cheapest first (same ordering as vector)
+        # used for finding multiple candidate paths, empty list if the network cannot be reached
+        costs = self._network_costs.get(network, {})
+        ranked = [ port for cost, port in sorted( (c, p) for p, c in costs.items() ) ]
+        return ranked if max_vectors is None else ranked[:max_vectors]
+
+
     def listVectors(self):
         # needed for exporting topologies
         return { network : cost for (network, (_, cost) ) in self._shortest_paths.items() }
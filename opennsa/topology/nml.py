@@ -6,6 +6,7 @@ Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2013)
 """
 
+import heapq
 import itertools
 import datetime
 
@@ -19,6 +20,9 @@ LOG_SYSTEM = 'opennsa.topology'
 INGRESS = 'ingress'
 EGRESS  = 'egress'
 
+MAX_PATHS = 10  # default number of paths returned by findPaths
+MAX_HOPS  = 10  # default maximum number of networks in a path
+
 
 
 class Port(object):
@@ -37,7 +41,7 @@ class Port(object):
 
 
     def canMatchLabel(self, label):
-        return nsa.Label.canMatch(self, label)
+        return nsa.Label.canMatch(self._label, label)
 
 
     def isBidirectional(self):
@@ -171,6 +175,7 @@ class Topology(object):
 
     def __init__(self):
         self.networks = {} # network_name -> ( Network, nsa.NetworkServiceAgent)
+        self._port_index = None # port id -> ( network_name, port ), created on demand
 
 
     def addNetwork(self, network, managing_nsa):
@@ -181,6 +186,7 @@ class Topology(object):
             raise error.TopologyError('Entry for network with id %s already exists' % network.id_)
 
         self.networks[network.id_] = (network, managing_nsa)
+        self._port_index = None
 
 
     def updateNetwork(self, network, managing_nsa):
@@ -192,6 +198,7 @@ class Topology(object):
             log.msg('Error updating network entry for %s. Reason: %s' % (network.id_, str(e)))
             if existing_entry:
                 self.networks[network.id_] = existing_entry # restore old entry
+                self._port_index = None
             raise e
 
 
@@ -203,13 +210,14 @@ class Topology(object):
 
 
     def getNetworkPort(self, port_id):
-        for network_id, (network,_) in self.networks.items():
-            try:
-                port = network.getPort(port_id)
-                return network_id, port
-            except error.TopologyError:
-                continue
-        else:
+        if self._port_index is None:
+            self._port_index = {}
+            for network_id, (network,_) in self.networks.items():
+                for port in itertools.chain(network.inbound_ports, network.outbound_ports, network.bidirectional_ports):
+                    self._port_index[port.id_] = (network_id, port)
+        try:
+            return self._port_index[port_id]
+        except KeyError:
             raise error.TopologyError('Cannot find port with id %s in topology' % port_id)
 
 
@@ -246,10 +254,21 @@ class Topology(object):
         return None
 
 
-    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+    def findPaths(self, source_stp, dest_stp, bandwidth, exclude_networks=None, max_paths=MAX_PATHS, max_hops=MAX_HOPS):
+        """
+        Find paths between two STPs, shortest (fewest networks) first.
 
-        source_port = self.getNetwork(source_stp.network).getPort(source_stp.port)
-        dest_port   = self.getNetwork(dest_stp.network).getPort(dest_stp.port)
+        The search is best-first, and bounded: at most max_paths paths are
+        returned, each crossing at most max_hops networks. Label sets are
+        narrowed as the search progresses, so paths without a usable label
+        are pruned early. Networks in exclude_networks are not crossed.
+
+        Each path is a list of nsa.Link, one per network.
+        """
+        source_network = self.getNetwork(source_stp.network)
+        dest_network   = self.getNetwork(dest_stp.network)
+        source_port    = source_network.getPort(source_network.id_ + ':' + source_stp.port)
+        dest_port      = dest_network.getPort(dest_network.id_ + ':' + dest_stp.port)
 
         if source_port.isBidirectional() or dest_port.isBidirectional():
             # at least one of the stps are bidirectional
@@ -261,8 +280,8 @@ class Topology(object):
             # both ports are unidirectional
             if not (source_port.orientation, dest_port.orientation) in ( (INGRESS, EGRESS), (EGRESS, INGRESS) ):
                 raise error.TopologyError('Cannot connect STPs of same unidirectional direction (%s -> %s)' % (source_port.orientation, dest_port.orientation))
+            raise error.TopologyError('Unidirectional path-finding not implemented yet')
 
-        # these are only really interesting for the initial call, afterwards they just prune
         if not source_port.canMatchLabel(source_stp.label):
             raise error.TopologyError('Source port %s (label %s) cannot match label for source STP (%s)' % (source_port.id_, source_port.label(), source_stp.label))
         if not dest_port.canMatchLabel(dest_stp.label):
@@ -272,77 +291,107 @@ class Topology(object):
 #        if not dest_port.canProvideBandwidth(bandwidth):
 #            raise error.BandwidthUnavailableError('Destination port cannot provide enough bandwidth (%i)' % bandwidth)
 
-        return self._findPathsRecurse(source_stp, dest_stp, bandwidth)
+        exclude_networks = set(exclude_networks or [])
+        demarcations = {} # port id -> ( demarcation network, demarcation port, demarcation port label ), cached for the search
+        port_labels  = {} # port id -> label, cached for the search (bidirectional port labels are computed)
 
+        # search state: (path length, sequence, network, ingress port, ingress label, hops so far, visited networks)
+        # the sequence number keeps the search order stable (port order) for paths of equal length
+        # hops are (network, ingress port, ingress label, egress port)
+        sequence = itertools.count()
+        queue = [ (1, sequence.next(), source_network, source_port, _intersect(source_port.label(), source_stp.label), (), frozenset([source_network.id_]) ) ]
+        expansions = {} # (network id, ingress port id) -> times expanded, bounds the search (k-shortest style)
+        paths = []
 
-    def _findPathsRecurse(self, source_stp, dest_stp, bandwidth, exclude_networks=None):
+        while queue and len(paths) < max_paths:
 
-        source_network = self.getNetwork(source_stp.network)
-        dest_network   = self.getNetwork(dest_stp.network)
-        source_port    = source_network.getPort(source_stp.port)
-        dest_port      = dest_network.getPort(dest_stp.port)
+            length, _, network, ingress_port, ingress_label, hops, visited = heapq.heappop(queue)
 
-        if not (source_port.canMatchLabel(source_stp.label) or dest_port.canMatchLabel(dest_stp.label)):
-            return []
-#        if not (source_port.canProvideBandwidth(bandwidth) and dest_port.canProvideBandwidth(bandwidth)):
-#            return []
-
-        if source_port.isBidirectional() and dest_port.isBidirectional():
-            # bidirectional path finding, easy case first
-            if source_stp.network == dest_stp.network:
+            if network.id_ == dest_network.id_:
                 # while it is possible to cross other network in order to connect to intra-network STPs
                 # it is not something we really want to do in the real world, so we don't
                 try:
-                    if source_network.canSwapLabel(source_stp.label.type_):
-                        source_label = source_port.label().intersect(source_stp.label)
-                        dest_label   = dest_port.label().intersect(dest_stp.label)
-                    else:
-                        source_label = source_port.label().intersect(dest_port.label()).intersect(source_stp.label).intersect(dest_stp.label)
-                        dest_label   = source_label
-                    link = nsa.Link(source_stp.network, source_stp.port, dest_stp.port, source_label, dest_label)
-                    return [ [ link ] ]
+                    paths.append( self._createPathLinks(hops + ( (network, ingress_port, ingress_label, dest_port), ), dest_stp) )
                 except nsa.EmptyLabelSet:
-                    return [] # no path
-            else:
-                # ok, time for real pathfinding
-                link_ports = source_network.findPorts(True, source_stp.label, source_stp.port)
-                link_ports = [ port for port in link_ports if port.hasRemote() ] # filter out termination ports
-                links = []
-                for lp in link_ports:
+                    pass # no usable label for the path
+                continue
+
+            if length >= max_hops:
+                continue
+
+            key = (network.id_, ingress_port.id_)
+            expansions[key] = expansions.get(key, 0) + 1
+            if expansions[key] > max_paths:
+                continue # already expanded enough times via shorter paths
+
+            can_swap = network.canSwapLabel(_labelType(ingress_label))
+
+            for lp in network.bidirectional_ports:
+                if lp.id_ == ingress_port.id_ or not lp.hasRemote():
+                    continue # termination port
+
+                if not lp.id_ in demarcations:
                     demarcation = self.findDemarcationPort(lp)
-                    if demarcation is None:
-                        continue
+                    if demarcation is not None:
+                        d_network_id, d_port = self.getNetworkPort(demarcation[1])
+                        demarcation = (self.getNetwork(d_network_id), d_port, d_port.label())
+                    demarcations[lp.id_] = demarcation
+                demarcation = demarcations[lp.id_]
+                if demarcation is None:
+                    continue
 
-                    d_network_id, d_port_id = demarcation
+                d_network, d_port, d_port_label = demarcation
+                if d_network.id_ in visited or d_network.id_ in exclude_networks:
+                    continue # don't do loops in path finding
 
-                    if exclude_networks is not None and demarcation[0] in exclude_networks:
-                        continue # don't do loops in path finding
+                if not lp.id_ in port_labels:
+                    port_labels[lp.id_] = lp.label()
+                lp_label = port_labels[lp.id_]
 
-                    demarcation_label = lp.label() if source_network.canSwapLabel(source_stp.label.type_) else source_stp.label.intersect(lp.label())
-                    demarcation_stp = nsa.STP(demarcation[0], demarcation[1], demarcation_label)
-                    sub_exclude_networks = [ source_network.id_ ] + (exclude_networks or [])
-                    sub_links = self._findPathsRecurse(demarcation_stp, dest_stp, bandwidth, sub_exclude_networks)
-                    # if we didn't find any sub paths, just continue
-                    if not sub_links:
-                        continue
+                if (lp_label is None) != (ingress_label is None):
+                    continue # labeled and unlabeled ports cannot be connected
 
-                    for sl in sub_links:
-                        # --
-                        if source_network.canSwapLabel(source_stp.label.type_):
-                            source_label = source_port.label().intersect(source_stp.label)
-                            dest_label   = lp.label().intersect(sl[0].src_stp.label)
-                        else:
-                            source_label = source_port.label().intersect(source_stp.label).intersect(lp.label()).intersect(sl[0].src_stp.label)
-                            dest_label   = source_label
+                try:
+                    egress_label = lp_label if can_swap else _intersect(ingress_label, lp_label)
+                    d_label = _intersect(egress_label, d_port_label)
+                except nsa.EmptyLabelSet:
+                    continue
 
-                        first_link = nsa.Link(source_stp.network, source_stp.port, lp.id_, source_label, dest_label)
-                        path = [ first_link ] + sl
-                        links.append(path)
+                state = (length + 1, sequence.next(), d_network, d_port, d_label, hops + ( (network, ingress_port, ingress_label, lp), ), visited | frozenset([d_network.id_]) )
+                heapq.heappush(queue, state)
 
-                return sorted(links, key=len) # sort by length, shortest first
+        return paths
 
-        else:
-            raise error.TopologyError('Unidirectional path-finding not implemented yet')
+
+    def _createPathLinks(self, hops, dest_stp):
+        # create the links for a path, with labels propagated backwards from the destination
+        # for networks that cannot swap labels, source and destination label is the same
+        links = []
+        next_label = dest_stp.label
+        for network, ingress_port, ingress_label, egress_port in reversed(hops):
+            if network.canSwapLabel(_labelType(ingress_label)):
+                src_label = ingress_label
+                dst_label = _intersect(egress_port.label(), next_label)
+            else:
+                src_label = _intersect(_intersect(ingress_label, egress_port.label()), next_label)
+                dst_label = src_label
+            links.insert(0, nsa.Link( nsa.STP(network.id_, ingress_port.name, src_label), nsa.STP(network.id_, egress_port.name, dst_label) ) )
+            next_label = src_label
+        return links
+
+
+
+def _intersect(label, other):
+    # label intersection, where None means no label restriction
+    if label is None:
+        return other
+    if other is None:
+        return label
+    return label.intersect(other)
+
+
+def _labelType(label):
+    return label.type_ if label is not None else None
 
 
 
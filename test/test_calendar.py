@@ -74,6 +74,21 @@ class CalendarTest(unittest.TestCase):
         self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds2, de2)
 
 
+    def testStartNoneExpired(self):
+
+        now = datetime.datetime.utcnow()
+
+        # reservations which have ended (but not yet been removed) do not block a reservation starting now
+        self.c.addReservation('r1', now - datetime.timedelta(seconds=20), now - datetime.timedelta(seconds=10))
+        self.c.addReservation('r2', None, now - datetime.timedelta(seconds=10))
+        self.c.checkReservation('r1', None, now + datetime.timedelta(seconds=5))
+        self.c.checkReservation('r2', None, None)
+        self.failUnlessEqual( self.c.findAvailable( [ (1, ['r1', 'r2']) ], None, None), (1, ['r1', 'r2']) )
+
+        self.c.addReservation('r1', None, now + datetime.timedelta(seconds=5))
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', None, now + datetime.timedelta(seconds=1))
+
+
     def testStartEndNone(self):
 
         ds1 = None
@@ -87,3 +102,84 @@ class CalendarTest(unittest.TestCase):
         self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds2, de2)
 
 
+
+
+    def testRemoveReservation(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=3)
+
+        self.c.addReservation('r1', ds, de)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds, de)
+
+        self.c.removeReservation('r1', ds, de)
+        self.c.checkReservation('r1', ds, de)
+
+        self.failUnlessRaises(ValueError, self.c.removeReservation, 'r1', ds, de)
+
+
+    def testResourceSeparation(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=3)
+
+        self.c.addReservation('r1', ds, de)
+        self.c.checkReservation('r2', ds, de)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds, de)
+
+
+    def testOverlappingAdd(self):
+        # the calendar does not prevent adding overlapping reservations (happens when building schedule)
+
+        now = datetime.datetime.utcnow()
+        ts = lambda s : now + datetime.timedelta(seconds=s)
+
+        self.c.addReservation('r1', ts(10), ts(100))
+        self.c.addReservation('r1', ts(20), ts(30))
+        self.c.addReservation('r1', ts(40), ts(50))
+
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ts(60), ts(70))
+
+        self.c.removeReservation('r1', ts(10), ts(100))
+        self.c.checkReservation('r1', ts(60), ts(70))
+        self.c.checkReservation('r1', ts(31), ts(39))
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ts(25), ts(35))
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ts(45), ts(55))
+
+
+    def testManyReservations(self):
+
+        now = datetime.datetime.utcnow()
+        ts = lambda s : now + datetime.timedelta(seconds=s)
+
+        for i in range(1, 1000, 2):
+            self.c.addReservation('r1', ts(i*10), ts(i*10+5))
+
+        self.c.checkReservation('r1', ts(1), ts(9))
+        self.c.checkReservation('r1', ts(506), ts(509))
+        self.c.checkReservation('r1', ts(10000), None)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ts(509), ts(515))
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ts(5), None)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', None, ts(20))
+
+
+    def testFindAvailable(self):
+
+        ds = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=3)
+
+        for vlan in range(1, 10):
+            self.c.addReservation('p1:%i' % vlan, ds, de)
+        self.c.addReservation('p2:10', ds, de)
+
+        single = lambda port : ( (vlan, [ '%s:%i' % (port, vlan) ]) for vlan in range(1, 4095) )
+        self.failUnlessEqual( self.c.findAvailable(single('p1'), ds, de), (10, [ 'p1:10' ]) )
+        self.failUnlessEqual( self.c.findAvailable(single('p2'), ds, de), (1,  [ 'p2:1'  ]) )
+
+        pair = ( (vlan, [ 'p1:%i' % vlan, 'p2:%i' % vlan ]) for vlan in range(1, 4095) )
+        self.failUnlessEqual( self.c.findAvailable(pair, ds, de), (11, [ 'p1:11', 'p2:11' ]) )
+
+        busy = ( (vlan, [ 'p1:%i' % vlan ]) for vlan in range(1, 10) )
+        self.failUnlessEqual( self.c.findAvailable(busy, ds, de), None )
+
+        self.failUnlessRaises(error.PayloadError, self.c.findAvailable, single('p1'), de, ds)
@@ -0,0 +1,70 @@
+import datetime
+
+from twisted.trial import unittest
+
+from opennsa.backends.common import capacity
+
+
+
+class CapacityCalendarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c = capacity.CapacityCalendar()
+        now = datetime.datetime.utcnow()
+        self.ts = lambda s : now + datetime.timedelta(seconds=s)
+
+
+    def testEmpty(self):
+
+        self.failUnlessEqual( self.c.peakBandwidth('p1', self.ts(1), self.ts(10)), 0)
+        self.failUnless( self.c.checkCapacity('p1', self.ts(1), self.ts(10), 1000, 1000) )
+        self.failIf( self.c.checkCapacity('p1', self.ts(1), self.ts(10), 1001, 1000) )
+
+
+    def testPeak(self):
+
+        ts = self.ts
+        self.c.addReservation('p1', ts(10), ts(50), 300)
+        self.c.addReservation('p1', ts(20), ts(30), 400)
+        self.c.addReservation('p1', ts(40), ts(60), 200)
+        self.c.addReservation('p2', ts(10), ts(60), 900)
+
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(0),  ts(10)), 0)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(0),  ts(11)), 300)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(25), ts(26)), 700)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(30), ts(40)), 300)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(30), ts(45)), 500)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(50), ts(70)), 200)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(60), None),   0)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', None,   None),   700)
+
+        self.failUnless( self.c.checkCapacity('p1', ts(30), ts(40), 700, 1000) )
+        self.failIf(     self.c.checkCapacity('p1', ts(30), ts(41), 700, 1000) )
+
+
+    def testNoneTimes(self):
+
+        ts = self.ts
+        self.c.addReservation('p1', None, ts(20), 500)
+        self.c.addReservation('p1', ts(10), None, 500)
+
+        self.failUnlessEqual( self.c.peakBandwidth('p1', None,   ts(5)),  500)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(15), ts(16)), 1000)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(20), None),   500)
+
+
+    def testRemove(self):
+
+        ts = self.ts
+        self.c.addReservation('p1', ts(10), ts(20), 300)
+        self.c.addReservation('p1', ts(20), ts(30), 300)
+
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(0), ts(40)), 300)
+
+        self.c.removeReservation('p1', ts(10), ts(20), 300)
+        self.failUnlessEqual( self.c.peakBandwidth('p1', ts(0), ts(20)), 0)
+        self.failUnlessRaises(ValueError, self.c.removeReservation, 'p1', ts(10), ts(20), 300)
+
+        self.c.removeReservation('p1', ts(20), ts(30), 300)
+        self.failUnlessEqual( self.c.ports, {} )
+
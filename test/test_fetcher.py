@@ -0,0 +1,86 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.web import server
+
+from opennsa import config
+from opennsa.shared import modifiableresource
+from opennsa.protocols.shared import httpclient
+from opennsa.discovery import fetcher
+
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = modifiableresource.ModifiableResource('test')
+        self.resource.updateResource('<document/>', datetime.datetime(2017, 1, 1, 12, 0, 0))
+
+        site = server.Site(self.resource)
+        site.noisy = False
+        self.port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+
+        self.documents = []
+        self.fetcher = fetcher.FetcherService(None, [], [ config.Peer(url, 1) ], None)
+        self.fetcher.gotDocument = lambda data, peer : self.documents.append(data)
+        self.fetcher.clock = task.Clock()
+        self.fetcher.running = True
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.fetcher.stopService()
+        yield httpclient.closeCachedConnections()
+        yield self.port.stopListening()
+        yield task.deferLater(reactor, 0, lambda : None) # let the server side see the connections close
+
+
+    @defer.inlineCallbacks
+    def testConditionalFetch(self):
+
+        ps = self.fetcher.peer_states[0]
+
+        yield self.fetcher.fetchDocument(ps)
+        self.failUnlessEqual(self.documents, [ '<document/>' ])
+        self.failUnlessEqual(ps.interval, fetcher.FETCH_INTERVAL_MIN)
+        self.failUnlessEqual(ps.last_modified, 'Sun, 01 Jan 2017 12:00:00 GMT')
+        self.failUnlessEqual(len(self.fetcher.clock.getDelayedCalls()), 1)
+
+        # not modified (304)
+        yield self.fetcher.fetchDocument(ps)
+        self.failUnlessEqual(len(self.documents), 1)
+        self.failUnlessEqual(ps.interval, fetcher.FETCH_INTERVAL_MIN * 2)
+        self.failUnlessEqual(len(self.fetcher.clock.getDelayedCalls()), 1)
+
+        # modified, but same content, document is not parsed again
+        self.resource.updateResource('<document/>', datetime.datetime(2017, 1, 1, 13, 0, 0))
+        yield self.fetcher.fetchDocument(ps)
+        self.failUnlessEqual(len(self.documents), 1)
+        self.failUnlessEqual(ps.interval, fetcher.FETCH_INTERVAL_MIN * 4)
+
+        # new content, interval is reset
+        self.resource.updateResource('<document>new</document>', datetime.datetime(2017, 1, 1, 14, 0, 0))
+        yield self.fetcher.fetchDocument(ps)
+        self.failUnlessEqual(self.documents, [ '<document/>', '<document>new</document>' ])
+        self.failUnlessEqual(ps.interval, fetcher.FETCH_INTERVAL_MIN)
+
+
+    @defer.inlineCallbacks
+    def testBackoffOnFailure(self):
+
+        ps = self.fetcher.peer_states[0]
+        self.resource.updateResource(None) # makes the resource return 500
+
+        intervals = []
+        for i in range(10):
+            yield self.fetcher.fetchDocument(ps)
+            intervals.append(ps.interval)
+
+        self.failUnlessEqual(intervals[:3], [ fetcher.FETCH_INTERVAL_MIN, fetcher.FETCH_INTERVAL_MIN * 2, fetcher.FETCH_INTERVAL_MIN * 4 ])
+        self.failUnlessEqual(intervals[-1], fetcher.FETCH_INTERVAL_MAX)
+
+        delay = self.fetcher.clock.getDelayedCalls()[0].getTime()
+        self.failUnless(fetcher.FETCH_INTERVAL_MAX * 0.9 <= delay <= fetcher.FETCH_INTERVAL_MAX * 1.1)
+
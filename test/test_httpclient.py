@@ -0,0 +1,131 @@
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.internet.error import TimeoutError
+from twisted.web import resource, server
+from twisted.web.error import Error as WebError
+
+from opennsa.protocols.shared import httpclient
+
+
+
+class TestResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        payload = request.content.read()
+        if payload == 'drop-reused' and getattr(request.channel, 'served', False):
+            # like a peer closing an idle connection just as the request arrives
+            request.channel.transport.abortConnection()
+            return server.NOT_DONE_YET
+        request.channel.served = True
+        if payload == 'slow':
+            call = reactor.callLater(0.6, self.finishSlow, request)
+            request.notifyFinish().addErrback(lambda _ : call.cancel()) # client gave up
+            return server.NOT_DONE_YET
+        if payload == 'fail':
+            request.setResponseCode(500)
+            return 'failed'
+        elif payload == 'empty':
+            request.setResponseCode(204)
+            return ''
+        return 'echo:' + payload
+
+    render_GET = render_POST
+
+    def finishSlow(self, request):
+        request.write('echo:slow')
+        request.finish()
+
+
+
+class CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.site = CountingSite(TestResource())
+        self.site.noisy = False
+        self.port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield httpclient.closeCachedConnections()
+        yield self.port.stopListening()
+        yield task.deferLater(reactor, 0, lambda : None) # let the server side see the connections close
+
+
+    @defer.inlineCallbacks
+    def testPersistentConnection(self):
+
+        for i in range(3):
+            data = yield httpclient.httpRequest(self.url, 'req%i' % i, {})
+            self.failUnlessEqual(data, 'echo:req%i' % i)
+
+        data = yield httpclient.httpRequest(self.url, '', {}, method='GET')
+        self.failUnlessEqual(data, 'echo:')
+
+        self.failUnlessEqual(self.site.connections, 1)
+
+
+    @defer.inlineCallbacks
+    def testConnectionLimit(self):
+
+        self.patch(httpclient, 'MAX_CONNECTIONS_PER_HOST', 2)
+        yield httpclient.closeCachedConnections() # pick up the new limit
+
+        results = yield defer.gatherResults( [ httpclient.httpRequest(self.url, 'req%i' % i, {}) for i in range(6) ] )
+        self.failUnlessEqual(results, [ 'echo:req%i' % i for i in range(6) ])
+        self.failUnlessEqual(self.site.connections, 2)
+
+
+    @defer.inlineCallbacks
+    def testErrorStatus(self):
+
+        try:
+            yield httpclient.httpRequest(self.url, 'fail', {})
+            self.fail('Should have raised WebError')
+        except WebError as e:
+            self.failUnlessEqual(e.status, '500')
+            self.failUnlessEqual(e.response, 'failed')
+
+        data = yield httpclient.httpRequest(self.url, 'empty', {})
+        self.failUnlessEqual(data, '')
+
+
+    @defer.inlineCallbacks
+    def testRetryClosedConnection(self):
+
+        data = yield httpclient.httpRequest(self.url, 'req', {})
+        self.failUnlessEqual(data, 'echo:req')
+
+        data = yield httpclient.httpRequest(self.url, 'drop-reused', {})
+        self.failUnlessEqual(data, 'echo:drop-reused')
+        self.failUnlessEqual(self.site.connections, 2)
+
+
+    @defer.inlineCallbacks
+    def testTimeoutExcludesQueueTime(self):
+
+        self.patch(httpclient, 'MAX_CONNECTIONS_PER_HOST', 1)
+        yield httpclient.closeCachedConnections() # pick up the new limit
+
+        # the second request waits for the first, which makes it take longer than the timeout in total
+        results = yield defer.gatherResults( [ httpclient.httpRequest(self.url, 'slow', {}, timeout=1) for i in range(2) ] )
+        self.failUnlessEqual(results, [ 'echo:slow', 'echo:slow' ])
+
+        try:
+            yield httpclient.httpRequest(self.url, 'slow', {}, timeout=0.2)
+            self.fail('Should have raised TimeoutError')
+        except TimeoutError:
+            pass
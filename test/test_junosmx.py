@@ -0,0 +1,85 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+try:
+    from opennsa.backends import junosmx
+except ImportError:
+    junosmx = None # conch (or its crypto dependencies) not available
+
+
+
+class JUNOSCommitBatchTest(unittest.TestCase):
+
+    if junosmx is None:
+        skip = 'Cannot import twisted.conch.ssh'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = [] # (commands, deferred)
+
+        self.sender = junosmx.JUNOSCommandSender('mx.example.org', 22, 'fingerprint', 'user', 'key.pub', 'key', {}, 'example.org')
+        self.sender.batcher.clock = self.clock
+        self.sender._sendCommands = self.sendCommands
+
+
+    def sendCommands(self, commands):
+        d = defer.Deferred()
+        self.sent.append( (commands, d) )
+        return d
+
+
+    def testCommitWindow(self):
+
+        d1 = self.sender._queueCommands( ['set a1', 'set a2'] )
+        d2 = self.sender._queueCommands( ['set b1'] )
+        self.failUnlessEqual(self.sent, [])
+
+        self.clock.advance(junosmx.COMMIT_WINDOW)
+        self.failUnlessEqual(len(self.sent), 1)
+        self.failUnlessEqual(self.sent[0][0], ['set a1', 'set a2', 'set b1'])
+
+        self.sent[0][1].callback(None)
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+
+
+    def testQueuedDuringCommit(self):
+
+        d1 = self.sender._queueCommands( ['set a'] )
+        self.clock.advance(junosmx.COMMIT_WINDOW)
+        self.failUnlessEqual(len(self.sent), 1)
+
+        # queued while the first commit holds the lock, both are committed together afterwards
+        d2 = self.sender._queueCommands( ['set b'] )
+        self.clock.advance(junosmx.COMMIT_WINDOW)
+        d3 = self.sender._queueCommands( ['set c'] )
+        self.failUnlessEqual(len(self.sent), 1)
+
+        self.sent[0][1].callback(None)
+        self.successResultOf(d1)
+        self.failUnlessEqual(len(self.sent), 2)
+        self.failUnlessEqual(self.sent[1][0], ['set b', 'set c'])
+
+        self.sent[1][1].callback(None)
+        self.successResultOf(d2)
+        self.successResultOf(d3)
+
+
+    def testFallbackOnFailure(self):
+
+        d1 = self.sender._queueCommands( ['set a'] )
+        d2 = self.sender._queueCommands( ['set b'] )
+        self.clock.advance(junosmx.COMMIT_WINDOW)
+
+        self.sent[0][1].errback(ValueError('commit failed'))
+
+        # command sets are committed one at a time, and only the failing one is errbacked
+        self.failUnlessEqual(len(self.sent), 2)
+        self.failUnlessEqual(self.sent[1][0], ['set a'])
+        self.sent[1][1].callback(None)
+        self.successResultOf(d1)
+
+        self.failUnlessEqual(self.sent[2][0], ['set b'])
+        self.sent[2][1].errback(ValueError('syntax error'))
+        self.failureResultOf(d2, ValueError)
+
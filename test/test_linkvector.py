@@ -74,3 +74,63 @@ class LinkVectorTest(unittest.TestCase):
         self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), None)
 
 
+
+
+    def testUpdateNotification(self):
+
+        updates = []
+        self.rv.callOnUpdate(lambda : updates.append(self.rv.listVectors()))
+
+        self.rv.updateVector(ARUBA_PORT, { ARUBA_TOPO : 1, BONAIRE_TOPO : 2 } )
+        self.failUnlessEqual(len(updates), 1)
+
+        # same information again, no change
+        self.rv.updateVector(ARUBA_PORT, { ARUBA_TOPO : 1, BONAIRE_TOPO : 2 } )
+        self.failUnlessEqual(len(updates), 1)
+
+        # path to bonaire changes port, but not cost, exported vectors stay the same
+        self.rv.updateVector(BONAIRE_PORT, { BONAIRE_TOPO : 2 } )
+        self.failUnlessEqual(len(updates), 1)
+
+        self.rv.updateVector(BONAIRE_PORT, { BONAIRE_TOPO : 1 } )
+        self.failUnlessEqual(len(updates), 2)
+        self.failUnlessEqual(updates[-1], { ARUBA_TOPO : 1, BONAIRE_TOPO : 1 } )
+        self.failUnlessEqual( self.rv.vector(BONAIRE_TOPO), BONAIRE_PORT)
+
+
+    def testDeleteVector(self):
+
+        self.rv.updateVector(ARUBA_PORT,   { ARUBA_TOPO : 1, BONAIRE_TOPO : 2, CURACAO_TOPO : 3 } )
+        self.rv.updateVector(BONAIRE_PORT, { BONAIRE_TOPO : 1, CURACAO_TOPO : 2 } )
+
+        updates = []
+        self.rv.callOnUpdate(lambda : updates.append(self.rv.listVectors()))
+
+        self.rv.deleteVector(BONAIRE_PORT)
+
+        self.failUnlessEqual( self.rv.vector(BONAIRE_TOPO), ARUBA_PORT)
+        self.failUnlessEqual( self.rv.vector(CURACAO_TOPO), ARUBA_PORT)
+        self.failUnlessEqual(updates, [ { ARUBA_TOPO : 1, BONAIRE_TOPO : 2, CURACAO_TOPO : 3 } ] )
+
+        self.rv.deleteVector(ARUBA_PORT)
+
+        self.failUnlessEqual( self.rv.vector(ARUBA_TOPO), None)
+        self.failUnlessEqual( self.rv.listVectors(), {} )
+        self.failUnlessEqual( len(updates), 2)
+
+
+
+    def testRankedVectors(self):
+
+        self.rv.updateVector(ARUBA_PORT,    { ARUBA_TOPO : 1, CURACAO_TOPO : 3 } )
+        self.rv.updateVector(BONAIRE_PORT,  { BONAIRE_TOPO : 1, CURACAO_TOPO : 2 } )
+        self.rv.updateVector(DOMINICA_PORT, { CURACAO_TOPO : 3 } )
+
+        self.failUnlessEqual( self.rv.rankedVectors(CURACAO_TOPO), [ BONAIRE_PORT, ARUBA_PORT, DOMINICA_PORT ] )
+        self.failUnlessEqual( self.rv.rankedVectors(CURACAO_TOPO, 2), [ BONAIRE_PORT, ARUBA_PORT ] )
+        self.failUnlessEqual( self.rv.rankedVectors(CURACAO_TOPO)[0], self.rv.vector(CURACAO_TOPO) )
+        self.failUnlessEqual( self.rv.rankedVectors(DOMINCA_TOPO), [] )
+
+        self.rv.deleteVector(BONAIRE_PORT)
+        self.failUnlessEqual( self.rv.rankedVectors(CURACAO_TOPO), [ ARUBA_PORT, DOMINICA_PORT ] )
+
@@ -0,0 +1,119 @@
+import json
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.python import log
+
+from opennsa import nsa, logging
+
+
+
+class Unformattable:
+
+    def __str__(self):
+        raise AssertionError('Message should not have been formatted')
+
+
+
+class LoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(logging, 'DEBUG', logging.DEBUG)
+        self.patch(logging, 'PAYLOAD', logging.PAYLOAD)
+
+        self.events = []
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+
+
+    def testDisabledCategoriesNotFormatted(self):
+
+        logging.configure(debug=False, payload=False)
+
+        logging.debug('Debug %s', Unformattable(), system='test')
+        logging.payload('Payload: %s', Unformattable(), system='test')
+
+        self.failUnlessEqual(self.events, [])
+
+
+    def testEnabledCategories(self):
+
+        out = StringIO()
+        logging.configure(debug=True, payload=True)
+        observer = logging.DebugLogObserver(out, debug=True, payload=True)
+
+        logging.debug('Debug %s %i', 'message', 2, system='test')
+        logging.payload('Payload: %s', '<payload/>', system='test')
+        logging.debug('Not a format string: 100%', system='test')
+
+        self.failUnlessEqual( [ e['message'] for e in self.events ], [ ('Debug message 2',), ('Payload: <payload/>',), ('Not a format string: 100%',) ] )
+        self.failUnless(self.events[0]['debug'])
+        self.failUnless(self.events[1]['payload'])
+
+        for event in self.events:
+            observer.emit(event)
+        self.failUnlessIn('[test] Payload: <payload/>', out.getvalue())
+
+
+    def testObserversDoNotConfigure(self):
+
+        logging.configure(debug=True, payload=False)
+        logging.DebugLogObserver(StringIO(), debug=False, payload=True)
+        logging.JSONLogObserver(StringIO(), debug=False, payload=True)
+
+        self.failUnlessEqual( (logging.DEBUG, logging.PAYLOAD), (True, False) )
+
+
+
+class JSONLogObserverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(logging, 'DEBUG', logging.DEBUG)
+        self.patch(logging, 'PAYLOAD', logging.PAYLOAD)
+
+        self.out = StringIO()
+
+
+    def _event(self, message, **kw):
+        event = { 'message': (message,), 'time': 1500000000.25, 'system': 'test', 'isError': 0 }
+        event.update(kw)
+        return event
+
+
+    def _records(self):
+        return [ json.loads(line) for line in self.out.getvalue().splitlines() ]
+
+
+    def testRecords(self):
+
+        observer = logging.JSONLogObserver(self.out)
+        observer.start()
+
+        header = nsa.NSIHeader(None, 'urn:ogf:network:example.net:2013:nsa', correlation_id='urn:uuid:1')
+        observer.emit( self._event('Reserve request', connection_id='conn-1', header=header) )
+        observer.emit( self._event('Debug message', debug=True) )
+        observer.emit( self._event('Plain message', other='not included') )
+        observer.stop()
+
+        records = self._records()
+        self.failUnlessEqual(len(records), 2)
+        self.failUnlessEqual(records[0], { 'time': '2017-07-14T02:40:00.250Z', 'system': 'test', 'message': 'Reserve request', 'connection_id': 'conn-1',
+                                           'correlation_id': 'urn:uuid:1', 'provider_nsa': 'urn:ogf:network:example.net:2013:nsa' })
+        self.failUnlessEqual(records[1], { 'time': '2017-07-14T02:40:00.250Z', 'system': 'test', 'message': 'Plain message' })
+
+
+    def testOverflow(self):
+
+        observer = logging.JSONLogObserver(self.out, queue_size=2)
+
+        # writer not started, so the queue fills up
+        for i in range(5):
+            observer.emit( self._event('Message %i' % i) )
+        self.failUnlessEqual(observer.dropped, 3)
+
+        observer.start()
+        observer.stop()
+
+        records = self._records()
+        self.failUnlessEqual([ r['message'] for r in records[:2] ], [ 'Message 0', 'Message 1' ])
+        self.failUnlessEqual(records[2]['dropped'], 3)
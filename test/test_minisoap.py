@@ -0,0 +1,88 @@
+from twisted.trial import unittest
+
+from opennsa import nsa, error, constants as cnt
+from opennsa.shared import xmlhelper
+from opennsa.protocols.shared import minisoap
+from opennsa.protocols.nsi2 import helper
+from opennsa.protocols.nsi2.bindings import nsiconnection, p2pservices
+
+
+REQUESTER   = 'urn:ogf:network:example.org:2013:requester'
+PROVIDER    = 'urn:ogf:network:example.net:2013:nsa'
+REPLY_TO    = 'http://localhost:9080/NSI/services/RequesterService2'
+
+
+
+def dump(obj):
+    # bindings objects does not implement equality, so compare their attributes
+    if type(obj) in (list, tuple):
+        return [ dump(o) for o in obj ]
+    elif hasattr(obj, '__dict__'):
+        return dict( (k, dump(v)) for k,v in obj.__dict__.items() )
+    else:
+        return obj
+
+
+
+class MiniSOAPTest(unittest.TestCase):
+
+    def createReservePayload(self):
+        header = nsa.NSIHeader(REQUESTER, PROVIDER, correlation_id='urn:uuid:f2d8a5a4-2b34-4fdc-a4a8-3e7d6a4c7d5e',
+                               security_attributes=[ nsa.SecurityAttribute('user', 'testuser') ], connection_trace=[ 'urn:ogf:network:example.org:2013:nsa:1' ])
+        header_element = helper.convertProviderHeader(header, REPLY_TO)
+
+        params = [ p2pservices.TypeValueType('mtu', '9000') ]
+        service_def = p2pservices.P2PServiceBaseType(1000, cnt.BIDIRECTIONAL, True, 'urn:ogf:network:example.net:2013:ps?vlan=1782',
+                                                     'urn:ogf:network:example.net:2013:bon?vlan=1782', None, params)
+        schedule = nsiconnection.ScheduleType('2017-01-01T12:00:00Z', None)
+        criteria = nsiconnection.ReservationRequestCriteriaType(0, schedule, cnt.EVTS_AGOLE, service_def)
+        reservation = nsiconnection.ReserveType(None, None, u'\xe6\xf8\xe5 reservation', criteria)
+
+        return minisoap.createSoapPayload(reservation.xml(nsiconnection.reserve), header_element)
+
+
+    def testCompactPayload(self):
+
+        compact = self.createReservePayload()
+        self.patch(minisoap, 'PRETTY_PRINT', True)
+        pretty = self.createReservePayload()
+
+        self.failIfIn('\n', compact)
+        self.failUnlessIn('\n', pretty)
+        self.failUnlessEqual(dump(helper.parseRequest(compact)), dump(helper.parseRequest(pretty)))
+
+
+    def testParseBackends(self):
+
+        if xmlhelper.lxml_etree is None:
+            raise unittest.SkipTest('lxml not available')
+
+        # comments must not show up as elements
+        payload = self.createReservePayload().replace('<soap:Body>', '<soap:Body><!-- comment -->')
+
+        results = []
+        for backend in (xmlhelper.ETREE, xmlhelper.LXML):
+            self.patch(xmlhelper, 'XML_BACKEND', backend)
+            results.append( dump(helper.parseRequest(payload)) )
+
+        self.failUnlessEqual(results[0], results[1])
+        header, reservation = helper.parseRequest(payload)
+        self.failUnlessEqual(header.connection_trace, [ 'urn:ogf:network:example.org:2013:nsa:1' ])
+        self.failUnlessEqual(reservation.description, u'\xe6\xf8\xe5 reservation')
+
+
+    def testParseFault(self):
+
+        err = error.STPUnavailableError('STP is not available')
+        se = helper.createServiceException(err, PROVIDER, 'conn-1')
+        payload = minisoap.createSoapFault(str(err), se.xml(nsiconnection.serviceException))
+
+        backends = [ xmlhelper.ETREE ] + ([ xmlhelper.LXML ] if xmlhelper.lxml_etree is not None else [])
+        for backend in backends:
+            self.patch(xmlhelper, 'XML_BACKEND', backend)
+            fault_code, fault_string, detail = minisoap.parseFault(payload)
+            self.failUnlessEqual(fault_string, 'STP is not available')
+            service_exception = nsiconnection.parse(detail)
+            self.failUnlessEqual(service_exception.errorId, error.STPUnavailableError.errorId)
+            self.failUnlessEqual(service_exception.connectionId, 'conn-1')
+
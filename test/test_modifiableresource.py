@@ -0,0 +1,99 @@
+import gzip
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web.test.requesthelper import DummyRequest
+
+from opennsa.shared import modifiableresource
+
+
+
+def request(**headers):
+    req = DummyRequest([''])
+    for name, value in headers.items():
+        req.headers[name.replace('_', '-')] = value
+    return req
+
+
+def header(req, name):
+    return req.outgoingHeaders.get(name.lower())
+
+
+
+class ModifiableResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.resource = modifiableresource.ModifiableResource('TestResource', 'application/xml')
+        self.resource.clock = self.clock
+
+
+    def testETag(self):
+
+        self.resource.updateResource('<doc/>')
+
+        req = request()
+        self.failUnlessEqual(self.resource.render_GET(req), '<doc/>')
+        etag = header(req, 'ETag')
+        self.failUnless(etag)
+
+        req = request(if_none_match=etag)
+        self.failUnlessEqual(self.resource.render_GET(req), '')
+        self.failUnlessEqual(req.responseCode, 304)
+
+        self.resource.updateResource('<doc>changed</doc>')
+        req = request(if_none_match=etag)
+        self.failUnlessEqual(self.resource.render_GET(req), '<doc>changed</doc>')
+        self.failIfEqual(header(req, 'ETag'), etag)
+
+
+    def testGzip(self):
+
+        representation = '<doc>' + 'data' * 100 + '</doc>'
+        self.resource.updateResource(representation)
+
+        req = request(accept_encoding='gzip, deflate')
+        data = self.resource.render_GET(req)
+        self.failUnlessEqual(header(req, 'Content-encoding'), 'gzip')
+        self.failUnlessEqual(gzip.GzipFile(fileobj=StringIO(data)).read(), representation)
+        self.failUnless(len(data) < len(representation))
+        self.failUnlessIdentical(self.resource.render_GET(request(accept_encoding='gzip')), data) # cached
+
+        # gzip etag is accepted for the identity variant and vice versa
+        req = request(if_none_match=header(req, 'ETag'))
+        self.resource.render_GET(req)
+        self.failUnlessEqual(req.responseCode, 304)
+
+        req = request(accept_encoding='gzip;q=0')
+        self.failUnlessEqual(self.resource.render_GET(req), representation)
+        self.failUnlessEqual(header(req, 'Content-encoding'), None)
+
+
+    def testDebouncedUpdate(self):
+
+        generated = []
+        def generate():
+            generated.append(None)
+            return '<doc>%i</doc>' % len(generated)
+
+        self.resource.updateLater(generate, 2)
+        self.clock.advance(0)
+        self.failUnlessEqual(len(generated), 1)
+
+        # burst of updates within the window, results in a single regeneration at the end of it
+        for i in range(10):
+            self.resource.updateLater(generate, 2)
+            self.clock.advance(0.1)
+        self.failUnlessEqual(len(generated), 1)
+
+        self.clock.advance(1)
+        self.failUnlessEqual(len(generated), 2)
+        self.failUnlessEqual(self.resource.render_GET(request()), '<doc>2</doc>')
+
+        # outside the window, update is immediate
+        self.clock.advance(5)
+        self.resource.updateLater(generate, 2)
+        self.clock.advance(0)
+        self.failUnlessEqual(len(generated), 3)
+
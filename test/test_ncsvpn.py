@@ -94,3 +94,81 @@ class NCSVPNBackendTest(unittest.TestCase):
 
     testActivation.skip = 'NCS VPN Test Requires NCS lab setup'
 
+
+
+
+class NCSVPNBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.requests = [] # (url, payload, method, deferred)
+        self.patch(ncsvpn.httpclient, 'httpRequest', self.httpRequest)
+
+        port_map = { 'hel' : 'hel:ge-1/0/1', 'sto' : 'sto:ge-1/0/1' }
+        self.cm = ncsvpn.NCSVPNConnectionManager('http://ncs.example.org/api/running/services', 'user', 'pass', port_map, 'NCS Test', batch_window=1)
+        self.cm.batcher.clock = self.clock
+
+        self.source = ncsvpn.NCSVPNTarget('hel', 'ge-1/0/1', 100)
+        self.dest   = ncsvpn.NCSVPNTarget('sto', 'ge-1/0/1', 100)
+
+
+    def httpRequest(self, url, payload, headers, method='POST', timeout=None):
+        d = defer.Deferred()
+        self.requests.append( (url, payload, method, d) )
+        return d
+
+
+    def testBatch(self):
+
+        d1 = self.cm.setupLink('ON-1', self.source, self.dest, 100)
+        d2 = self.cm.setupLink('ON-2', self.source, self.dest, 100)
+        d3 = self.cm.teardownLink('ON-3', self.source, self.dest, 100)
+        self.failUnlessEqual(self.requests, [])
+
+        self.clock.advance(1)
+        self.failUnlessEqual(len(self.requests), 1)
+        url, payload, method, d = self.requests[0]
+        self.failUnlessEqual(method, 'PATCH')
+        self.failUnlessIn('<service-name>ON-1</service-name>', payload)
+        self.failUnlessIn('<service-name>ON-2</service-name>', payload)
+        self.failUnlessIn('nc:operation="delete"', payload)
+
+        d.callback('')
+        for d in (d1, d2, d3):
+            self.successResultOf(d)
+
+
+    def testBatchFallback(self):
+
+        d1 = self.cm.setupLink('ON-1', self.source, self.dest, 100)
+        d2 = self.cm.teardownLink('ON-2', self.source, self.dest, 100)
+        self.clock.advance(1)
+
+        self.requests[0][3].errback(ValueError('transaction failed'))
+
+        # individual requests, one at a time
+        self.failUnlessEqual(len(self.requests), 2)
+        self.failUnlessEqual(self.requests[1][2], 'POST')
+        self.requests[1][3].callback('')
+        self.successResultOf(d1)
+
+        self.failUnlessEqual(self.requests[2][2], 'DELETE')
+        self.failUnlessIn('/bod/ON-2', self.requests[2][0])
+        self.requests[2][3].errback(ValueError('no such service'))
+        self.failureResultOf(d2, ValueError)
+
+
+    def testRepeatedServiceNotInSameBatch(self):
+
+        self.cm.setupLink('ON-1', self.source, self.dest, 100)
+        self.cm.teardownLink('ON-1', self.source, self.dest, 100)
+        self.clock.advance(1)
+
+        # single change batches are sent as normal requests
+        self.failUnlessEqual(len(self.requests), 1)
+        self.failUnlessEqual(self.requests[0][2], 'POST')
+        self.requests[0][3].callback('')
+        self.clock.advance(0)
+        self.failUnlessEqual(len(self.requests), 2)
+        self.failUnlessEqual(self.requests[1][2], 'DELETE')
+        self.requests[1][3].callback('')
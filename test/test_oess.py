@@ -0,0 +1,113 @@
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa.backends import oess
+
+
+
+WORKGROUPS  = json.dumps( { 'results' : [ { 'name' : 'nsi', 'workgroup_id' : 7 } ] } )
+PORTS       = json.dumps( { 'results' : [ { 'name' : 'eth1' }, { 'name' : 'eth2' } ] } )
+AVAILABLE   = json.dumps( { 'results' : [ { 'available' : 1 } ] } )
+PATH        = json.dumps( { 'results' : [ { 'link' : 'l1' } ] } )
+PROVISIONED = json.dumps( { 'results' : { 'success' : 1, 'circuit_id' : 42 } } )
+
+
+
+class OESSQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.queries = [] # (sub_path, deferred)
+        self.patch(oess, 'http_query', self.httpQuery)
+
+        self.setup = oess.OessSetup('http://oess.example.org/', 'user', 'password', 'nsi')
+        self.setup.conn.clock = self.clock
+
+
+    def httpQuery(self, conn, sub_path):
+        d = defer.Deferred()
+        self.queries.append( (sub_path, d) )
+        return d
+
+
+    def testCacheAndCoalescing(self):
+
+        conn = self.setup.conn
+        results = []
+        for _ in range(3):
+            oess.oess_get_workgroups(conn).addCallback(results.append)
+
+        self.failUnlessEqual(len(self.queries), 1) # coalesced
+        self.queries[0][1].callback(WORKGROUPS)
+        self.failUnlessEqual(results, [ WORKGROUPS ] * 3)
+
+        # cached within ttl
+        oess.oess_get_workgroups(conn).addCallback(results.append)
+        self.failUnlessEqual(len(self.queries), 1)
+        self.failUnlessEqual(len(results), 4)
+
+        # explicit invalidation
+        oess.oess_get_workgroups(conn, refresh=True)
+        self.failUnlessEqual(len(self.queries), 2)
+        self.queries[1][1].callback(WORKGROUPS)
+
+        # expired
+        self.clock.advance(oess.CACHE_TTL)
+        oess.oess_get_workgroups(conn)
+        self.failUnlessEqual(len(self.queries), 3)
+
+        # uncached queries are coalesced, but not cached
+        oess.oess_query_vlan_availability(conn, 'sw1', 'eth1', 100)
+        oess.oess_query_vlan_availability(conn, 'sw1', 'eth1', 100)
+        self.failUnlessEqual(len(self.queries), 4)
+        self.queries[3][1].callback(AVAILABLE)
+        oess.oess_query_vlan_availability(conn, 'sw1', 'eth1', 100)
+        self.failUnlessEqual(len(self.queries), 5)
+
+
+    def testQueryFailure(self):
+
+        conn = self.setup.conn
+        d1 = oess.oess_get_switch_ports(conn, 'sw1')
+        d2 = oess.oess_get_switch_ports(conn, 'sw1')
+        self.queries[0][1].errback(ValueError('boom'))
+
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+        # failures are not cached
+        oess.oess_get_switch_ports(conn, 'sw1')
+        self.failUnlessEqual(len(self.queries), 2)
+
+
+    def testConcurrentProvisioning(self):
+
+        d = self.setup.oess_provisioning('sw1:eth1#100', 'sw2:eth2#200')
+
+        # workgroups, two port lists, two vlan availability queries, and primary path are issued at the same time
+        self.failUnlessEqual(len(self.queries), 6)
+
+        replies = { 'get_workgroups' : WORKGROUPS, 'get_node_interfaces' : PORTS,
+                    'is_vlan_tag_available' : AVAILABLE, 'get_shortest_path' : PATH }
+        for sub_path, qd in self.queries[:]:
+            action = sub_path.split('action=')[1].split('&')[0]
+            qd.callback(replies[action])
+
+        # backup path
+        self.failUnlessEqual(len(self.queries), 7)
+        self.failUnlessIn('link=l1', self.queries[6][0])
+        self.queries[6][1].callback(PATH)
+
+        self.failUnlessIn('provision_circuit', self.queries[7][0])
+        self.failUnlessIn('workgroup_id=7', self.queries[7][0])
+        self.queries[7][1].callback(PROVISIONED)
+
+        self.successResultOf(d)
+        self.failUnlessEqual(self.setup.circuit_id, 42)
+
+        # second provisioning only looks up what is not cached
+        self.setup.oess_provisioning('sw1:eth1#101', 'sw2:eth2#201')
+        self.failUnlessEqual(len(self.queries), 8 + 3)
+
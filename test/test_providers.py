@@ -1,11 +1,13 @@
 import os, datetime, json, StringIO
 
 from twisted.trial import unittest
+from twisted.python import failure
 from twisted.internet import reactor, defer, task
 
-from opennsa import nsa, provreg, database, error, setup, aggregator, config, plugin, constants as cnt
+from opennsa import nsa, provreg, database, error, setup, aggregator, config, plugin, state, constants as cnt
 from opennsa.topology import nml, nrm, linkvector
 from opennsa.backends import dud
+from opennsa.protocols.shared import httpclient
 
 from . import topology, common, db
 
@@ -322,6 +324,32 @@ class GenericProviderTest:
             pass # we expect this
 
 
+    @defer.inlineCallbacks
+    def testBandwidthUnavailable(self):
+
+        # ports have 1000 Mbps capacity, two 600 Mbps connections cannot fit, even with different vlans
+        source_stp  = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1781') )
+        dest_stp    = nsa.STP(self.network, self.dest_port,   nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        criteria    = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp, dest_stp, 600, cnt.BIDIRECTIONAL, False, None) )
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.requester.reserve_defer
+
+        self.requester.reserve_defer = defer.Deferred()
+
+        source_stp2 = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1783') )
+        dest_stp2   = nsa.STP(self.network, self.dest_port,   nsa.Label(cnt.ETHERNET_VLAN, '1784') )
+        criteria2   = nsa.Criteria(0, self.schedule, nsa.Point2PointService(source_stp2, dest_stp2, 600, cnt.BIDIRECTIONAL, False, None) )
+
+        self.header.newCorrelationId()
+        try:
+            yield self.provider.reserve(self.header, None, None, None, criteria2)
+            self.fail('Should have raised BandwidthUnavailableError')
+        except error.BandwidthUnavailableError:
+            pass # expected
+
+
     @defer.inlineCallbacks
     def testProvisionNonExistentConnection(self):
 
@@ -775,6 +803,7 @@ class DUDBackendTest(GenericProviderTest, unittest.TestCase):
 
         self.provider = self.backend
         self.provider.scheduler.clock = self.clock
+        self.provider.verify_connection_cache = True
         self.provider.startService()
 
         db.setupDatabase()
@@ -806,6 +835,135 @@ class DUDBackendTest(GenericProviderTest, unittest.TestCase):
     testHairpinConnection.skip = 'Tested in aggregator'
 
 
+    @defer.inlineCallbacks
+    def testBuildSchedule(self):
+        # create connections in various states directly in the database and restore them in a new backend
+
+        from opennsa.backends.common import genericbackend
+
+        class NullRequester:
+            def __getattr__(self, name):
+                return lambda *args : None
+
+        now = datetime.datetime.utcnow()
+        ts = lambda s : now + datetime.timedelta(seconds=s)
+
+        def createConnection(connection_id, label, reservation_state, provision_state, start_time, end_time, data_plane_active, allocated, reserve_time=now):
+            vlan = nsa.Label(cnt.ETHERNET_VLAN, label)
+            conn = genericbackend.GenericBackendConnections(connection_id=connection_id, revision=0, global_reservation_id=None, description=None,
+                        requester_nsa=self.requester_agent.urn(), reserve_time=reserve_time,
+                        reservation_state=reservation_state, provision_state=provision_state, lifecycle_state=state.CREATED, data_plane_active=data_plane_active,
+                        source_network=self.network, source_port=self.source_port, source_label=vlan,
+                        dest_network=self.network, dest_port=self.dest_port, dest_label=vlan,
+                        start_time=start_time, end_time=end_time, symmetrical=False, directionality=cnt.BIDIRECTIONAL, bandwidth=self.bandwidth, allocated=allocated)
+            return conn.save()
+
+        yield createConnection('expired',   '1781', state.RESERVE_START, state.PROVISIONED, ts(-100), ts(-10),  True,  True)
+        yield createConnection('timed-out', '1782', state.RESERVE_HELD,  state.RELEASED,    ts(100),  ts(1000), False, False, reserve_time=ts(-1000))
+        yield createConnection('activate',  '1783', state.RESERVE_START, state.PROVISIONED, ts(-10),  ts(1000), False, True)
+        yield createConnection('scheduled', '1784', state.RESERVE_START, state.PROVISIONED, ts(100),  ts(1000), False, True)
+
+        nrm_ports = nrm.parsePortSpec(StringIO.StringIO(topology.ARUBA_TOPOLOGY))
+        backend = dud.DUDNSIBackend(self.network, nrm_ports, NullRequester(), {})
+        backend.restore_concurrency = 2
+        yield backend.restore_defer
+
+        conns = yield genericbackend.GenericBackendConnections.find()
+        conns = dict( [ (c.connection_id, c) for c in conns ] )
+
+        self.failUnlessEqual(conns['expired'].lifecycle_state,      state.PASSED_ENDTIME)
+        self.failUnlessEqual(conns['expired'].data_plane_active,    False)
+        self.failUnlessEqual(conns['timed-out'].reservation_state,  state.RESERVE_START)
+        self.failUnlessEqual(conns['timed-out'].lifecycle_state,    state.CREATED)
+        self.failUnlessEqual(conns['activate'].data_plane_active,   True)
+        self.failUnlessEqual(conns['scheduled'].data_plane_active,  False)
+
+        # only the active and the scheduled connection should have resources reserved
+        resources = sorted( set( r for r, _, _ in backend.calendar.reservations ) )
+        self.failUnlessEqual(resources, [ '1783', '1784' ])
+
+        self.failUnless(backend.scheduler.hasScheduledCall('activate'))
+        self.failUnless(backend.scheduler.hasScheduledCall('scheduled'))
+        self.failUnless(backend.scheduler.hasScheduledCall('timed-out'))
+
+        # expired and rolled back connections are not live, and are not kept in the cache
+        self.failUnlessEqual(sorted(backend.connections), [ 'activate', 'scheduled' ])
+
+        yield backend.stopService()
+
+
+    @defer.inlineCallbacks
+    def testConnectionCacheEviction(self):
+
+        self.header.newCorrelationId()
+        aborted = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+        self.failUnlessIn(aborted, self.backend.connections)
+
+        yield self.provider.reserveAbort(self.header, aborted)
+        self.failIfIn(aborted, self.backend.connections)
+
+        self.requester.reserve_defer = defer.Deferred()
+        self.header.newCorrelationId()
+        ended = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+        yield self.provider.reserveCommit(self.header, ended)
+
+        conn = self.backend.connections[ended]
+        yield self.backend._doEndtime(conn) # what the scheduler does at end time
+        self.failUnlessEqual(conn.lifecycle_state, state.PASSED_ENDTIME)
+        self.failIfIn(ended, self.backend.connections)
+
+        yield self.provider.terminate(self.header, ended)
+        self.failUnlessEqual(self.backend.connections, {})
+
+
+
+class FakeRemoteProvider:
+    # remote provider for the aggregator, the outcome of reservations is set with mode:
+    # confirm: ack and confirm, ack_error: fail ack, held_ack: ack is left to the test (in held),
+    # reserve_failed: ack, reserveFailed is sent with failReservation
+
+    def __init__(self, aggregator, calls, mode='confirm'):
+        self.aggregator = aggregator
+        self.calls = calls # deferreds of calls to the aggregator
+        self.mode = mode
+        self.reserved = []
+        self.terminated = []
+        self.held = []
+        self.unconfirmed = []
+
+    def reserve(self, header, connection_id, global_reservation_id, description, criteria, request_info=None):
+        if self.mode == 'ack_error':
+            return defer.fail( error.STPUnavailableError('Remote STP not available') )
+        if self.mode == 'held_ack':
+            d = defer.Deferred()
+            self.held.append(d)
+            return d
+
+        self.reserved.append(criteria.service_def)
+        connection_id = 'remote-%i' % len(self.reserved)
+        reply_header = nsa.NSIHeader(header.requester_nsa, header.provider_nsa, correlation_id=header.correlation_id)
+        if self.mode == 'reserve_failed':
+            self.unconfirmed.append( (reply_header, connection_id) )
+        else:
+            # confirm after the ack, like a real provider would
+            self.calls.append( task.deferLater(reactor, 0, self.aggregator.reserveConfirmed, reply_header, connection_id, global_reservation_id, description, criteria) )
+        return defer.succeed(connection_id)
+
+    def failReservation(self):
+        reply_header, connection_id = self.unconfirmed.pop(0)
+        d = self.aggregator.reserveFailed(reply_header, connection_id, None, error.STPUnavailableError('Remote STP not available'))
+        self.calls.append(d)
+        return d
+
+    def terminate(self, header, connection_id, request_info=None):
+        self.terminated.append(connection_id)
+        reply_header = nsa.NSIHeader(header.requester_nsa, header.provider_nsa, correlation_id=header.correlation_id)
+        self.calls.append( task.deferLater(reactor, 0, self.aggregator.terminateConfirmed, reply_header, connection_id) )
+        return defer.succeed(connection_id)
+
+
 
 class AggregatorTest(GenericProviderTest, unittest.TestCase):
 
@@ -818,6 +976,10 @@ class AggregatorTest(GenericProviderTest, unittest.TestCase):
 
         db.setupDatabase()
 
+        # notifications can be in flight when the test is done, which would leave persistent connections behind
+        httpclient.closeCachedConnections()
+        self.patch(httpclient, 'PERSISTENT', False)
+
         self.requester = common.DUDRequester()
 
         self.clock = task.Clock()
@@ -827,6 +989,7 @@ class AggregatorTest(GenericProviderTest, unittest.TestCase):
 
         self.backend = dud.DUDNSIBackend(self.network, nrm_ports, self.requester, {})
         self.backend.scheduler.clock = self.clock
+        self.backend.verify_connection_cache = True
 
         pl = plugin.BasePlugin()
         pl.init( { config.NETWORK_NAME: self.network }, None )
@@ -877,6 +1040,249 @@ class AggregatorTest(GenericProviderTest, unittest.TestCase):
             self.fail('Should not have raised exception: %s' % str(e))
 
 
+    def trackCalls(self, calls, obj, *names):
+        # record a deferred for each call to the named methods, which fires when the call is done
+        def track(method):
+            def call(*args):
+                d = defer.maybeDeferred(method, *args)
+                done = defer.Deferred()
+                def finished(result):
+                    if isinstance(result, failure.Failure):
+                        done.errback(result)
+                    else:
+                        done.callback(result)
+                    return result
+                d.addBoth(finished)
+                calls.append(done)
+                return d
+            return call
+
+        for name in names:
+            self.patch(obj, name, track(getattr(obj, name)))
+
+
+    @defer.inlineCallbacks
+    def waitForCalls(self, calls):
+        # wait for recorded calls, including the ones made while waiting, none of them may fail
+        waited = 0
+        while waited < len(calls):
+            pending = calls[waited:]
+            waited = len(calls)
+            results = yield defer.DeferredList(pending, consumeErrors=True)
+            for success, result in results:
+                if not success:
+                    self.fail('Call failed: %s' % result.getErrorMessage())
+
+
+    def setupAlternatePaths(self, bonaire_mode):
+        # curacao can be reached via both bonaire (cheapest) and dominica
+        calls = []
+        # abandoned sub reservations are terminated while the backend can still be saving them
+        self.backend.verify_connection_cache = False
+        self.trackCalls(calls, self.backend, 'reserve', '_doReserve', 'terminate')
+        self.trackCalls(calls, self.provider, 'reserveConfirmed', 'reserveFailed', 'terminateConfirmed')
+
+        self.provider.route_vectors.updateVector('bon', { 'curacao' : 2 } )
+        self.provider.route_vectors.updateVector('dom', { 'curacao' : 3 } )
+
+        bonaire  = FakeRemoteProvider(self.provider, calls, bonaire_mode)
+        dominica = FakeRemoteProvider(self.provider, calls)
+        self.provider.provider_registry.addProvider('bonaire:nsa',  bonaire,  [ 'bonaire'  ] )
+        self.provider.provider_registry.addProvider('dominica:nsa', dominica, [ 'dominica' ] )
+
+        dest_stp = nsa.STP('curacao', 'ps', nsa.Label(cnt.ETHERNET_VLAN, '1782') )
+        criteria = nsa.Criteria(0, self.schedule, nsa.Point2PointService(self.source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None))
+
+        return calls, bonaire, dominica, criteria
+
+
+    @defer.inlineCallbacks
+    def testAlternatePath(self):
+
+        calls, bonaire, dominica, criteria = self.setupAlternatePaths('ack_error')
+
+        # without the policy, only the best path is tried
+        self.header.newCorrelationId()
+        yield self.failUnlessFailure(self.provider.reserve(self.header, None, None, None, criteria), error.STPUnavailableError)
+        self.failUnlessEqual(dominica.reserved, [])
+        yield self.waitForCalls(calls)
+
+        self.provider.policies.append(cnt.ALTERNATE_PATH)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        self.failUnless(acid)
+
+        self.failUnlessEqual(len(dominica.reserved), 1)
+        self.failUnlessEqual(dominica.reserved[0].source_stp.network, 'dominica')
+        self.failUnlessEqual(dominica.reserved[0].dest_stp, criteria.service_def.dest_stp)
+
+        # the failed bonaire leg must not hold back the aggregated confirmation
+        header, cid, gid, desc, sp = yield self.requester.reserve_defer
+        self.failUnlessEqual(cid, acid)
+
+        yield self.waitForCalls(calls)
+
+
+    @defer.inlineCallbacks
+    def testAlternatePathAbandonedTerminate(self):
+        # the local sub connection is confirmed before the bonaire leg fails, so it is in the database when it is terminated
+
+        calls, bonaire, dominica, criteria = self.setupAlternatePaths('held_ack')
+        self.provider.policies.append(cnt.ALTERNATE_PATH)
+
+        local_confirmed = defer.Deferred()
+        reserveConfirmed = self.provider.reserveConfirmed
+        def confirm(*args):
+            d = reserveConfirmed(*args)
+            d.addCallback(lambda _ : local_confirmed.called or local_confirmed.callback(None))
+            return d
+        self.patch(self.provider, 'reserveConfirmed', confirm)
+
+        self.header.newCorrelationId()
+        d = self.provider.reserve(self.header, None, None, None, criteria)
+        yield local_confirmed
+
+        sub_conns = yield database.SubConnection.find()
+        self.failUnlessEqual(len(sub_conns), 1)
+        self.failUnlessEqual(sub_conns[0].provider_nsa, self.provider_agent.urn())
+
+        bonaire.held[0].errback( error.STPUnavailableError('Remote STP not available') )
+        acid = yield d
+        header, cid, gid, desc, sp = yield self.requester.reserve_defer
+        self.failUnlessEqual(cid, acid)
+        yield self.waitForCalls(calls)
+
+        # the abandoned local sub connection is terminated, without terminating the connection
+        from opennsa.backends.common import genericbackend
+        local_conns = yield genericbackend.GenericBackendConnections.findBy(connection_id=sub_conns[0].connection_id)
+        self.failUnlessEqual(local_conns[0].lifecycle_state, state.TERMINATED)
+
+        conn = yield self.provider.getConnection(acid)
+        self.failUnlessEqual(conn.reservation_state, state.RESERVE_HELD)
+        self.failUnlessEqual(conn.lifecycle_state, state.CREATED)
+        self.failIf(self.requester.terminate_defer.called)
+
+        sub_conns = yield self.provider.getSubConnectionsByConnectionKey(conn.id)
+        self.failUnlessEqual(sorted( [ sc.provider_nsa for sc in sub_conns ] ), sorted( [ 'dominica:nsa', self.provider_agent.urn() ] ))
+
+
+    @defer.inlineCallbacks
+    def testAlternatePathReserveFailed(self):
+        # bonaire acks the reservation, but fails it afterwards
+
+        calls, bonaire, dominica, criteria = self.setupAlternatePaths('reserve_failed')
+        self.provider.policies.append(cnt.ALTERNATE_PATH)
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.waitForCalls(calls)
+        self.failIf(self.requester.reserve_defer.called)
+
+        yield bonaire.failReservation()
+        self.failUnlessEqual(bonaire.terminated, [ 'remote-1' ])
+        self.failUnlessEqual(len(dominica.reserved), 1)
+
+        header, cid, gid, desc, sp = yield self.requester.reserve_defer
+        self.failUnlessEqual(cid, acid)
+        yield self.waitForCalls(calls)
+
+        conn = yield self.provider.getConnection(acid)
+        self.failUnlessEqual(conn.reservation_state, state.RESERVE_HELD)
+
+
+    @defer.inlineCallbacks
+    def testAlternatePathReserveFailedNoPaths(self):
+        # when there are no more paths to try, the failure is passed on
+
+        calls, bonaire, dominica, criteria = self.setupAlternatePaths('reserve_failed')
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, criteria)
+        yield self.waitForCalls(calls)
+
+        yield bonaire.failReservation()
+        header, cid, connection_states, err = self.failureResultOf(self.requester.reserve_defer).value
+        self.failUnlessEqual(cid, acid)
+        self.failUnlessIsInstance(err, error.STPUnavailableError)
+        self.failUnlessEqual(dominica.reserved, [])
+        yield self.waitForCalls(calls)
+
+
+    @defer.inlineCallbacks
+    def testQuerySummaryDataPlaneStatus(self):
+        # data plane status for multiple connections is aggregated from the sub connections in one go
+
+        self.header.newCorrelationId()
+        acid = yield self.provider.reserve(self.header, None, None, None, self.criteria)
+        yield self.requester.reserve_defer
+
+        yield self.provider.reserveCommit(self.header, acid)
+        yield self.requester.reserve_commit_defer
+
+        yield self.provider.provision(self.header, acid)
+        yield self.requester.provision_defer
+
+        self.clock.advance(3)
+        header, cid, nid, timestamp, dps = yield self.requester.data_plane_change_defer
+
+        source_stp = nsa.STP(self.network, self.source_port, nsa.Label(cnt.ETHERNET_VLAN, '1783') )
+        dest_stp   = nsa.STP(self.network, self.dest_port,   nsa.Label(cnt.ETHERNET_VLAN, '1784') )
+        sd = nsa.Point2PointService(source_stp, dest_stp, self.bandwidth, cnt.BIDIRECTIONAL, False, None)
+
+        self.requester.reserve_defer = defer.Deferred()
+        self.header.newCorrelationId()
+        acid2 = yield self.provider.reserve(self.header, None, None, None, nsa.Criteria(0, self.schedule, sd))
+        yield self.requester.reserve_defer
+
+        self.header.newCorrelationId()
+        yield self.provider.querySummary(self.header, connection_ids = [ acid, acid2 ] )
+        header, reservations = yield self.requester.query_summary_defer
+
+        dps = dict( (ci.connection_id, ci.states[3]) for ci in reservations )
+        self.failUnlessEquals(dps[acid][:2],  (True, 0) )
+        self.failUnlessEquals(dps[acid2][:2], (False, 0) )
+
+
+    @defer.inlineCallbacks
+    def testQuerySummaryPages(self):
+
+        now = datetime.datetime.utcnow()
+        ts = lambda s : now + datetime.timedelta(seconds=s)
+
+        for connection_id, lifecycle_state, start_time, end_time in [ ('page-1', state.CREATED,    ts(10),  ts(100) ),
+                                                                      ('page-2', state.TERMINATED, ts(10),  ts(100) ),
+                                                                      ('page-3', state.CREATED,    ts(200), None    ) ]:
+            conn = database.ServiceConnection(connection_id=connection_id, revision=0, requester_nsa=self.header.requester_nsa, reserve_time=now,
+                                              reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=lifecycle_state,
+                                              source_network=self.network, source_port=self.source_port, source_label=self.source_stp.label,
+                                              dest_network=self.network, dest_port=self.dest_port, dest_label=self.dest_stp.label,
+                                              start_time=start_time, end_time=end_time, symmetrical=False, directionality=cnt.BIDIRECTIONAL, bandwidth=200)
+            yield conn.save()
+
+        pages = []
+        def gotPage(reservations):
+            pages.append( [ ci.connection_id for ci in reservations ] )
+
+        count = yield self.provider.querySummaryPages(self.header, None, None, gotPage, page_size=2)
+        self.failUnlessEqual(count, 3)
+        self.failUnlessEqual(pages, [ ['page-1', 'page-2'], ['page-3'] ])
+
+        del pages[:]
+        yield self.provider.querySummaryPages(self.header, None, None, gotPage, lifecycle_states=[state.CREATED])
+        self.failUnlessEqual(pages, [ ['page-1', 'page-3'] ])
+
+        del pages[:]
+        yield self.provider.querySummaryPages(self.header, None, None, gotPage, start_time=ts(150), end_time=ts(300))
+        self.failUnlessEqual(pages, [ ['page-3'] ])
+
+        # last modified is set by the database, so use its idea of time
+        conn = yield database.ServiceConnection.findBy(connection_id='page-3')
+        del pages[:]
+        yield self.provider.querySummaryPages(self.header, None, None, gotPage, modified_since=conn[0].last_modified)
+        self.failUnlessEqual(pages, [ ['page-3'] ])
+
+
 
 class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
 
@@ -897,6 +1303,10 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
 
         db.setupDatabase()
 
+        # notifications can be in flight when the test is done, which would leave persistent connections behind
+        httpclient.closeCachedConnections()
+        self.patch(httpclient, 'PERSISTENT', False)
+
         self.requester = common.DUDRequester()
 
         self.clock = task.Clock()
@@ -906,6 +1316,7 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
 
         self.backend = dud.DUDNSIBackend(self.network, nrm_ports, None, {}) # we set the parent later
         self.backend.scheduler.clock = self.clock
+        self.backend.verify_connection_cache = True
 
         pl = plugin.BasePlugin()
         pl.init( { config.NETWORK_NAME: self.network }, None )
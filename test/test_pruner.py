@@ -46,3 +46,23 @@ class PrunerTest(unittest.TestCase):
         self.assertEquals(pruned_path[1].src_stp.label.labelValue(), '2077')
 
 
+
+
+    def testPruneMultiplePaths(self):
+
+        def createPath(demarc_label):
+            ndn_link = nsa.Link( nsa.STP('nordu.net:2013:topology',     'funet',      nsa.Label('vlan', '2031-2035')),
+                                 nsa.STP('nordu.net:2013:topology',     'surfnet',    nsa.Label('vlan', demarc_label)) )
+            sfn_link = nsa.Link( nsa.STP('surfnet.nl:1990:production7', 'nordunet',   nsa.Label('vlan', demarc_label)),
+                                 nsa.STP('surfnet.nl:1990:production7', '19523',      nsa.Label('vlan', '2077')) )
+            return [ ndn_link, sfn_link ]
+
+        # first path cannot be pruned (no common vlan), and is dropped
+        paths = [ createPath('1780-1789'), createPath('2000-2100') ]
+        pruned_paths = pruner.plugin.prunePaths(paths).result
+
+        self.assertEquals(len(pruned_paths), 1)
+        self.assertEquals(pruned_paths[0][0].dst_stp.label.labelValue(), '2077')
+
+        self.assertRaises(nsa.EmptyLabelSet, pruner.plugin.prunePaths, [ createPath('1780-1789') ])
+
@@ -0,0 +1,112 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa.backends.common import scheduler
+
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = scheduler.TimingWheel(self.clock)
+        self.fired = []
+
+
+    def add(self, delay, name):
+        d = defer.Deferred()
+        d.addCallback(lambda _ : self.fired.append( (name, self.clock.seconds()) ))
+        return self.wheel.add(delay, d)
+
+
+    def testFiringOrderAndTime(self):
+
+        for delay in (2.5, 1, 300, 20000, 7):
+            self.add(delay, delay)
+
+        self.clock.pump( [1] * 30000 )
+
+        self.failUnlessEqual( [ name for name, _ in self.fired ], [ 1, 2.5, 7, 300, 20000 ] )
+        for name, fired_at in self.fired:
+            # never early, at most one tick late
+            self.failUnless( name <= fired_at < name + scheduler.RESOLUTION, 'Call %s fired at %s' % (name, fired_at))
+
+        self.failUnlessEqual( len(self.wheel), 0 )
+        self.failUnlessEqual( self.clock.getDelayedCalls(), [] )
+
+
+    def testRemove(self):
+
+        e1 = self.add(5, 'e1')
+        self.add(5, 'e2')
+        e3 = self.add(600, 'e3')
+
+        self.wheel.remove(e1)
+        self.clock.advance(10)
+        self.failUnlessEqual( [ name for name, _ in self.fired ], [ 'e2' ] )
+
+        self.wheel.remove(e3)
+        self.failUnlessEqual( len(self.wheel), 0 )
+        # no ticking when the wheel is empty
+        self.failUnlessEqual( self.clock.getDelayedCalls(), [] )
+
+
+    def testBatchFiring(self):
+
+        for i in range(100):
+            self.add(3, i)
+
+        self.clock.advance(3)
+        self.failUnlessEqual( len(self.fired), 100 )
+        self.failUnlessEqual( len(self.wheel), 0 )
+
+
+    def testClockJump(self):
+
+        self.add(10, 'a')
+        self.add(100000, 'b')
+
+        self.clock.advance(50000)
+        self.failUnlessEqual( [ name for name, _ in self.fired ], [ 'a' ] )
+        self.clock.advance(50000)
+        self.failUnlessEqual( [ name for name, _ in self.fired ], [ 'a', 'b' ] )
+
+
+
+class CallSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.CallScheduler()
+        self.scheduler.clock = task.Clock()
+        self.calls = []
+
+
+    def testScheduleCancel(self):
+
+        now = datetime.datetime.utcnow()
+
+        self.scheduler.scheduleCall('c1', now + datetime.timedelta(seconds=2), self.calls.append, 'c1')
+        self.scheduler.scheduleCall('c2', now + datetime.timedelta(seconds=4), self.calls.append, 'c2')
+        self.failUnless( self.scheduler.hasScheduledCall('c1') )
+
+        self.scheduler.cancelCall('c2')
+        self.failIf( self.scheduler.hasScheduledCall('c2') )
+
+        self.scheduler.clock.advance(5)
+        self.failUnlessEqual(self.calls, [ 'c1' ])
+
+
+    def testCancelAll(self):
+
+        now = datetime.datetime.utcnow()
+        for i in range(10):
+            self.scheduler.scheduleCall(i, now + datetime.timedelta(seconds=i), self.calls.append, i)
+
+        self.scheduler.cancelAllCalls()
+        self.scheduler.clock.advance(20)
+
+        self.failUnlessEqual(self.calls, [])
+        self.failUnlessEqual(self.scheduler.clock.getDelayedCalls(), [])
+
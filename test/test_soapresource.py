@@ -0,0 +1,76 @@
+import StringIO
+
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+
+from opennsa.protocols.shared import soapresource
+
+
+
+class StreamingRequest(DummyRequest):
+    # request where the transport is full after each write, until the producer is resumed
+
+    def __init__(self, soap_action):
+        DummyRequest.__init__(self, [''])
+        self.method = 'POST'
+        self.requestHeaders.setRawHeaders('soapaction', [ soap_action ])
+        self.content = StringIO.StringIO('')
+        self.producer = None
+
+    def isSecure(self):
+        return False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        DummyRequest.write(self, data)
+        self.producer.pauseProducing()
+
+
+
+class StreamingReplyTest(unittest.TestCase):
+
+    def setUp(self):
+
+        def produce(write):
+            d = write('page 1')
+            d.addCallback(lambda _ : write('page 2'))
+            return d
+
+        self.resource = soapresource.SOAPResource()
+        self.resource.registerDecoder('query', lambda soap_data, request_info : soapresource.StreamingReply(produce))
+        self.request = StreamingRequest('query')
+
+
+    def testBackPressure(self):
+
+        self.failUnlessEqual(self.resource.render_POST(self.request), server.NOT_DONE_YET)
+
+        # nothing more is produced until the transport has room
+        producer = self.request.producer
+        self.failUnlessEqual(self.request.written, [ 'page 1' ])
+        self.failIf(self.request.finished)
+
+        producer.resumeProducing()
+        self.failUnlessEqual(self.request.written, [ 'page 1', 'page 2' ])
+        self.failIf(self.request.finished)
+
+        producer.resumeProducing()
+        self.failUnless(self.request.finished)
+        self.failUnlessEqual(self.request.producer, None)
+
+
+    def testConnectionLost(self):
+
+        self.resource.render_POST(self.request)
+        self.request.producer.stopProducing()
+
+        self.failUnlessEqual(self.request.written, [ 'page 1' ])
+        self.failIf(self.request.finished)
+        self.failUnlessEqual(self.request.producer, None)
+
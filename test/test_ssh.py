@@ -0,0 +1,305 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+try:
+    from opennsa.backends.common import ssh, junos
+except ImportError:
+    ssh = None # conch (or its crypto dependencies) not available
+
+
+
+class FakeSSHConnection:
+
+    def __init__(self):
+        self.written = []
+        self.requests = []
+        self.eof = False
+        self.closed = False
+
+    def sendRequest(self, channel, request_type, data, wantReply=0):
+        self.requests.append(request_type)
+        return defer.succeed(None)
+
+    def sendEOF(self, channel):
+        self.eof = True
+
+    def sendClose(self, channel):
+        self.closed = True
+        channel.closed()
+
+
+
+class CLIChannelTest(unittest.TestCase):
+
+    if ssh is None:
+        skip = 'Cannot import twisted.conch.ssh'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.conn = FakeSSHConnection()
+
+        self.channel = junos.JUNOSChannel(self.conn)
+        self.channel.clock = self.clock
+        self.channel.write = self.conn.written.append
+        self.channel.loseConnection = lambda : self.conn.sendClose(self.channel)
+
+
+    def testSendBlock(self):
+
+        d = self.channel.sendBlock( ['set a', 'set b'] )
+        self.failUnlessEqual(self.conn.written, [ 'set a\rset b\r' ])
+
+        # output arrives in arbitrary chunks, prompts can be split
+        self.channel.dataReceived('set a\r\n\r\n[ed')
+        self.failIf(d.called)
+        self.channel.dataReceived('it]\r\n\r\nset b\r\nwarning: something\r\n\r\n{master:0}')
+        self.failIf(d.called)
+        self.channel.dataReceived('[edit]\r\n')
+
+        responses = self.successResultOf(d)
+        self.failUnlessEqual(len(responses), 2)
+        self.failUnlessIn('set a', responses[0])
+        self.failUnlessIn('warning: something', responses[1])
+
+
+    def testSendBlockError(self):
+
+        d = self.channel.sendBlock( ['set a', 'set b', 'set c'] )
+        self.channel.dataReceived('set a\r\n\r\n[edit]\r\nset b\r\nsyntax error, expecting <command>.\r\n\r\n[edit]\r\n')
+
+        f = self.failureResultOf(d, ssh.CommandError)
+        self.failUnlessEqual(f.value.command, 'set b')
+        self.failUnlessIn('syntax error', f.value.output)
+
+
+    def testTimeout(self):
+
+        d = self.channel.sendBlock( ['set a', 'set b'] )
+        self.channel.dataReceived('set a\r\n\r\n[edit]\r\n')
+        self.failIf(d.called)
+
+        self.clock.advance(self.channel.command_timeout)
+        f = self.failureResultOf(d, ssh.CommandError)
+        self.failUnlessEqual(f.value.command, 'set b')
+        self.failUnlessEqual(self.channel.pending, [])
+
+
+    def testJUNOSCommit(self):
+
+        d = self.channel.sendCommands( ['set a'] )
+        self.failUnlessEqual(self.conn.requests, ['shell'])
+        self.failUnlessEqual(self.conn.written, [ 'edit private\rset a\r' ])
+
+        self.channel.dataReceived('edit private\r\n\r\n[edit]\r\nset a\r\n\r\n[edit]\r\n')
+        self.failUnlessEqual(self.conn.written[-1], 'commit\r')
+        self.failIf(d.called)
+
+        self.channel.dataReceived('commit\r\ncommit complete\r\n\r\n[edit]\r\n')
+        self.successResultOf(d)
+        self.failUnless(self.conn.eof)
+        self.failUnless(self.conn.closed)
+
+
+    def testJUNOSCommitFailure(self):
+
+        d = self.channel.sendCommands( ['set a'] )
+        self.channel.dataReceived('edit private\r\n\r\n[edit]\r\nset a\r\n\r\n[edit]\r\n')
+        self.channel.dataReceived('commit\r\n[edit interfaces]\r\n  \'ge-0/0/1\'\r\n    some check failed\r\n\r\n[edit]\r\n')
+
+        f = self.failureResultOf(d, ssh.CommandError)
+        self.failUnlessEqual(f.value.command, junos.COMMAND_COMMIT)
+        self.failIf(self.conn.closed)
+
+
+
+class FakePoolConnection(FakeSSHConnection):
+
+    def __init__(self, open_failures=0):
+        FakeSSHConnection.__init__(self)
+        self.transport = self
+        self.open_failures = open_failures
+        self.channels = []
+        self.keepalives = [] # reply deferreds, fired by the test
+
+    def loseConnection(self):
+        self.closed = True
+
+    def sendClose(self, channel):
+        # closing a channel leaves the connection open
+        channel.closed()
+
+    def sendGlobalRequest(self, request_type, data, wantReply=0):
+        d = defer.Deferred()
+        self.keepalives.append(d)
+        return d
+
+    def openChannel(self, channel):
+        self.channels.append(channel)
+        if self.open_failures:
+            self.open_failures -= 1
+            channel.openFailed(ValueError('channel open failed'))
+        else:
+            channel.channelOpen('')
+
+
+
+class FakeConnectionCreator:
+
+    def __init__(self):
+        self.connections = []
+        self.open_failures = 0 # for new connections
+        self.hold = False
+        self.held = [] # (deferred, connection) when holding
+
+    def getSSHConnection(self):
+        ssh_connection = FakePoolConnection(self.open_failures)
+        self.connections.append(ssh_connection)
+        if self.hold:
+            d = defer.Deferred()
+            self.held.append( (d, ssh_connection) )
+            return d
+        return defer.succeed(ssh_connection)
+
+
+
+class SSHConnectionPoolTest(unittest.TestCase):
+
+    if ssh is None:
+        skip = 'Cannot import twisted.conch.ssh'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.creator = FakeConnectionCreator()
+
+        self.pool = ssh.SSHConnectionPool(self.creator, max_channels=2)
+        self.pool.clock = self.clock
+
+
+    def testKeepalive(self):
+
+        conn = self.successResultOf( self.pool.getConnection() )
+
+        self.clock.advance(self.pool.keepalive_interval)
+        self.failUnlessEqual(len(conn.keepalives), 1)
+        conn.keepalives[0].callback(None)
+
+        # answered keepalive, connection is kept and reused
+        self.clock.advance(self.pool.keepalive_interval)
+        self.failUnlessEqual(len(conn.keepalives), 2)
+        self.failIf(conn.closed)
+        self.failUnlessIdentical(self.successResultOf( self.pool.getConnection() ), conn)
+        self.failUnlessEqual(len(self.creator.connections), 1)
+
+
+    def testKeepaliveTimeout(self):
+
+        conn = self.successResultOf( self.pool.getConnection() )
+
+        self.clock.advance(self.pool.keepalive_interval)
+        self.failUnlessEqual(len(conn.keepalives), 1)
+
+        # no reply before the next keepalive, connection is dropped and no more keepalives are sent
+        self.clock.advance(self.pool.keepalive_interval)
+        self.failUnless(conn.closed)
+        self.failUnlessEqual(self.pool.ssh_connection, None)
+        self.failUnlessEqual(self.clock.getDelayedCalls(), [])
+
+        new_conn = self.successResultOf( self.pool.getConnection() )
+        self.failIfIdentical(new_conn, conn)
+        self.failUnlessEqual(len(self.creator.connections), 2)
+
+
+    def testReconnect(self):
+
+        conn = self.successResultOf( self.pool.getConnection() )
+        conn.closed = True # lost
+
+        self.creator.hold = True
+        d1 = self.pool.getConnection()
+        d2 = self.pool.getConnection()
+        self.failIf(d1.called or d2.called)
+
+        # only one connection is created for concurrent requests
+        self.failUnlessEqual(len(self.creator.held), 1)
+        d, new_conn = self.creator.held[0]
+        d.callback(new_conn)
+        self.failUnlessIdentical(self.successResultOf(d1), new_conn)
+        self.failUnlessIdentical(self.successResultOf(d2), new_conn)
+
+        # keepalive of the lost connection is gone
+        self.failUnlessEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(self.pool.keepalive_interval)
+        self.failUnlessEqual(conn.keepalives, [])
+        self.failUnlessEqual(len(new_conn.keepalives), 1)
+
+
+    def testReconnectFailure(self):
+
+        self.creator.hold = True
+        d = self.pool.getConnection()
+        self.creator.held[0][0].errback(ValueError('connection refused'))
+        self.failureResultOf(d, ValueError)
+
+        # next request tries again
+        self.creator.hold = False
+        self.successResultOf( self.pool.getConnection() )
+        self.failUnlessEqual(len(self.creator.connections), 2)
+
+
+    def testOpenChannelRetry(self):
+
+        self.successResultOf( self.pool.withChannel(ssh.SSHChannel, lambda channel : None) )
+        conn = self.creator.connections[0]
+
+        # channel open fails on the reused connection, it is retried once on a new connection
+        conn.open_failures = 1
+        channels = []
+        self.successResultOf( self.pool.withChannel(ssh.SSHChannel, channels.append) )
+
+        self.failUnless(conn.closed)
+        self.failUnlessEqual(len(self.creator.connections), 2)
+        self.failUnlessIdentical(channels[0].conn, self.creator.connections[1])
+        self.failUnless(channels[0].channel_closed.called)
+
+
+    def testOpenChannelFailureNewConnection(self):
+
+        # no retry when the channel open fails on a fresh connection
+        self.creator.open_failures = 2
+        self.failureResultOf( self.pool.withChannel(ssh.SSHChannel, lambda channel : None), ValueError )
+        self.failUnlessEqual(len(self.creator.connections), 1)
+
+        # channel slot is released
+        self.failUnlessEqual(self.pool.channel_semaphore.tokens, 2)
+
+
+    def testMaxChannels(self):
+
+        funcs = [] # (channel, deferred)
+        def useChannel(channel):
+            d = defer.Deferred()
+            funcs.append( (channel, d) )
+            return d
+
+        d1 = self.pool.withChannel(ssh.SSHChannel, useChannel)
+        d2 = self.pool.withChannel(ssh.SSHChannel, useChannel)
+        d3 = self.pool.withChannel(ssh.SSHChannel, useChannel)
+
+        self.failUnlessEqual(len(funcs), 2)
+        conn = self.creator.connections[0]
+        self.failUnlessEqual(len(conn.channels), 2)
+
+        # third channel is opened when one of the others is closed
+        funcs[1][1].callback('two')
+        self.failUnlessEqual(self.successResultOf(d2), 'two')
+        self.failUnless(funcs[1][0].channel_closed.called)
+        self.failUnlessEqual(len(funcs), 3)
+        self.failUnlessEqual(len(conn.channels), 3)
+
+        funcs[0][1].callback('one')
+        funcs[2][1].callback('three')
+        self.failUnlessEqual(self.successResultOf(d1), 'one')
+        self.failUnlessEqual(self.successResultOf(d3), 'three')
+        self.failUnlessEqual(self.pool.channel_semaphore.tokens, 2)
+        self.failUnlessEqual(len(self.creator.connections), 1)
+
@@ -0,0 +1,141 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from opennsa import nsa, error, state
+from opennsa.backends.common import genericbackend
+
+from . import db
+
+
+
+class TransitionTest(unittest.TestCase):
+
+    def setUp(self):
+        db.setupDatabase()
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield genericbackend.GenericBackendConnections.deleteAll()
+        from twistar.registry import Registry
+        Registry.DBPOOL.close()
+
+
+    @defer.inlineCallbacks
+    def _createConnection(self, connection_id='conn-1'):
+        label = nsa.Label('vlan', '1782')
+        conn = genericbackend.GenericBackendConnections(connection_id=connection_id, revision=0, global_reservation_id=None, description='test',
+                                                        requester_nsa='urn:ogf:network:example.net:2013:nsa', reserve_time=datetime.datetime.utcnow(),
+                                                        reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED,
+                                                        data_plane_active=False, source_network='example.net:2013', source_port='ps', source_label=label,
+                                                        dest_network='example.net:2013', dest_port='bon', dest_label=label,
+                                                        start_time=None, end_time=None, symmetrical=False, directionality='Bidirectional', bandwidth=200, allocated=False)
+        yield conn.save()
+        defer.returnValue(conn)
+
+
+    def _loadConnection(self, connection_id='conn-1'):
+        d = genericbackend.GenericBackendConnections.findBy(connection_id=connection_id)
+        d.addCallback(lambda conns : conns[0])
+        return d
+
+
+    @defer.inlineCallbacks
+    def testMultipleTransitions(self):
+
+        conn = yield self._createConnection()
+
+        notifications = []
+        state.subscribe(conn.connection_id, lambda : notifications.append(conn.reservation_state))
+        self.addCleanup(state.SUBSCRIPTIONS.pop, conn.connection_id)
+
+        yield state.Transition(conn).reserve(state.RESERVE_CHECKING, state.RESERVE_HELD).provision(state.PROVISIONING).set(allocated=True).commit()
+
+        self.failUnlessEqual(conn.reservation_state, state.RESERVE_HELD)
+        self.failUnlessEqual(conn.provision_state, state.PROVISIONING)
+        self.failUnlessEqual(conn.allocated, True)
+        self.failUnlessEqual(notifications, [ state.RESERVE_HELD ])
+
+        db_conn = yield self._loadConnection()
+        self.failUnlessEqual(db_conn.reservation_state, state.RESERVE_HELD)
+        self.failUnlessEqual(db_conn.provision_state, state.PROVISIONING)
+        self.failUnlessEqual(db_conn.allocated, True)
+
+
+    @defer.inlineCallbacks
+    def testOnlyChangedColumnsPersisted(self):
+
+        conn = yield self._createConnection()
+
+        conn.description = 'not saved'
+        yield state.Transition(conn).lifecycle(state.TERMINATING).commit()
+
+        db_conn = yield self._loadConnection()
+        self.failUnlessEqual(db_conn.lifecycle_state, state.TERMINATING)
+        self.failUnlessEqual(db_conn.description, 'test')
+
+
+    @defer.inlineCallbacks
+    def testInvalidTransition(self):
+
+        conn = yield self._createConnection()
+
+        # validated when the batch is built
+        self.failUnlessRaises(error.InternalServerError, state.Transition(conn).reserve, state.RESERVE_CHECKING, state.RESERVE_START)
+
+        # and again on commit, as the connection may have changed
+        transition = state.Transition(conn).set(allocated=True).reserve(state.RESERVE_CHECKING)
+        yield state.reserveChecking(conn)
+        self.failUnlessRaises(error.InternalServerError, transition.commit)
+
+        self.failUnlessEqual(conn.allocated, False)
+        db_conn = yield self._loadConnection()
+        self.failUnlessEqual(db_conn.reservation_state, state.RESERVE_CHECKING)
+        self.failUnlessEqual(db_conn.allocated, False)
+
+
+
+    @defer.inlineCallbacks
+    def testCommitTransitions(self):
+
+        conns = []
+        for connection_id in ('conn-1', 'conn-2', 'conn-3'):
+            conn = yield self._createConnection(connection_id)
+            conns.append(conn)
+
+        notifications = []
+        for conn in conns:
+            state.subscribe(conn.connection_id, lambda conn=conn : notifications.append(conn.connection_id))
+            self.addCleanup(state.SUBSCRIPTIONS.pop, conn.connection_id)
+
+        transitions = [ state.Transition(conns[0]).reserve(state.RESERVE_CHECKING),
+                        state.Transition(conns[1]).reserve(state.RESERVE_CHECKING),
+                        state.Transition(conns[2]).lifecycle(state.PASSED_ENDTIME) ]
+        yield state.commitTransitions(transitions, chunk_size=1)
+
+        self.failUnlessEqual(sorted(notifications), [ 'conn-1', 'conn-2', 'conn-3' ])
+        for connection_id, reservation_state, lifecycle_state in [ ('conn-1', state.RESERVE_CHECKING, state.CREATED),
+                                                                   ('conn-2', state.RESERVE_CHECKING, state.CREATED),
+                                                                   ('conn-3', state.RESERVE_START,    state.PASSED_ENDTIME) ]:
+            db_conn = yield self._loadConnection(connection_id)
+            self.failUnlessEqual(db_conn.reservation_state, reservation_state)
+            self.failUnlessEqual(db_conn.lifecycle_state, lifecycle_state)
+
+
+    @defer.inlineCallbacks
+    def testCommitTransitionsInvalid(self):
+
+        conn1 = yield self._createConnection('conn-1')
+        conn2 = yield self._createConnection('conn-2')
+
+        transitions = [ state.Transition(conn1).reserve(state.RESERVE_CHECKING),
+                        state.Transition(conn2).reserve(state.RESERVE_CHECKING) ]
+        yield state.reserveChecking(conn2)
+
+        # nothing is changed if one of the transitions is no longer valid
+        self.failUnlessRaises(error.InternalServerError, state.commitTransitions, transitions)
+        self.failUnlessEqual(conn1.reservation_state, state.RESERVE_START)
+        db_conn = yield self._loadConnection('conn-1')
+        self.failUnlessEqual(db_conn.reservation_state, state.RESERVE_START)
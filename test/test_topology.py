@@ -9,10 +9,10 @@ from . import topology
 
 LABEL = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
 
-ARUBA_NETWORK    = 'aruba:topology'
-BONAIRE_NETWORK  = 'bonaire:topology'
-CURACAO_NETWORK  = 'curacao:topology'
-DOMINICA_NETWORK = 'dominica:topology'
+ARUBA_NETWORK    = 'aruba'
+BONAIRE_NETWORK  = 'bonaire'
+CURACAO_NETWORK  = 'curacao'
+DOMINICA_NETWORK = 'dominica'
 
 ARUBA_PS   = nsa.STP(ARUBA_NETWORK,   'ps',   LABEL)
 BONAIRE_PS = nsa.STP(BONAIRE_NETWORK, 'ps', LABEL)
@@ -22,10 +22,10 @@ CURACAO_PS = nsa.STP(CURACAO_NETWORK, 'ps', LABEL)
 class TopologyTest(unittest.TestCase):
 
     def setUp(self):
-        an,_ = nrm.parseTopologySpec(StringIO(topology.ARUBA_TOPOLOGY),    ARUBA_NETWORK)
-        bn,_ = nrm.parseTopologySpec(StringIO(topology.BONAIRE_TOPOLOGY),  BONAIRE_NETWORK)
-        cn,_ = nrm.parseTopologySpec(StringIO(topology.CURACAO_TOPOLOGY),  CURACAO_NETWORK)
-        dn,_ = nrm.parseTopologySpec(StringIO(topology.DOMINICA_TOPOLOGY), DOMINICA_NETWORK)
+        an = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(topology.ARUBA_TOPOLOGY)),    ARUBA_NETWORK,    ARUBA_NETWORK)
+        bn = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(topology.BONAIRE_TOPOLOGY)),  BONAIRE_NETWORK,  BONAIRE_NETWORK)
+        cn = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(topology.CURACAO_TOPOLOGY)),  CURACAO_NETWORK,  CURACAO_NETWORK)
+        dn = nml.createNMLNetwork(nrm.parsePortSpec(StringIO(topology.DOMINICA_TOPOLOGY)), DOMINICA_NETWORK, DOMINICA_NETWORK)
 
         a_nsa = nsa.NetworkServiceAgent('aruba:nsa',    'a-endpoint')
         b_nsa = nsa.NetworkServiceAgent('bonaire:nsa',  'b-endpoint')
@@ -56,7 +56,6 @@ class TopologyTest(unittest.TestCase):
         #paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 800)
         #self.assertEquals(len(paths), 1)
 
-    testBasicPathfinding.skip = 'NML module is not used'
 
     def testNoSwapPathfinding(self):
 
@@ -65,34 +64,33 @@ class TopologyTest(unittest.TestCase):
 
         first_path = paths[0]
         self.assertEquals(len(first_path), 2) # aruba - bonaire
-        self.assertEquals( [ l.network for l in first_path ], [ARUBA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in first_path ], [ARUBA_NETWORK, BONAIRE_NETWORK] )
 
         fpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         for link in first_path:
-            self.assertEquals(link.src_label, fpl)
-            self.assertEquals(link.dst_label, fpl)
+            self.assertEquals(link.src_stp.label, fpl)
+            self.assertEquals(link.dst_stp.label, fpl)
 
 
         second_path = paths[1]
         self.assertEquals(len(second_path), 3) # aruba - dominica - bonaire
-        self.assertEquals( [ l.network for l in second_path ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in second_path ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
 
         spl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1782')
         for link in second_path:
-            self.assertEquals(link.src_label, spl)
-            self.assertEquals(link.dst_label, spl)
+            self.assertEquals(link.src_stp.label, spl)
+            self.assertEquals(link.dst_stp.label, spl)
 
 
         third_path = paths[2]
         self.assertEquals(len(third_path), 4) # aruba - dominica - curacao - bonaire
-        self.assertEquals( [ l.network for l in third_path ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in third_path ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1783-1786')
         for link in third_path:
-            self.assertEquals(link.src_label, tpl)
-            self.assertEquals(link.dst_label, tpl)
+            self.assertEquals(link.src_stp.label, tpl)
+            self.assertEquals(link.dst_stp.label, tpl)
 
-    testNoSwapPathfinding.skip = 'NML module is not used'
 
 
     def testFullSwapPathfinding(self):
@@ -106,54 +104,53 @@ class TopologyTest(unittest.TestCase):
 
         fp = paths[0]
         self.assertEquals(len(fp), 2) # aruba - bonaire
-        self.assertEquals( [ l.network for l in fp ], [ARUBA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in fp ], [ARUBA_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         ipl = nsa.Label(cnt.ETHERNET_VLAN, '1780-1789')
 
-        self.assertEquals(fp[0].src_label, tpl)
-        self.assertEquals(fp[0].dst_label, ipl)
-        self.assertEquals(fp[1].src_label, ipl)
-        self.assertEquals(fp[1].dst_label, tpl)
+        self.assertEquals(fp[0].src_stp.label, tpl)
+        self.assertEquals(fp[0].dst_stp.label, ipl)
+        self.assertEquals(fp[1].src_stp.label, ipl)
+        self.assertEquals(fp[1].dst_stp.label, tpl)
 
         del fp, tpl, ipl
 
         sp = paths[1]
         self.assertEquals(len(sp), 3) # aruba - dominica - bonaire
-        self.assertEquals( [ l.network for l in sp ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in sp ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         ipl = nsa.Label(cnt.ETHERNET_VLAN, '1780-1789')
         jpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1782')
 
-        self.assertEquals(sp[0].src_label, tpl)
-        self.assertEquals(sp[0].dst_label, ipl)
-        self.assertEquals(sp[1].src_label, ipl)
-        self.assertEquals(sp[1].dst_label, jpl)
-        self.assertEquals(sp[2].src_label, jpl)
-        self.assertEquals(sp[2].dst_label, tpl)
+        self.assertEquals(sp[0].src_stp.label, tpl)
+        self.assertEquals(sp[0].dst_stp.label, ipl)
+        self.assertEquals(sp[1].src_stp.label, ipl)
+        self.assertEquals(sp[1].dst_stp.label, jpl)
+        self.assertEquals(sp[2].src_stp.label, jpl)
+        self.assertEquals(sp[2].dst_stp.label, tpl)
 
         del sp, tpl, ipl, jpl
 
         tp = paths[2]
         self.assertEquals(len(tp), 4) # aruba - dominica - curacao - bonaire
-        self.assertEquals( [ l.network for l in tp ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in tp ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         ipl = nsa.Label(cnt.ETHERNET_VLAN, '1780-1789')
         jpl = nsa.Label(cnt.ETHERNET_VLAN, '1783-1786')
         kpl = nsa.Label(cnt.ETHERNET_VLAN, '1780-1789')
 
-        self.assertEquals(tp[0].src_label, tpl)
-        self.assertEquals(tp[0].dst_label, ipl)
-        self.assertEquals(tp[1].src_label, ipl)
-        self.assertEquals(tp[1].dst_label, jpl)
-        self.assertEquals(tp[2].src_label, jpl)
-        self.assertEquals(tp[2].dst_label, kpl)
-        self.assertEquals(tp[3].src_label, kpl)
-        self.assertEquals(tp[3].dst_label, tpl)
+        self.assertEquals(tp[0].src_stp.label, tpl)
+        self.assertEquals(tp[0].dst_stp.label, ipl)
+        self.assertEquals(tp[1].src_stp.label, ipl)
+        self.assertEquals(tp[1].dst_stp.label, jpl)
+        self.assertEquals(tp[2].src_stp.label, jpl)
+        self.assertEquals(tp[2].dst_stp.label, kpl)
+        self.assertEquals(tp[3].src_stp.label, kpl)
+        self.assertEquals(tp[3].dst_stp.label, tpl)
 
-    testFullSwapPathfinding.skip = 'NML module is not used'
 
 
     def testPartialSwapPathfinding(self):
@@ -167,51 +164,68 @@ class TopologyTest(unittest.TestCase):
 
         fp = paths[0]
         self.assertEquals(len(fp), 2) # aruba - bonaire
-        self.assertEquals( [ l.network for l in fp ], [ARUBA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in fp ], [ARUBA_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
 
-        self.assertEquals(fp[0].src_label, tpl)
-        self.assertEquals(fp[0].dst_label, tpl)
-        self.assertEquals(fp[1].src_label, tpl)
-        self.assertEquals(fp[1].dst_label, tpl)
+        self.assertEquals(fp[0].src_stp.label, tpl)
+        self.assertEquals(fp[0].dst_stp.label, tpl)
+        self.assertEquals(fp[1].src_stp.label, tpl)
+        self.assertEquals(fp[1].dst_stp.label, tpl)
 
         del fp, tpl
 
         sp = paths[1]
         self.assertEquals(len(sp), 3) # aruba - dominica - bonaire
-        self.assertEquals( [ l.network for l in sp ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in sp ], [ARUBA_NETWORK, DOMINICA_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         ipl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1782')
 
-        self.assertEquals(sp[0].src_label, tpl)
-        self.assertEquals(sp[0].dst_label, tpl)
-        self.assertEquals(sp[1].src_label, tpl)
-        self.assertEquals(sp[1].dst_label, ipl)
-        self.assertEquals(sp[2].src_label, ipl)
-        self.assertEquals(sp[2].dst_label, tpl)
+        self.assertEquals(sp[0].src_stp.label, tpl)
+        self.assertEquals(sp[0].dst_stp.label, tpl)
+        self.assertEquals(sp[1].src_stp.label, tpl)
+        self.assertEquals(sp[1].dst_stp.label, ipl)
+        self.assertEquals(sp[2].src_stp.label, ipl)
+        self.assertEquals(sp[2].dst_stp.label, tpl)
 
         del sp, tpl, ipl
 
         tp = paths[2]
         self.assertEquals(len(tp), 4) # aruba - dominica - curacao - bonaire
-        self.assertEquals( [ l.network for l in tp ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
+        self.assertEquals( [ l.src_stp.network for l in tp ], [ARUBA_NETWORK, DOMINICA_NETWORK, CURACAO_NETWORK, BONAIRE_NETWORK] )
 
         tpl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         ipl = nsa.Label(cnt.ETHERNET_VLAN, '1781-1789')
         jpl = nsa.Label(cnt.ETHERNET_VLAN, '1783-1786')
 
-        self.assertEquals(tp[0].src_label, tpl)
-        self.assertEquals(tp[0].dst_label, ipl)
-        self.assertEquals(tp[1].src_label, ipl)
-        self.assertEquals(tp[1].dst_label, jpl)
-        self.assertEquals(tp[2].src_label, jpl)
-        self.assertEquals(tp[2].dst_label, jpl)
-        self.assertEquals(tp[3].src_label, jpl)
-        self.assertEquals(tp[3].dst_label, tpl)
+        self.assertEquals(tp[0].src_stp.label, tpl)
+        self.assertEquals(tp[0].dst_stp.label, ipl)
+        self.assertEquals(tp[1].src_stp.label, ipl)
+        self.assertEquals(tp[1].dst_stp.label, jpl)
+        self.assertEquals(tp[2].src_stp.label, jpl)
+        self.assertEquals(tp[2].dst_stp.label, jpl)
+        self.assertEquals(tp[3].src_stp.label, jpl)
+        self.assertEquals(tp[3].dst_stp.label, tpl)
+
+
+    def testPathfindingBounds(self):
+
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_paths=2)
+        self.assertEquals( [ len(path) for path in paths ], [2,3] )
+
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, max_hops=3)
+        self.assertEquals( [ len(path) for path in paths ], [2,3] )
+
+        paths = self.topology.findPaths(ARUBA_PS, BONAIRE_PS, 100, exclude_networks=[ DOMINICA_NETWORK ])
+        self.assertEquals( [ [ l.src_stp.network for l in path ] for path in paths ], [ [ARUBA_NETWORK, BONAIRE_NETWORK] ] )
+
+        # source port is not considered as a demarcation, and path endpoints are kept
+        self.assertEquals(paths[0][0].src_stp.port, 'ps')
+        self.assertEquals(paths[0][0].dst_stp.port, 'bon')
+        self.assertEquals(paths[0][1].src_stp.port, 'aru')
+        self.assertEquals(paths[0][1].dst_stp.port, 'ps')
 
-    testPartialSwapPathfinding.skip = 'NML module is not used'
 
     def testNoAvailableBandwidth(self):
         self.failUnlessRaises(error.BandwidthUnavailableError, self.topology.findPaths, ARUBA_PS, BONAIRE_PS, 1200)